@@ -0,0 +1,172 @@
+"""
+Keyrings and messages for the benchmark. Every case of the bot logic (see README) is covered by inline PGP mails,
+the signed and encrypted ones also as PGP/MIME, with different mixes of attachments.
+"""
+from collections import namedtuple
+from email.mime.application import MIMEApplication
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+import os
+import random
+
+import gnupg
+
+from pgpbuddy.crypto import Encryption, Signature
+from pgpbuddy.keycache import SenderKeys, NO_KEYS
+
+
+BUDDY = "buddy@example.com"
+# the keyserver stand-in knows the sender's key but not the stranger's
+SENDER = "sender@example.org"
+STRANGER = "stranger@example.org"
+
+KEY_INPUT = """Key-Type: RSA
+Key-Length: {bits}
+Key-Usage: sign
+Subkey-Type: RSA
+Subkey-Length: {bits}
+Subkey-Usage: encrypt
+Name-Real: {name}
+Name-Email: {email}
+Expire-Date: 0
+%no-protection
+%commit
+"""
+
+Keyrings = namedtuple('Keyrings', 'buddy_home sender_gpg keyserver')
+
+# case of the bot logic, expected outcome of handling the message, and the message itself
+Sample = namedtuple('Sample', 'case encryption signature raw_message')
+
+
+def create_keyrings(directory, bits=2048):
+    """
+    Create buddy's GnuPG home and a second one that holds the keys of the people writing to buddy.
+    :return: Keyrings, keyserver maps a sender to the SenderKeys the keyserver stand-in returns
+    """
+    buddy_home = os.path.join(directory, "buddy")
+    sender_home = os.path.join(directory, "senders")
+    for home in (buddy_home, sender_home):
+        os.makedirs(home, mode=0o700)
+
+    buddy_gpg = gnupg.GPG(gnupghome=buddy_home)
+    buddy_gpg.gen_key(KEY_INPUT.format(bits=bits, name="PGPBuddy", email=BUDDY))
+
+    sender_gpg = gnupg.GPG(gnupghome=sender_home)
+    sender_gpg.encoding = 'utf-8'
+    for email in (SENDER, STRANGER):
+        sender_gpg.gen_key(KEY_INPUT.format(bits=bits, name=email.split("@")[0], email=email))
+    sender_gpg.import_keys(buddy_gpg.export_keys(BUDDY))
+
+    fingerprints = tuple(key["fingerprint"] for key in sender_gpg.list_keys(keys=[SENDER]))
+    keyserver = {SENDER: SenderKeys(sender_gpg.export_keys(SENDER), fingerprints), STRANGER: NO_KEYS}
+    return Keyrings(buddy_home, sender_gpg, keyserver)
+
+
+def create_corpus(gpg, attachment_size=256 * 1024):
+    """
+    :param gpg: GPG with the secret keys of SENDER and STRANGER and the public key of BUDDY
+    :return: list of Sample
+    """
+    text = "Hi buddy, is this working?"
+    png = b'\x89PNG\r\n\x1a\n' + os.urandom(attachment_size)
+    pdf = b'%PDF-1.4\n' + os.urandom(attachment_size)
+    key = gpg.export_keys(SENDER)
+
+    def clearsign(signer, data=text):
+        return str(gpg.sign(data, keyid=signer, clearsign=True))
+
+    def encrypt(recipient, signer=None, data=text):
+        return str(gpg.encrypt(data, recipient, sign=signer, always_trust=True))
+
+    # C: the signed text was changed on the way
+    tampered = clearsign(SENDER).replace(text, text.upper())
+
+    return [
+        Sample("A", Encryption.missing, Signature.missing, inline(SENDER, text)),
+        Sample("A", Encryption.missing, Signature.missing, inline(SENDER, text, [png, pdf])),
+        Sample("B", Encryption.missing, Signature.incorrect, inline(STRANGER, clearsign(STRANGER))),
+        Sample("C", Encryption.missing, Signature.incorrect, inline(SENDER, tampered)),
+        Sample("D", Encryption.correct, Signature.incorrect, inline(STRANGER, encrypt(BUDDY, STRANGER))),
+        Sample("E", Encryption.missing, Signature.correct, inline(SENDER, clearsign(SENDER))),
+        Sample("E", Encryption.missing, Signature.correct, inline(SENDER, clearsign(SENDER), [png, key])),
+        Sample("E", Encryption.missing, Signature.correct, pgp_mime_signed(gpg, SENDER, text, [pdf])),
+        Sample("F", Encryption.correct, Signature.correct, inline(SENDER, encrypt(BUDDY, SENDER))),
+        Sample("F", Encryption.correct, Signature.correct, pgp_mime_encrypted(gpg, SENDER, text, SENDER)),
+        Sample("G", Encryption.correct, Signature.missing, inline(STRANGER, encrypt(BUDDY))),
+        Sample("H", Encryption.correct, Signature.missing, inline(SENDER, encrypt(BUDDY))),
+        Sample("H", Encryption.correct, Signature.missing, inline(SENDER, encrypt(BUDDY), [png])),
+        Sample("H", Encryption.correct, Signature.missing, pgp_mime_encrypted(gpg, SENDER, text)),
+        # I: encrypted to a key buddy does not have
+        Sample("I", Encryption.incorrect, Signature.missing, inline(SENDER, encrypt(STRANGER))),
+    ]
+
+
+def sample_messages(corpus, count, seed=0):
+    """
+    :return: count samples drawn from the corpus, every sample at least once if count allows
+    """
+    rng = random.Random(seed)
+    samples = list(corpus) * (count // len(corpus))
+    samples += rng.sample(corpus, count - len(samples))
+    rng.shuffle(samples)
+    return samples
+
+
+def envelope(message, sender, subject):
+    message["From"] = sender
+    message["To"] = BUDDY
+    message["Subject"] = subject
+    return message
+
+
+def inline(sender, text, attachments=()):
+    if not attachments:
+        return envelope(MIMEText(text, 'plain', 'utf-8'), sender, "inline").as_bytes()
+
+    message = MIMEMultipart()
+    message.attach(MIMEText(text, 'plain', 'utf-8'))
+    for i, data in enumerate(attachments):
+        if isinstance(data, str):
+            part = MIMEText(data, 'plain', 'utf-8')
+            part.add_header('Content-Disposition', 'attachment', filename="key{}.asc".format(i))
+        else:
+            part = MIMEApplication(data)
+            part.add_header('Content-Disposition', 'attachment', filename="attachment{}".format(i))
+        message.attach(part)
+    return envelope(message, sender, "inline with attachments").as_bytes()
+
+
+def pgp_mime_signed(gpg, sender, text, attachments=()):
+    content = MIMEMultipart()
+    content.attach(MIMEText(text, 'plain', 'utf-8'))
+    for i, data in enumerate(attachments):
+        part = MIMEApplication(data)
+        part.add_header('Content-Disposition', 'attachment', filename="attachment{}".format(i))
+        content.attach(part)
+
+    # buddy verifies the signed part exactly as it appears between the boundaries, with \n line endings
+    signed = content.as_bytes().replace(b'\r\n', b'\n')
+    signature = str(gpg.sign(signed, keyid=sender, detach=True, binary=False))
+
+    boundary = "signed-boundary"
+    return ("From: {}\nTo: {}\nSubject: PGP/MIME signed\nMIME-Version: 1.0\n"
+            "Content-Type: multipart/signed; micalg=pgp-sha256; protocol=\"application/pgp-signature\"; "
+            "boundary=\"{}\"\n\n--{}\n".format(sender, BUDDY, boundary, boundary)).encode() + signed + \
+           ("\n--{}\nContent-Type: application/pgp-signature; name=\"signature.asc\"\n\n{}\n--{}--\n"
+            .format(boundary, signature, boundary)).encode()
+
+
+def pgp_mime_encrypted(gpg, sender, text, signer=None):
+    content = MIMEText(text, 'plain', 'utf-8')
+    encrypted = str(gpg.encrypt(content.as_string(), BUDDY, sign=signer, always_trust=True))
+
+    message = MIMEMultipart('encrypted', protocol="application/pgp-encrypted")
+    version = MIMEBase('application', 'pgp-encrypted')
+    version.set_payload("Version: 1\n")
+    message.attach(version)
+    body = MIMEBase('application', 'octet-stream', name="encrypted.asc")
+    body.set_payload(encrypted)
+    message.attach(body)
+    return envelope(message, sender, "PGP/MIME encrypted").as_bytes()
@@ -0,0 +1,166 @@
+"""
+Benchmark of the message handling pipeline against a real GnuPG home and in-memory mail servers.
+
+    python -m benchmarks.run --messages 200 --json benchmark.json
+
+Reports messages per second, p50/p99 latencies of every stage and the peak memory the pipeline allocated.
+Messages whose outcome differs from the bot logic in the README are counted per case, such a difference means the
+benchmark did not time the path it was meant to.
+"""
+from collections import Counter, OrderedDict
+import argparse
+import json
+import math
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.corpus import create_keyrings, create_corpus, sample_messages
+from benchmarks.servers import MemoryMailbox, MemorySMTP, local_servers
+from pgpbuddy.buddy import handle_message, make_response
+from pgpbuddy.fetch import iter_new_messages
+from pgpbuddy.keycache import NO_KEYS
+from pgpbuddy.prefetch import KeyPrefetcher
+from pgpbuddy.send import send_responses
+from pgpbuddy.signcache import SignatureCache
+from pgpbuddy.state import MailState
+from pgpbuddy.workspace import init_workspaces, gpgconf
+
+
+# rollback is deleting the keys a message imported from the workspace again
+STAGES = ["fetch", "handle", "respond", "rollback", "send"]
+
+
+def percentile(values, p):
+    # nearest rank
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(math.ceil(p / 100.0 * len(values))) - 1))]
+
+
+def run(samples, keyrings, signatures=True):
+    """
+    Answer all samples once, the way buddy answers a poll of the mailbox, with a workspace like one of buddy's workers.
+    :return: dictionary with the results
+    """
+    mailbox = MemoryMailbox(sample.raw_message for sample in samples)
+    smtp = MemorySMTP()
+    expected = {"uid{}".format(i + 1): sample for i, sample in enumerate(samples)}
+
+    prefetcher = KeyPrefetcher(lambda sender: keyrings.keyserver.get(sender, NO_KEYS))
+    cache = SignatureCache() if signatures else None
+    state = MailState(":memory:")
+
+    latencies = OrderedDict((stage, []) for stage in STAGES)
+    mismatches = Counter()
+    responses = []
+    # setting up the workspace is done once per process in buddy, it is not part of the timings
+    with init_workspaces(keyrings.buddy_home, 1) as workspaces, local_servers(mailbox, smtp):
+        # memory is traced from here on, keys, corpus and workspace are not counted
+        tracemalloc.start()
+        started = time.perf_counter()
+        messages = iter_new_messages("pop3", "buddy", "password", state)
+        while True:
+            start = time.perf_counter()
+            try:
+                uid, message = next(messages)
+            except StopIteration:
+                break
+            latencies["fetch"].append(time.perf_counter() - start)
+
+            with workspaces.acquire() as workspace:
+                with workspace.message() as gpg:
+                    start = time.perf_counter()
+                    header, encryption_status, signature_status, reason = handle_message(gpg, message, prefetcher)
+                    latencies["handle"].append(time.perf_counter() - start)
+
+                    start = time.perf_counter()
+                    response_full, _ = make_response(gpg, header, encryption_status, signature_status, reason,
+                                                     workspace.index, cache)
+                    responses.append(response_full)
+                    latencies["respond"].append(time.perf_counter() - start)
+
+                    # leaving the block rolls back the keys the message imported
+                    start = time.perf_counter()
+                latencies["rollback"].append(time.perf_counter() - start)
+
+            sample = expected[uid]
+            if (encryption_status, signature_status) != (sample.encryption, sample.signature):
+                mismatches[sample.case] += 1
+
+        # all replies of a poll go out over one session
+        start = time.perf_counter()
+        sent, failed = send_responses("smtp", 465, "buddy", "password", responses)
+        latencies["send"].append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - started
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    prefetcher.close()
+    state.close()
+
+    return OrderedDict([
+        ("messages", len(samples)),
+        ("cases", dict(Counter(sample.case for sample in samples))),
+        ("seconds", elapsed),
+        ("messages_per_second", len(samples) / elapsed if elapsed else 0.0),
+        ("stages", OrderedDict((stage, OrderedDict([("count", len(values)),
+                                                    ("p50_ms", 1000 * percentile(values, 50)),
+                                                    ("p99_ms", 1000 * percentile(values, 99)),
+                                                    ("total_s", sum(values))]))
+                               for stage, values in latencies.items())),
+        ("sent", len(sent)),
+        ("failed", len(failed)),
+        ("unexpected_outcomes", dict(mismatches)),
+        # python allocations of the pipeline stages, the gpg processes are not included
+        ("peak_memory_kb", peak_memory // 1024),
+    ])
+
+
+def report(results):
+    lines = ["{messages} messages in {seconds:.2f} s, {messages_per_second:.1f} messages/s".format(**results),
+             "{:<10}{:>8}{:>12}{:>12}{:>12}".format("stage", "count", "p50 ms", "p99 ms", "total s")]
+    for stage, values in results["stages"].items():
+        lines.append("{:<10}{count:>8}{p50_ms:>12.2f}{p99_ms:>12.2f}{total_s:>12.2f}".format(stage, **values))
+    lines.append("sent {sent}, failed {failed}".format(**results))
+    lines.append("peak memory {peak_memory_kb} kB".format(**results))
+    if results["unexpected_outcomes"]:
+        # the timings of these cases did not measure the path the bot logic describes
+        lines.append("messages per case answered differently than the bot logic describes: {}"
+                     .format(results["unexpected_outcomes"]))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark buddy's message handling pipeline")
+    parser.add_argument("--messages", type=int, default=100, help="number of messages to answer")
+    parser.add_argument("--key-bits", type=int, default=2048, help="size of the generated RSA keys")
+    parser.add_argument("--attachment-size", type=int, default=256 * 1024, help="bytes per binary attachment")
+    parser.add_argument("--no-signature-cache", action="store_true", help="sign every response")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="buddy_benchmark_")
+    try:
+        keyrings = create_keyrings(directory, args.key_bits)
+        corpus = create_corpus(keyrings.sender_gpg, args.attachment_size)
+        samples = sample_messages(corpus, args.messages, args.seed)
+        results = run(samples, keyrings, not args.no_signature_cache)
+    finally:
+        for home in ("buddy", "senders"):
+            gpgconf("{}/{}".format(directory, home), "--kill", "gpg-agent")
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print(report(results))
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+    return 1 if results["failed"] else 0
+
+
+if __name__ == '__main__':
+    exit(main())
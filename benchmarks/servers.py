@@ -0,0 +1,110 @@
+"""
+In-memory stand-ins for the POP3 and SMTP servers. They implement the calls buddy makes on poplib.POP3_SSL and
+smtplib.SMTP_SSL, so the fetching and sending code runs unchanged without any network.
+"""
+from contextlib import contextmanager
+import poplib
+from unittest.mock import patch
+
+
+class MemoryMailbox(object):
+
+    def __init__(self, messages=()):
+        """
+        :param messages: raw messages as bytes
+        """
+        self.messages = {}
+        self.next_uid = 1
+        # only one session at a time has access to the maildrop (RFC 1939)
+        self.locked = False
+        for message in messages:
+            self.add(message)
+
+    def add(self, message):
+        self.messages["uid{}".format(self.next_uid)] = message
+        self.next_uid += 1
+
+    def pop3(self, *args, **kwargs):
+        return MemoryPOP3(self)
+
+
+class MemoryPOP3(object):
+
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+        # message numbers are fixed for the session, deletions only happen on quit
+        self.uids = sorted(mailbox.messages, key=lambda uid: int(uid[3:]))
+        self.deleted = set()
+        self.locked = False
+
+    def user(self, username):
+        return b'+OK'
+
+    def pass_(self, password):
+        if self.mailbox.locked:
+            raise poplib.error_proto(b'-ERR [IN-USE] maildrop already locked')
+        self.mailbox.locked = self.locked = True
+        return b'+OK'
+
+    def list(self):
+        lines = ["{} {}".format(i + 1, len(self.mailbox.messages[uid])).encode() for i, uid in enumerate(self.uids)]
+        return b'+OK', lines, 0
+
+    def uidl(self):
+        return b'+OK', ["{} {}".format(i + 1, uid).encode() for i, uid in enumerate(self.uids)], 0
+
+    def retr(self, msg_num):
+        message = self.mailbox.messages[self.uids[msg_num - 1]]
+        return b'+OK', message.split(b'\n'), len(message)
+
+    def top(self, msg_num, lines):
+        header = self.mailbox.messages[self.uids[msg_num - 1]].split(b'\n\n', 1)[0]
+        return b'+OK', header.split(b'\n'), len(header)
+
+    def dele(self, msg_num):
+        self.deleted.add(self.uids[msg_num - 1])
+        return b'+OK'
+
+    def quit(self):
+        if self.locked:
+            for uid in self.deleted:
+                del self.mailbox.messages[uid]
+            self.mailbox.locked = self.locked = False
+        return b'+OK'
+
+
+class MemorySMTP(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def smtp(self, *args, **kwargs):
+        return MemorySMTPSession(self)
+
+
+class MemorySMTPSession(object):
+
+    def __init__(self, server):
+        self.server = server
+
+    def ehlo(self):
+        return 250, b'ok'
+
+    def login(self, username, password):
+        return 235, b'ok'
+
+    def sendmail(self, sender, recipient, message):
+        self.server.sent.append((recipient, message))
+        return {}
+
+    def quit(self):
+        return 221, b'bye'
+
+    def close(self):
+        pass
+
+
+@contextmanager
+def local_servers(mailbox, smtp):
+    with patch('poplib.POP3_SSL', mailbox.pop3), patch('smtplib.SMTP_SSL', smtp.smtp):
+        yield
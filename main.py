@@ -5,6 +5,7 @@ import logging
 import sys
 
 from pgpbuddy import buddy
+from pgpbuddy import service
 
 
 if __name__ == '__main__':
@@ -19,6 +20,11 @@ if __name__ == '__main__':
     with open("config.yaml", 'r') as config:
         config = yaml.load(config)
 
-    while True:
-        buddy.check_and_reply_to_messages(config)
-        time.sleep(60)
+    # keyring workspaces and key cache are set up once and shared by all polls
+    with buddy.init_resources(config) as resources:
+        if "imap-server" in config:
+            buddy.wait_and_reply_to_messages(config, resources)
+        elif config.get("asyncio", False):
+            service.run(config, resources)
+        else:
+            buddy.poll_and_reply_to_messages(config, resources)
@@ -0,0 +1,135 @@
+from collections import OrderedDict
+from enum import Enum
+import threading
+import time
+
+from pgpbuddy.keycache import normalize
+
+
+Admission = Enum('Admission', 'accept sender_limit domain_limit')
+
+# rates are in messages per minute, a burst is the number of messages accepted at once after a quiet period
+DEFAULT_SENDER_RATE = 2
+DEFAULT_SENDER_BURST = 20
+DEFAULT_DOMAIN_RATE = 60
+DEFAULT_DOMAIN_BURST = 200
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_TRACKED = 10000
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst, now):
+        """
+        :param rate: tokens added per second
+        :param burst: most tokens the bucket holds
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, now):
+        self.refill(now)
+        return self.tokens >= 1
+
+    def take(self):
+        self.tokens -= 1
+
+
+class AdmissionControl(object):
+    """
+    Decides which messages buddy spends gpg time on. Every sender and every sender domain has a token bucket, a
+    message whose sender or domain has run out of tokens is put off before any gpg process is started for it. The
+    small and the large messages that are admitted each have a budget of messages in flight and share one of bytes in
+    flight, a message that does not fit waits until earlier ones of its lane are done.
+    """
+
+    def __init__(self, max_in_flight, max_bytes=DEFAULT_MAX_BYTES, sender_rate=DEFAULT_SENDER_RATE,
+                 sender_burst=DEFAULT_SENDER_BURST, domain_rate=DEFAULT_DOMAIN_RATE,
+                 domain_burst=DEFAULT_DOMAIN_BURST, max_tracked=DEFAULT_MAX_TRACKED, max_large_in_flight=None):
+        """
+        :param max_in_flight: number of small messages that are handled or waiting for a worker at the same time
+        :param max_bytes: total size of the messages of both lanes, a larger message is handled when nothing else of
+        its lane is in flight
+        :param sender_rate: messages per minute per sender, None for no limit
+        :param domain_rate: messages per minute per sender domain, None for no limit
+        :param max_tracked: number of senders and domains whose buckets are kept, the least recently seen are
+        forgotten first
+        :param max_large_in_flight: number of large messages in flight, max_in_flight if None
+        """
+        self.max_in_flight = max_in_flight
+        self.max_large_in_flight = max_in_flight if max_large_in_flight is None else max_large_in_flight
+        self.max_bytes = max_bytes
+        self.sender_rate = sender_rate
+        self.sender_burst = sender_burst
+        self.domain_rate = domain_rate
+        self.domain_burst = domain_burst
+        self.max_tracked = max_tracked
+
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+        self.capacity = threading.Condition()
+        # messages in flight per lane, keyed by whether they are large
+        self.lanes = {False: 0, True: 0}
+        self.bytes_in_flight = 0
+
+    @property
+    def in_flight(self):
+        return sum(self.lanes.values())
+
+    def admit(self, sender):
+        """
+        Take a token from the buckets of the sender and of its domain, if both have one.
+        :return: Admission
+        """
+        sender = normalize(sender)
+        domain = sender.rpartition("@")[2]
+        now = time.time()
+        with self.lock:
+            sender_bucket = self._bucket(("sender", sender), self.sender_rate, self.sender_burst, now)
+            domain_bucket = self._bucket(("domain", domain), self.domain_rate, self.domain_burst, now)
+            if sender_bucket is not None and not sender_bucket.available(now):
+                return Admission.sender_limit
+            if domain_bucket is not None and not domain_bucket.available(now):
+                return Admission.domain_limit
+            for bucket in (sender_bucket, domain_bucket):
+                if bucket is not None:
+                    bucket.take()
+            return Admission.accept
+
+    def acquire(self, size, large=False):
+        """
+        Wait until the message fits into the budget of its lane and of the bytes in flight.
+        :param large: the message is handled by the workers of the large messages
+        """
+        limit = self.max_large_in_flight if large else self.max_in_flight
+        with self.capacity:
+            # the large messages can hold all bytes in flight, the small ones still get through one at a time
+            self.capacity.wait_for(lambda: self.lanes[large] < limit and
+                                   (self.lanes[large] == 0 or self.bytes_in_flight + size <= self.max_bytes))
+            self.lanes[large] += 1
+            self.bytes_in_flight += size
+
+    def release(self, size, large=False):
+        with self.capacity:
+            self.lanes[large] -= 1
+            self.bytes_in_flight -= size
+            self.capacity.notify_all()
+
+    def _bucket(self, key, rate, burst, now):
+        if rate is None:
+            return None
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(rate / 60.0, burst, now)
+        self.buckets.move_to_end(key)
+        # a forgotten bucket starts out full again, the least recently seen senders are the least likely to be over
+        # their limit
+        while len(self.buckets) > self.max_tracked:
+            self.buckets.popitem(last=False)
+        return bucket
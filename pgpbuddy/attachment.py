@@ -0,0 +1,125 @@
+from collections import namedtuple
+import binascii
+import codecs
+import logging
+import os
+import quopri
+import tempfile
+
+
+log = logging.getLogger(__name__)
+
+# attachments that decode to more than memory_limit bytes are kept in temporary files,
+# attachments larger than max_size are dropped without being decoded
+DEFAULT_MEMORY_LIMIT = 1024 * 1024
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+Limits = namedtuple('Limits', 'memory_limit max_size directory')
+DEFAULT_LIMITS = Limits(DEFAULT_MEMORY_LIMIT, DEFAULT_MAX_SIZE, None)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class SpilledAttachment(object):
+    """
+    Decoded attachment that is too large to keep in memory. It lives in an anonymous temporary file that disappears
+    when the attachment is closed or garbage collected.
+    """
+
+    def __init__(self, file, content_type=None, directory=None):
+        """
+        :param directory: where further temporary files for this attachment, e.g. its plaintext, are created
+        """
+        self.file = file
+        self.content_type = content_type
+        self.directory = directory
+
+    @property
+    def size(self):
+        return os.fstat(self.file.fileno()).st_size
+
+    def open(self):
+        # gpg reads the file from the start, callers share the one file object
+        self.file.seek(0)
+        return self.file
+
+    def head(self, size=1024):
+        return self.open().read(size)
+
+    def read(self):
+        return self.open().read()
+
+    def close(self):
+        self.file.close()
+
+    def __repr__(self):
+        return "SpilledAttachment({}, {} bytes)".format(self.content_type, self.size)
+
+
+def decoded_size(part):
+    """
+    Estimate the decoded size of a part from its encoded payload, without decoding it.
+    """
+    payload = part.get_payload()
+    if part["Content-Transfer-Encoding"] == "base64":
+        return len(payload) * 3 // 4
+    return len(payload)
+
+
+def spill(part, directory=None):
+    """
+    Decode a base64 or quoted-printable part chunk by chunk into a temporary file.
+    :return: SpilledAttachment
+    """
+    payload = part.get_payload()
+    encoding = part["Content-Transfer-Encoding"]
+    out = tempfile.TemporaryFile(dir=directory)
+
+    if encoding == "base64":
+        rest = b''
+        for start in range(0, len(payload), CHUNK_SIZE):
+            chunk = rest + b''.join(payload[start:start + CHUNK_SIZE].encode('ascii', 'ignore').split())
+            # base64 can only be decoded in groups of four characters
+            usable = len(chunk) - len(chunk) % 4
+            out.write(binascii.a2b_base64(chunk[:usable]))
+            rest = chunk[usable:]
+        if rest:
+            out.write(binascii.a2b_base64(rest + b'=' * (-len(rest) % 4)))
+    elif encoding == "quoted-printable":
+        charset = payload_charset(part)
+        rest = b''
+        for start in range(0, len(payload), CHUNK_SIZE):
+            # decode whole lines only, soft line breaks and escapes never span two lines. a line ending in \r may
+            # still continue with \n
+            lines = (rest + payload[start:start + CHUNK_SIZE].encode(charset, 'surrogateescape')).splitlines(True)
+            rest = lines.pop() if not lines[-1].endswith(b'\n') else b''
+            out.write(quopri.decodestring(b''.join(lines)))
+        out.write(quopri.decodestring(rest))
+    else:
+        out.write(payload.encode('utf-8', 'surrogateescape'))
+
+    out.flush()
+    return SpilledAttachment(out, part.get_content_type(), directory)
+
+
+def payload_charset(part):
+    # get_payload decodes 8bit data of the part with its charset, encoding the payload with it gives the data back.
+    # what an ascii part can not decode is already replaced, it is kept as utf-8
+    try:
+        charset = codecs.lookup(part.get_content_charset() or 'ascii').name
+    except LookupError:
+        charset = 'ascii'
+    return 'utf-8' if charset == 'ascii' else charset
+
+
+def spill_target(directory=None):
+    """
+    Create a temporary file that another program, e.g. gpg, can write to by path.
+    :return: (path, file object opened for reading)
+    """
+    fd, filename = tempfile.mkstemp(dir=directory)
+    return filename, os.fdopen(fd, 'rb')
+
+
+def is_spilled(data):
+    return isinstance(data, SpilledAttachment)
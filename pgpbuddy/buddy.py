@@ -1,19 +1,52 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
 import logging
+import time
 
 import pgpbuddy.crypto as crypto
+import pgpbuddy.imap as imap
 import pgpbuddy.response as response
-from pgpbuddy.send import create_message, send_response
-from pgpbuddy.fetch import fetch_messages, parse_message
+from pgpbuddy.workspace import init_workspaces
+from pgpbuddy.keycache import init_keycache, DEFAULT_TTL, DEFAULT_NEGATIVE_TTL
+from pgpbuddy.prefetch import init_prefetcher, DEFAULT_WORKERS, DEFAULT_TIMEOUT
+from pgpbuddy.state import init_state, Status, DEFAULT_MAX_ATTEMPTS, DEFAULT_MAX_DEFERRALS
+from pgpbuddy.workqueue import init_workqueue, DEFAULT_LEASE, DEFAULT_BACKOFF
+from pgpbuddy.shard import init_coordinator, DEFAULT_NODE_TTL
+from pgpbuddy.attachment import Limits, DEFAULT_MEMORY_LIMIT, DEFAULT_MAX_SIZE
+from pgpbuddy.signcache import SignatureCache, DEFAULT_SIGNATURE_CACHE_SIZE
+from pgpbuddy.metrics import init_metrics, increment, timed, DEFAULT_STATS_INTERVAL
+from pgpbuddy.trace import init_tracer, traced
+from pgpbuddy.resultcache import ResultCache, Result, message_digest, DEFAULT_RESULT_CACHE_SIZE, \
+    DEFAULT_RESULT_TTL, DEFAULT_DUPLICATE_INTERVAL
+from pgpbuddy.send import create_message, message_content, send_responses
+from pgpbuddy.admission import AdmissionControl, Admission, DEFAULT_MAX_BYTES, DEFAULT_SENDER_RATE, \
+    DEFAULT_SENDER_BURST, DEFAULT_DOMAIN_RATE, DEFAULT_DOMAIN_BURST
+from pgpbuddy.fetch import iter_new_messages, enqueue_new_messages, iter_queued_messages, parse_message, message_size
 
 
 log = logging.getLogger(__name__)
 
+# everything that outlives a single poll of the mailbox
+Resources = namedtuple('Resources', 'workspaces keycache state workqueue coordinator signatures results admission')
 
-def handle_message(gpg, message):
+# seconds between two polls of the mailbox, when it is not watched with IMAP IDLE
+POLL_INTERVAL = 60
+
+# messages larger than this are handled by large-workers workers of their own
+DEFAULT_LARGE_MESSAGE_SIZE = 1024 * 1024
+DEFAULT_LARGE_WORKERS = 1
+
+
+def handle_message(gpg, message, prefetcher):
     raw_message, header, body, attachments = message
 
     # try to import senders public key from keyserver
-    crypto.import_public_keys_from_server(gpg, header["From"])
+    if needs_sender_key(header, body):
+        keys = prefetcher.get(header["From"]).keys
+        if keys:
+            with timed("key_import"):
+                gpg.import_keys(keys)
 
     # the original message was an S/MIME message (encrypted)
     if header["Content-Type"] == "multipart/encrypted":
@@ -34,15 +67,23 @@ def handle_message(gpg, message):
     return header, encryption_status, signature_status, reason
 
 
+def needs_sender_key(header, body):
+    # plain text mail gets the welcome response (A) which is neither verified nor encrypted
+    if header["Content-Type"] in ("multipart/encrypted", "multipart/signed"):
+        return True
+    return crypto.contains_pgp_data(body)
+
+
 def handle_multipart_encrypted(gpg, body):
-    encryption_status, signature_status, reason = crypto.check_encryption_and_signature(gpg, body)
+    # decrypt once, the plaintext is needed for the classification and for parsing
+    decrypted = crypto.decrypt(gpg, body)
+    encryption_status, signature_status, reason = crypto.classify_decryption(decrypted)
 
     if encryption_status != crypto.Encryption.correct:
         return encryption_status, signature_status, reason
 
     # parse the decrypted data into body and attachments
-    result = gpg.decrypt(body)
-    _, _, body, attachments = parse_message(result.data)
+    _, _, body, attachments = parse_message(decrypted.data)
 
     # attachments might contain public key
     attachments = [crypto.decrypt_attachment(gpg, attachment) for attachment in attachments]
@@ -52,16 +93,13 @@ def handle_multipart_encrypted(gpg, body):
 
 
 def handle_multipart_signed(gpg, body, attachments):
-    # there should be only one "attachment" which contains the signature
-    signature = attachments[0]
+    # the first "attachment" is the signature, the attachments of the signed part follow it
+    signature, attachments = attachments[0], attachments[1:]
     signature_status, reason = crypto.verify_external_sig(gpg, body, signature.encode())
 
     if signature_status != crypto.Signature.correct:
         return crypto.Encryption.missing, signature_status, reason
 
-    # the multipart/signed contains another multipart body, split that one into actual body and attachments
-    _, _, body, attachments = parse_message(body)
-
     # attachments might contain public key
     attachments = [crypto.decrypt_attachment(gpg, attachment) for attachment in attachments]
     crypto.import_public_keys_from_attachments(gpg, attachments)
@@ -78,34 +116,289 @@ def handle_inline_pgp(gpg, body, attachments):
     return encryption_status, signature_status, reason
 
 
-def make_response(gpg, header, encryption_status, signature_status, reason):
+def make_response(gpg, header, encryption_status, signature_status, reason, index=None, signatures=None):
+    """
+    :return: the response and the case of the bot logic it answers
+    """
     target = header["From"]
 
     # need senders public key to encrypt response
-    key_status = crypto.check_public_key_available(gpg, header["From"])
-
-    response_subject = response.subject[(encryption_status.value, signature_status.value)]
-    response_subject = "{} (Was: {})".format(response_subject, header["Subject"])
+    key_status = crypto.check_public_key_available(gpg, header["From"], index)
 
-    response_text = response.content[(encryption_status.value, signature_status.value)]
-    # Append reason if exists
-    if reason != '':
-        response_text = '{} because {}'.format(response_text, reason)
+    response_subject, response_text = response.render(encryption_status, signature_status, header["Subject"], reason)
 
     response_encryption = crypto.select_response_encryption(key_status, encryption_status, signature_status)
-    response_text = crypto.encrypt_response(gpg, response_encryption, response_text, target)
+    with timed("sign_encrypt"):
+        response_text = crypto.encrypt_response(gpg, response_encryption, response_text, target, signatures)
+    case = response.case(encryption_status, signature_status, key_status)
+    increment("responses_total", case=case, cached="false")
 
     response_full = create_message(target, response_subject, response_text)
-    return response_full
-
-
-def check_and_reply_to_messages(config):
-    messages = fetch_messages(config["pop3-server"], config["username"], config["password"])
-    for message in messages:
-        with crypto.init_gpg(config["gnupghome"]) as gpg:
-            header, encryption_status, signature_status, reason = handle_message(gpg, message)
-            response_full = make_response(gpg, header, encryption_status, signature_status, reason)
-
-        print(response_full["Subject"])
-        send_response(config["smtp-server"], config["smtp-port"], config["username"],
-                      config["password"], response_full)
\ No newline at end of file
+    return response_full, case
+
+
+@contextmanager
+def init_resources(config):
+    check_node_ttl(config)
+    with ExitStack() as stack:
+        stack.enter_context(init_metrics(config.get("metrics-port"),
+                                         config.get("stats-interval", DEFAULT_STATS_INTERVAL)))
+        if "gpg-trace" in config:
+            stack.enter_context(init_tracer(config["gpg-trace"]))
+        workspaces = stack.enter_context(init_workspaces(config["gnupghome"], config.get("workers", 1),
+                                                         config.get("gpg-agent", False),
+                                                         config.get("large-workers", DEFAULT_LARGE_WORKERS)))
+        keycache = stack.enter_context(init_keycache(config.get("keycache", ":memory:"),
+                                                     crypto.fetch_public_keys_from_server,
+                                                     config.get("keycache-ttl", DEFAULT_TTL),
+                                                     config.get("keycache-negative-ttl", DEFAULT_NEGATIVE_TTL)))
+        state = stack.enter_context(init_state(config.get("state", ":memory:"),
+                                               config.get("max-attempts", DEFAULT_MAX_ATTEMPTS),
+                                               config.get("max-deferrals", DEFAULT_MAX_DEFERRALS)))
+        workqueue = None
+        if "workqueue" in config:
+            workqueue = stack.enter_context(init_workqueue(config["workqueue"], config.get("lease", DEFAULT_LEASE),
+                                                           config.get("max-attempts", DEFAULT_MAX_ATTEMPTS),
+                                                           config.get("retry-backoff", DEFAULT_BACKOFF)))
+        coordinator = None
+        if "shard-store" in config:
+            coordinator = stack.enter_context(init_coordinator(config["shard-store"], config.get("node"),
+                                                               config.get("node-ttl", DEFAULT_NODE_TTL),
+                                                               config.get("lease", DEFAULT_LEASE)))
+        signatures = SignatureCache(config.get("signature-cache-size", DEFAULT_SIGNATURE_CACHE_SIZE))
+        results = ResultCache(config.get("result-cache-size", DEFAULT_RESULT_CACHE_SIZE),
+                              config.get("result-cache-ttl", DEFAULT_RESULT_TTL),
+                              config.get("duplicate-interval", DEFAULT_DUPLICATE_INTERVAL))
+        yield Resources(workspaces, keycache, state, workqueue, coordinator, signatures, results,
+                        admission_control(config, workspaces.size, workspaces.large_size))
+
+
+def check_node_ttl(config):
+    # a node sends its heartbeat once per poll, in between the other nodes must not count it as gone
+    if "shard-store" not in config:
+        return
+    wait = imap.IDLE_TIMEOUT if "imap-server" in config else config.get("poll-interval", POLL_INTERVAL)
+    node_ttl = config.get("node-ttl", DEFAULT_NODE_TTL)
+    if node_ttl <= wait:
+        raise ValueError("node-ttl ({} seconds) has to be longer than the {} seconds between two polls of the mailbox"
+                         .format(node_ttl, wait))
+
+
+def process_message(resources, prefetcher, uid, message, large=False):
+    """
+    :param large: handle the message with a workspace of the large messages
+    :return: the response, None if there is nothing to send
+    """
+    try:
+        digest = None
+        if resources.results is not None:
+            digest = result_digest(message, prefetcher)
+            if not resources.results.admit(digest, uid):
+                # a copy of this message was answered a moment ago, e.g. a mail loop, it is dropped without a reply
+                log.info("Not replying to duplicate message {}".format(uid))
+                increment("duplicates_dropped_total")
+                mark_replied(resources, uid)
+                return None
+
+            result = resources.results.get(digest)
+            if result is not None:
+                increment("duplicates_total")
+                increment("responses_total", case=result.case, cached="true")
+                resources.state.mark(uid, Status.processed)
+                return create_message(message[1]["From"], result.subject, result.text)
+
+        # every message sees buddy's keyring only, keys it imports are rolled back afterwards
+        with resources.workspaces.acquire(large) as workspace, workspace.message() as gpg, trace_fields(uid, message):
+            header, encryption_status, signature_status, reason = handle_message(gpg, message, prefetcher)
+            response_full, case = make_response(gpg, header, encryption_status, signature_status, reason,
+                                                workspace.index, resources.signatures)
+        if digest is not None:
+            resources.results.put(digest, Result(encryption_status, signature_status, reason, case,
+                                                 *message_content(response_full)))
+        resources.state.mark(uid, Status.processed)
+        return response_full
+    except Exception:
+        raw_message, _, _, _ = message
+        log.exception("Could not handle message: {}".format(raw_message))
+        increment("handling_errors_total")
+        if resources.workqueue is not None:
+            # the next attempt need not wait for the lease to run out, but is not made by the same poll either
+            resources.workqueue.release(uid)
+        return None
+
+
+def result_digest(message, prefetcher):
+    _, header, body, attachments = message
+    # the sender's keys decide the outcome as much as the message itself, but only if buddy looks at them
+    fingerprints = prefetcher.get(header["From"]).fingerprints if needs_sender_key(header, body) else ()
+    return message_digest(header, body, attachments, fingerprints)
+
+
+def trace_fields(uid, message):
+    # the gpg processes of a message are traced with what identifies the message and its shape
+    raw_message, header, _, attachments = message
+    return traced(uid=uid, sender=header["From"], content_type=header["Content-Type"],
+                  message_bytes=message_size(raw_message), attachments=len(attachments))
+
+
+def check_and_reply_to_messages(config, resources=None):
+    if resources is None:
+        with init_resources(config) as resources:
+            return check_and_reply_to_messages(config, resources)
+
+    return reply_to_messages(config, resources, new_messages(config, resources))
+
+
+def poll_and_reply_to_messages(config, resources, polls=None):
+    """
+    Answer the messages in the mailbox every poll-interval seconds.
+    :param polls: number of polls of the mailbox before returning, None to run forever
+    """
+    poll = 0
+    while polls is None or poll < polls:
+        try:
+            check_and_reply_to_messages(config, resources)
+        except Exception:
+            # e.g. another node holds the lock on the maildrop, the next poll tries again
+            log.exception("Polling the mailbox failed")
+
+        poll += 1
+        if polls is None or poll < polls:
+            time.sleep(config.get("poll-interval", POLL_INTERVAL))
+
+
+def new_messages(config, resources):
+    """
+    :return: iterable of (uid, (raw message, headers, body, attachments)) that still need an answer
+    """
+    if resources.workqueue is None:
+        return iter_new_messages(config["pop3-server"], config["username"], config["password"],
+                                 resources.state, config.get("batch-limit"), resources.coordinator,
+                                 attachment_limits(config))
+
+    # the queue also holds messages left over from an earlier run, those are answered without fetching them again
+    enqueue_new_messages(config["pop3-server"], config["username"], config["password"],
+                         resources.state, resources.workqueue, config.get("batch-limit"), resources.coordinator)
+    return iter_queued_messages(resources.workqueue, resources.state, config.get("batch-limit"),
+                                attachment_limits(config))
+
+
+def admission_control(config, workers, large_workers=0):
+    # by default as many messages wait for a worker as are being handled, in each lane
+    return AdmissionControl(config.get("max-in-flight", 2 * workers),
+                            config.get("max-in-flight-bytes", DEFAULT_MAX_BYTES),
+                            config.get("sender-rate", DEFAULT_SENDER_RATE),
+                            config.get("sender-burst", DEFAULT_SENDER_BURST),
+                            config.get("domain-rate", DEFAULT_DOMAIN_RATE),
+                            config.get("domain-burst", DEFAULT_DOMAIN_BURST),
+                            max_large_in_flight=config.get("max-large-in-flight", 2 * max(large_workers, 1)))
+
+
+def admit(resources, uid, message):
+    """
+    :return: True if the message is handled now. a message over its sender's or domain's limit stays on the server
+    for a later poll, one that is still over its sender's limit after max-deferrals polls is deleted without a reply
+    """
+    _, header, _, _ = message
+    admission = resources.admission.admit(header["From"])
+    if admission == Admission.accept:
+        return True
+
+    # the domain's other senders are not flooding, their mail is answered once the domain is below its limit
+    if admission == Admission.domain_limit or resources.state.should_defer(uid):
+        log.info("Deferring message {} from {}, {}".format(uid, header["From"], admission.name.replace("_", " ")))
+        increment("messages_deferred_total", reason=admission.name)
+        defer(resources, uid)
+        return False
+
+    log.info("Dropping message {} from {}, {}".format(uid, header["From"], admission.name.replace("_", " ")))
+    increment("messages_dropped_total", reason=admission.name)
+    mark_replied(resources, uid)
+    return False
+
+
+def is_large(config, size):
+    return size > config.get("large-message-size", DEFAULT_LARGE_MESSAGE_SIZE)
+
+
+def attachment_limits(config):
+    return Limits(config.get("attachment-memory-limit", DEFAULT_MEMORY_LIMIT),
+                  config.get("attachment-max-size", DEFAULT_MAX_SIZE), config.get("attachment-dir"))
+
+
+def mark_replied(resources, uid):
+    # only now the original can be deleted
+    resources.state.mark(uid, Status.replied)
+    if resources.workqueue is not None:
+        resources.workqueue.complete(uid)
+    if resources.coordinator is not None:
+        resources.coordinator.mark_replied(uid)
+
+
+def defer(resources, uid):
+    # putting a message off is no attempt to answer it, it is not given up on because of it
+    resources.state.defer(uid)
+    if resources.workqueue is not None:
+        resources.workqueue.defer(uid)
+
+
+def wait_and_reply_to_messages(config, resources):
+    """
+    Answer messages the moment they arrive in the IMAP mailbox, instead of polling.
+    """
+    imap.serve(config["imap-server"], config["username"], config["password"], resources.state,
+               lambda messages: reply_to_messages(config, resources, messages), config.get("batch-limit"),
+               coordinator=resources.coordinator, limits=attachment_limits(config))
+
+
+def reply_to_messages(config, resources, messages):
+    """
+    :param messages: iterable of (uid, (raw message, headers, body, attachments))
+    :return: list of replies that were sent and list of (reply, error) for the ones that could not be sent
+    """
+    workers = resources.workspaces.size
+
+    futures = []
+    with init_prefetcher(crypto.fetch_public_keys_from_server, resources.keycache,
+                         config.get("keyserver-workers", DEFAULT_WORKERS),
+                         config.get("keyserver-timeout", DEFAULT_TIMEOUT)) as prefetcher, \
+            ThreadPoolExecutor(max_workers=workers) as executor, \
+            ThreadPoolExecutor(max_workers=max(resources.workspaces.large_size, 1)) as large_executor:
+        for uid, message in messages:
+            raw_message, header, _, _ = message
+            if not admit(resources, uid, message):
+                continue
+
+            # start the keyserver lookup right away, handling only waits for it when it needs the sender's key
+            prefetcher.prefetch([header["From"]])
+
+            # large messages queue for workers and workspaces of their own, the small ones behind them do not wait for
+            # them
+            size = message_size(raw_message)
+            large = is_large(config, size)
+            lane = large_executor if large else executor
+
+            # retrieving stalls while the admitted messages of the lane are waiting for a worker, so that they are not
+            # all held in memory. gpg and network calls block on subprocesses and sockets, so threads are enough to
+            # handle messages in parallel
+            resources.admission.acquire(size, large)
+            future = lane.submit(process_message, resources, prefetcher, uid, message, large)
+            future.add_done_callback(lambda _, size=size, large=large: resources.admission.release(size, large))
+            futures.append((uid, future))
+
+    responses = []
+    uids = {}
+    for uid, future in futures:
+        response_full = future.result()
+        if response_full is not None:
+            log.info("Replying to {}: {}".format(response_full["To"], response_full["Subject"]))
+            responses.append(response_full)
+            uids[id(response_full)] = uid
+
+    # send all replies over one smtp session
+    sent, failed = send_responses(config["smtp-server"], config["smtp-port"], config["username"],
+                                  config["password"], responses)
+
+    for response_full in sent:
+        mark_replied(resources, uids[id(response_full)])
+    return sent, failed
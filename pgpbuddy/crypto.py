@@ -1,11 +1,16 @@
+from collections import namedtuple
 from contextlib import contextmanager
 import shutil
 import logging
+import os
+import re
 import tempfile
-from os import path
 from enum import Enum
 
-import gnupg
+from pgpbuddy.attachment import SpilledAttachment, is_spilled, spill_target
+from pgpbuddy.keycache import SenderKeys, NO_KEYS
+from pgpbuddy.metrics import timed
+from pgpbuddy.trace import TracedGPG, traced
 
 
 log = logging.getLogger(__name__)
@@ -14,39 +19,97 @@ PublicKey = Enum('PublicKey', 'available not_available')
 Signature = Enum('Signature', 'correct incorrect missing')
 Encryption = Enum('Encryption', 'correct incorrect missing')
 ResponseEncryption = Enum('ResponseEncryption', 'plain sign encrypt_and_sign encrypt_fails_but_sign')
+PgpData = Enum('PgpData', 'armored packets none')
+
+KEYSERVER = "pgp.mit.edu"
+
+KeyImport = namedtuple('KeyImport', 'fingerprint ok reason')
+
+PUBLIC_KEY_BLOCK = re.compile(r'-----BEGIN PGP PUBLIC KEY BLOCK-----.*?-----END PGP PUBLIC KEY BLOCK-----', re.DOTALL)
 
 
 def import_public_keys_from_attachments(gpg, attachments):
-    def try_import(data):
-        # it is a binary attachment, can not contain the PUBLIC KEY block
-        if isinstance(data, bytes):
-            return False
-
-        # check if the usual markers for PUBLIC KEY block are there
-        data = data.strip().split("\n")
-        if data[0] != "-----BEGIN PGP PUBLIC KEY BLOCK-----" or data[-1] != "-----END PGP PUBLIC KEY BLOCK-----":
-            return False
-
-        # looks like a PUBLIC KEY block, try to import it into keyring and report on results
-        result = gpg.import_keys(data)
-        if result.results[0]['ok'] == '1':
-            return True
-        else:
-            return False
+    """
+    Import every ascii armored public key block found in the attachments with a single gpg call.
+    :param attachments: list of (data, encryption status) as returned by decrypt_attachment
+    :return: list of KeyImport, one for every key gpg reported on
+    """
+    blocks = [block for data, _ in attachments for block in find_public_key_blocks(data)]
+    return import_public_key_blocks(gpg, blocks)
+
+
+def find_public_key_blocks(data):
+    # a large attachment is only read if it starts like ascii armor
+    if is_spilled(data):
+        if classify_attachment(data) != PgpData.armored:
+            return []
+        data = data.read()
+
+    if isinstance(data, bytes):
+        data = data.decode('ascii', 'replace')
+    return PUBLIC_KEY_BLOCK.findall(data)
+
+
+def import_public_key_blocks(gpg, blocks):
+    if not blocks:
+        return []
 
-    imported = [i for i, (attach, _) in enumerate(attachments) if try_import(attach)]
-    remaining_attachments = [attach for i, attach in enumerate(attachments) if i not in imported]
-    return remaining_attachments
+    with timed("key_import"):
+        imports = import_results(gpg.import_keys("\n".join(blocks)))
 
+        # gpg gives up on all of its input at the first broken block, import them one by one to save the others
+        if len(blocks) > 1 and len([key for key in imports if key.ok]) < len(blocks):
+            imports = [key for block in blocks for key in import_results(gpg.import_keys(block))]
 
-def import_public_keys_from_server(gpg, sender):
-    keys = gpg.search_keys(sender, "pgp.mit.edu")
+    for key in imports:
+        if not key.ok:
+            log.info("Importing public key {} failed: {}".format(key.fingerprint, key.reason))
+    return imports
+
+
+def import_results(result):
+    return [KeyImport(entry.get('fingerprint'), 'ok' in entry, entry.get('text', '').strip().replace("\n", ", "))
+            for entry in result.results]
+
+
+@timed("keyserver")
+def receive_public_keys(gpg, sender):
+    fingerprints = []
+    keys = gpg.search_keys(sender, KEYSERVER)
     for key in keys:
-        gpg.recv_keys("pgp.mit.edu", key["keyid"])
+        result = gpg.recv_keys(KEYSERVER, key["keyid"])
+        if result is not None:
+            fingerprints.extend(result.fingerprints)
+    return fingerprints
+
+
+def fetch_public_keys_from_server(sender):
+    """
+    Look up the sender's keys in a scratch keyring, independent of any message that is being handled.
+    :return: SenderKeys, NO_KEYS if the keyserver does not know the sender
+    """
+    with empty_pgp_dir() as gnupghome, traced(sender=sender):
+        gpg = TracedGPG(gnupghome=gnupghome)
+        gpg.encoding = 'utf-8'
+        return sender_keys_of(gpg, receive_public_keys(gpg, sender))
+
+
+def sender_keys_of(gpg, fingerprints):
+    if not fingerprints:
+        return NO_KEYS
+    return SenderKeys(gpg.export_keys(fingerprints), tuple(sorted(set(fingerprints))))
 
 
 def decrypt_attachment(gpg, data):
-    result = gpg.decrypt(data)
+    # most attachments are images and documents, there is no point in starting gpg for them
+    if classify_attachment(data) == PgpData.none:
+        return data, Encryption.missing
+
+    if is_spilled(data):
+        return decrypt_spilled_attachment(gpg, data)
+
+    with timed("decrypt"):
+        result = gpg.decrypt(data)
     if result.status == 'decryption ok':
         return result.data.decode('UTF-8', "replace"), Encryption.correct
     elif result.status == 'decryption failed':
@@ -59,7 +122,29 @@ def decrypt_attachment(gpg, data):
         return data, Encryption.missing
 
 
-def check_public_key_available(gpg, sender):
+@timed("decrypt")
+def decrypt_spilled_attachment(gpg, attachment):
+    # gpg reads the attachment from its file and writes the plaintext to another file, neither is held in memory
+    filename, plaintext = spill_target(attachment.directory)
+    try:
+        result = gpg.decrypt_file(attachment.open(), output=filename)
+    finally:
+        # the open file object keeps the plaintext around until it is closed
+        os.unlink(filename)
+
+    if result.status == 'decryption ok':
+        return SpilledAttachment(plaintext, directory=attachment.directory), Encryption.correct
+    plaintext.close()
+    if result.status == 'decryption failed':
+        return attachment, Encryption.incorrect
+    return attachment, Encryption.missing
+
+
+@timed("key_check")
+def check_public_key_available(gpg, sender, index=None):
+    if index is not None:
+        return PublicKey.available if index.lookup(sender) else PublicKey.not_available
+
     result = gpg.encrypt("blabla", recipients=sender, always_trust=True)
     if result.ok:
         return PublicKey.available
@@ -67,9 +152,79 @@ def check_public_key_available(gpg, sender):
         return PublicKey.not_available
 
 
+# for each packet tag gpg might have to look at, the values the first byte of the packet body can take
+PACKET_FIRST_BYTES = {
+    1: (3, 6),              # public-key encrypted session key, version
+    2: (3, 4, 5, 6),        # signature, version
+    3: (4, 5, 6),           # symmetric-key encrypted session key, version
+    4: (3, 6),              # one-pass signature, version
+    5: (3, 4, 5, 6),        # secret key, version
+    6: (3, 4, 5, 6),        # public key, version
+    8: (0, 1, 2, 3),        # compressed data, algorithm
+    9: None,                # symmetrically encrypted data, no header
+    11: tuple(b'btu1lm'),   # literal data, format
+    18: (1, 2),             # symmetrically encrypted integrity protected data, version
+    20: (1,),               # AEAD encrypted data, version
+}
+
+CLASSIFY_HEAD_SIZE = 1024
+
+
+def classify_attachment(data):
+    """
+    Tell from the first bytes of an attachment whether it can contain OpenPGP data at all.
+    :return: PgpData.armored for ascii armor, PgpData.packets for something that starts like a binary OpenPGP packet,
+    PgpData.none otherwise
+    """
+    if is_spilled(data):
+        head = data.head(CLASSIFY_HEAD_SIZE)
+        if contains_pgp_data(head):
+            return PgpData.armored
+        data = head
+    elif contains_pgp_data(data):
+        return PgpData.armored
+
+    if isinstance(data, str) or not is_pgp_packet(data):
+        return PgpData.none
+    return PgpData.packets
+
+
+def is_pgp_packet(data):
+    """
+    Check the header of the first packet (RFC 4880 section 4.2), many file formats start with a byte that looks
+    like a packet tag but not with a valid packet.
+    """
+    if len(data) < 2 or not data[0] & 0x80:
+        return False
+
+    if data[0] & 0x40:
+        # new format: tag in the low six bits, length in one, two or five octets
+        tag = data[0] & 0x3f
+        if data[1] < 192 or 224 <= data[1] < 255:
+            body = 2
+        elif data[1] < 224:
+            body = 3
+        else:
+            body = 6
+    else:
+        # old format: tag in bits 2 to 5, the low two bits select a length of one, two, four or no octets
+        tag = (data[0] >> 2) & 0x0f
+        body = 1 + (1, 2, 4, 0)[data[0] & 0x03]
+
+    if tag not in PACKET_FIRST_BYTES:
+        return False
+    first_bytes = PACKET_FIRST_BYTES[tag]
+    return first_bytes is None or (len(data) > body and data[body] in first_bytes)
+
+
+def contains_pgp_data(data):
+    marker = b'-----BEGIN PGP ' if isinstance(data, bytes) else '-----BEGIN PGP '
+    return marker in data
+
+
 def contains_signature(attachment):
     # it is a binary attachment, can not contain the PUBLIC KEY block
-    if isinstance(attachment, bytes):
+    if isinstance(attachment, bytes) or is_spilled(attachment):
         return False
 
     attachment = attachment.strip().split("\n")
@@ -78,26 +233,74 @@ def contains_signature(attachment):
     return False
 
 
+class DecryptResult(object):
+    """
+    Outcome of decrypting data once. The classification, the re-parsing of the plaintext and the check of an inline
+    signature inside the plaintext all share this single gpg.decrypt call.
+    """
+
+    def __init__(self, gpg, data):
+        self.gpg = gpg
+        with timed("decrypt"):
+            self.result = gpg.decrypt(data)
+        self._text = None
+        self._signature = None
+
+    @property
+    def status(self):
+        return self.result.status
+
+    @property
+    def trust_text(self):
+        return self.result.trust_text
+
+    @property
+    def data(self):
+        return self.result.data
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.result.data.decode('utf-8')
+        return self._text
+
+    def verify_signature(self):
+        if self._signature is None:
+            with timed("verify"):
+                self._signature = self.gpg.verify(self.result.data)
+        return self._signature
+
+
+def decrypt(gpg, data):
+    return DecryptResult(gpg, data)
+
+
 def check_encryption_and_signature(gpg, data):
     """
     :param gpg:
     :param data:
     :return:
     """
+    return classify_decryption(decrypt(gpg, data))
+
 
-    result = gpg.decrypt(data)
+def classify_decryption(result):
+    """
+    :param result: DecryptResult of the data to check
+    :return: encryption status, signature status and reason
+    """
 
     # plain text message
     if result.status == 'no data was provided' and result.trust_text is None:
         return Encryption.missing, Signature.missing, ''
 
     # correct encrypted, signature missing
-    if result.status == 'decryption ok' and result.trust_text is None and '-----BEGIN PGP SIGNATURE-----' not in result.data.decode('utf-8'):
+    if result.status == 'decryption ok' and result.trust_text is None and '-----BEGIN PGP SIGNATURE-----' not in result.text:
         return Encryption.correct, Signature.missing, ''
 
     # correct encrypted, signature wrong
-    if result.status == 'decryption ok' and result.trust_text is None and '-----BEGIN PGP SIGNATURE-----' in result.data.decode('utf-8'):
-        sig_verify = gpg.verify(result.data)
+    if result.status == 'decryption ok' and result.trust_text is None and '-----BEGIN PGP SIGNATURE-----' in result.text:
+        sig_verify = result.verify_signature()
         return Encryption.correct, Signature.incorrect, ' the signature failed to verify because {}'.format(sig_verify.status)
 
     # correct encrypted, correct signature
@@ -120,6 +323,7 @@ def check_encryption_and_signature(gpg, data):
     return Encryption.incorrect, Signature.incorrect, 'FAILURE {}'.format(result.status)
 
 
+@timed("verify")
 def verify_external_sig(gpg, data, sig):
     with tempfile.NamedTemporaryFile() as tmp:
         tmp.write(sig)
@@ -160,37 +364,43 @@ def select_response_encryption(key_status, encryption_status, signature_status):
     return ResponseEncryption.sign
 
 
-def encrypt_response(gpg, encryption_type, text, recipient):
+def encrypt_response(gpg, encryption_type, text, recipient, signatures=None):
+    """
+    :param signatures: optional SignatureCache, responses that are only signed do not depend on the recipient and are
+    signed once
+    """
     if encryption_type == ResponseEncryption.sign:
-        return gpg.sign(text).data.decode("UTF-8")
+        return sign_text(gpg, text, signatures)
     elif encryption_type == ResponseEncryption.encrypt_and_sign:
-        return gpg.encrypt(text, recipients=recipient, always_trust=True, sign=True).data.decode("UTF-8")
+        result = gpg.encrypt(text, recipients=recipient, always_trust=True, sign=True)
+        if result.ok:
+            return result.data.decode("UTF-8")
+        # the key looked usable but gpg refused it, answer as if there was no key
+        return encrypt_response(gpg, ResponseEncryption.encrypt_fails_but_sign, text, recipient, signatures)
     elif encryption_type == ResponseEncryption.encrypt_fails_but_sign:
         text += '\n\nNote: We could not find your public key! Was it attached or put on a keyserver?\nWe need your public key to encrypt emails to you.'
-        return gpg.sign(text).data.decode("UTF-8")
+        return sign_text(gpg, text, signatures)
     else:
         return text
 
-@contextmanager
-def init_gpg(path_to_buddy_keyring):
-    with temp_pgp_dir(path_to_buddy_keyring) as gnupghome:
-        gpg = gnupg.GPG(gnupghome=gnupghome)
-        gpg.encoding = 'utf-8'
-        yield gpg
 
+def sign_text(gpg, text, signatures=None):
+    if signatures is None:
+        return gpg.sign(text).data.decode("UTF-8")
 
-@contextmanager
-def temp_pgp_dir(gpghome):
-
-    # create temporary directory
-    tmpdir = tempfile.mkdtemp(prefix="buddy_")
+    key = (getattr(gpg, 'signing_fingerprint', None), text)
+    signed = signatures.get(key)
+    if signed is None:
+        signed = gpg.sign(text).data.decode("UTF-8")
+        signatures.put(key, signed)
+    return signed
 
-    # copy keyring to the temporary directory
-    shutil.copyfile(path.join(gpghome, "pubring.gpg"), path.join(tmpdir, "pubring.gpg"))
-    shutil.copyfile(path.join(gpghome, "secring.gpg"), path.join(tmpdir, "secring.gpg"))
 
+@contextmanager
+def empty_pgp_dir():
+    tmpdir = tempfile.mkdtemp(prefix="buddy_")
     try:
         yield tmpdir
     finally:
-        # automatically delete the directory
-        shutil.rmtree(tmpdir)
\ No newline at end of file
+        shutil.rmtree(tmpdir)
+
@@ -1,11 +1,23 @@
+from collections.abc import Mapping
 from contextlib import contextmanager
+from email.errors import HeaderParseError
+from email.header import decode_header
+from email.parser import BytesParser, BytesHeaderParser
+from email.policy import compat32
 import base64
+import logging
 import quopri
 import re
 
-import pyzmail
 import poplib
 
+from pgpbuddy.attachment import DEFAULT_LIMITS, decoded_size, spill
+from pgpbuddy.metrics import timed
+from pgpbuddy.state import Status
+
+
+log = logging.getLogger(__name__)
+
 
 class ParsingError(Exception):
     def __init__(self, msg):
@@ -15,55 +27,216 @@ class ParsingError(Exception):
         return "Error parsing message, {}".format(self.msg)
 
 
-def fetch_messages(pop3_server, username, password):
+def iter_new_messages(pop3_server, username, password, state, limit=None, coordinator=None, limits=DEFAULT_LIMITS):
+    """
+    Retrieve only the messages that have not been answered yet. Messages stay on the server until state records
+    that they were answered, they are then deleted at the beginning of the next poll.
+    :param state: MailState that tracks the messages by UIDL
+    :param limit: maximum number of messages to retrieve, the rest is left for the next poll
+    :param coordinator: optional Coordinator, only the messages it assigns to this node are retrieved
+    :param limits: attachment Limits
+    :return: generator of (uid, (raw message, headers, body, attachments))
+    """
     with connect(pop3_server, username, password) as conn:
-        num_messages = len(conn.list()[1])
-        message_ids = list(range(num_messages))
-        messages = [retrieve_message(conn, msg_id) for msg_id in message_ids]
-        messages = [parse_message(raw_msg) for raw_msg in messages]
-        return messages
-
-
-def retrieve_message(conn, message_id):
-    # messages are counted starting at 1 
-    message = conn.retr(message_id+1)[1]
-
-    # once buddy has the message we can delete the original
-    conn.dele(message_id+1)
-
-    return message
+        for msg_num, uid in list_new_messages(conn, state, limit, coordinator=coordinator):
+            state.mark(uid, Status.seen)
+            with timed("retrieve"):
+                raw_message = conn.retr(msg_num)[1]
+            message = parse_or_skip(state, uid, raw_message, limits)
+            if message is not None:
+                yield uid, message
+
+
+def enqueue_new_messages(pop3_server, username, password, state, workqueue, limit=None, coordinator=None):
+    """
+    Retrieve the messages that have not been answered yet into the work queue. Messages that are already queued
+    are not retrieved again.
+    :return: number of messages that were queued
+    """
+    with connect(pop3_server, username, password) as conn:
+        new_messages = list_new_messages(conn, state, limit, skip=workqueue, coordinator=coordinator)
+        for msg_num, uid in new_messages:
+            state.mark(uid, Status.seen)
+            with timed("retrieve"):
+                raw_message = conn.retr(msg_num)[1]
+            workqueue.put(uid, raw_message)
+        return len(new_messages)
+
+
+def iter_queued_messages(workqueue, state, limit=None, limits=DEFAULT_LIMITS):
+    """
+    Lease messages from the work queue one at a time. A message that is not completed goes back into the queue once
+    its lease runs out.
+    :return: generator of (uid, (raw message, headers, body, attachments))
+    """
+    taken = 0
+    while limit is None or taken < limit:
+        job = workqueue.take()
+        if job is None:
+            return
+        taken += 1
+
+        message = parse_or_skip(state, job.uid, job.raw_message, limits)
+        if message is None:
+            workqueue.complete(job.uid)
+            continue
+        yield job.uid, message
+
+
+def list_new_messages(conn, state, limit=None, skip=(), coordinator=None):
+    uids = list_uids(conn)
+    state.prune(uids.values())
+
+    # replies to these went out in an earlier poll
+    replied = state.replied()
+    if coordinator is not None:
+        # the heartbeat goes out with every poll, also one that finds nothing to claim
+        coordinator.heartbeat()
+        # another node may have answered a message and stopped before deleting it
+        coordinator.prune(uids.values())
+        replied |= coordinator.replied()
+    for msg_num, uid in uids.items():
+        if uid in replied:
+            conn.dele(msg_num)
+
+    new_messages = []
+    for msg_num, uid in sorted(uids.items()):
+        if limit is not None and len(new_messages) >= limit:
+            break
+        if uid in replied or not state.should_retrieve(uid) or uid in skip:
+            continue
+        # only the headers are needed to decide which node answers the message, and only the first time it is listed
+        if coordinator is not None and \
+                not coordinator.claim(state.sender(uid, lambda: retrieve_sender(conn, msg_num)), uid):
+            continue
+        new_messages.append((msg_num, uid))
+
+    # retrieve the small messages of the batch first, a large one does not hold up the ones behind it
+    sizes = list_sizes(conn)
+    new_messages.sort(key=lambda new_message: sizes.get(new_message[0], 0))
+    return new_messages
+
+
+def retrieve_sender(conn, msg_num):
+    header = BytesHeaderParser().parsebytes(b'\r\n'.join(conn.top(msg_num, 0)[1]))
+    return header.get("From", "")
+
+
+def message_size(raw_message):
+    # poplib hands out a message as its lines without line endings
+    if isinstance(raw_message, list):
+        return sum(len(line) + 2 for line in raw_message)
+    return len(raw_message)
 
 
-def parse_message(raw_message):
+def parse_or_skip(state, uid, raw_message, limits=DEFAULT_LIMITS):
+    try:
+        return parse_message(raw_message, limits)
+    except ParsingError as e:
+        # there is nothing to answer, treat it as done so that it gets deleted
+        log.info("Skipping message: {}".format(e))
+        state.mark(uid, Status.replied)
+        return None
+
+
+def list_uids(conn):
+    # each line of the listing is "<message number> <uid>"
+    uids = {}
+    for line in conn.uidl()[1]:
+        msg_num, uid = line.decode().split()
+        uids[int(msg_num)] = uid
+    return uids
+
+
+def list_sizes(conn):
+    # each line of the listing is "<message number> <size in bytes>"
+    sizes = {}
+    for line in conn.list()[1]:
+        msg_num, size = line.decode().split()[:2]
+        sizes[int(msg_num)] = int(size)
+    return sizes
+
+
+@timed("parse")
+def parse_message(raw_message, limits=DEFAULT_LIMITS):
+    """
+    Parse a message in a single walk over its MIME tree. Headers are decoded when they are first accessed.
+    :param limits: attachment Limits, attachments above the memory limit are decoded into temporary files
+    :return: (raw message, headers, body, attachments). For multipart/signed the body holds the exact signed bytes
+    and the first attachment is the signature, the attachments of the signed part follow it
+    """
     if isinstance(raw_message, list):
         raw_message = b'\n'.join(raw_message)
-    message = pyzmail.parse.message_from_bytes(raw_message)
-
-    # extract and decode relevant parts of header
-    headers = {"Subject": pyzmail.parse.decode_mail_header(message["Subject"]),
-               "To": pyzmail.parse.decode_mail_header(message["To"]),
-               "From": pyzmail.parse.decode_mail_header(message["From"]),
-               "Content-Type": message.get_content_type()}
+    message = BytesParser(policy=compat32).parsebytes(raw_message)
+    headers = Headers(message)
 
     # extract and decode body and attachments
-    if message.get_content_type() == "multipart/encrypted":
+    if headers["Content-Type"] == "multipart/encrypted":
         body, attachments = parse_multipart_encrypted(message)
-    elif message.get_content_type() == "multipart/signed":
-        body, attachments = parse_multipart_signed(raw_message, message)
+    elif headers["Content-Type"] == "multipart/signed":
+        body, attachments = parse_multipart_signed(raw_message, message, limits)
     else:
-        body, attachments = parse_pgp_inline(message)
+        body, attachments = parse_pgp_inline(message, limits)
 
     return raw_message, headers, body, attachments
 
 
+class Headers(Mapping):
+    """
+    The headers buddy uses, each one is only decoded when it is accessed.
+    """
+
+    names = ("Subject", "To", "From", "Content-Type")
+
+    def __init__(self, message):
+        self.message = message
+        self.decoded = {}
+
+    def __getitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        if name not in self.decoded:
+            if name == "Content-Type":
+                self.decoded[name] = self.message.get_content_type()
+            else:
+                self.decoded[name] = decode_header_value(self.message[name])
+        return self.decoded[name]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+
+def decode_header_value(value):
+    if value is None:
+        return ""
+    try:
+        chunks = decode_header(value)
+    except HeaderParseError:
+        return value.encode('us-ascii', 'replace').decode('us-ascii')
+
+    decoded = []
+    for text, charset in chunks:
+        if isinstance(text, str):
+            text = text.encode('us-ascii', 'replace')
+        try:
+            decoded.append(text.decode(charset or 'us-ascii', 'replace'))
+        except LookupError:
+            decoded.append(text.decode('us-ascii', 'replace'))
+    return "".join(decoded)
+
+
 def parse_multipart_encrypted(message):
     # multipart/encrypted must contain exactly two parts: I) version and other metadata, II) message body
     # attachements are encrypted and part of the message body
-    if len(message.mailparts) != 2:
+    parts = leaf_parts(message)
+    if len(parts) != 2:
         raise ParsingError("Malformated S/MIME message")
 
     # body must always be application/octet-stream, there can only be one application/octet stream part
-    possible_bodies = [part for part in message.mailparts if "application/octet-stream" in part.type]
+    possible_bodies = [part for part in parts if part.get_content_type() == "application/octet-stream"]
     if len(possible_bodies) != 1:
         raise ParsingError("Malformated S/MIME message")
     body = possible_bodies[0]
@@ -71,45 +244,117 @@ def parse_multipart_encrypted(message):
     return decode(body), []
 
 
-def parse_multipart_signed(raw_message, parsed_message):
-    # multipart/signed contains several boundaries. this confuses pyzmail.
-    # have to split message manually to find multipart/mixed
-    boundary = parsed_message.get_boundary().encode()
-    parts = raw_message.split(b'\n--'+boundary+b'\n')
-
-    # multipart/signed must contained one and only one multipart/mixed part,
-    possible_bodies = [part for part in parts if b'Content-Type: multipart/mixed' in part]
-    if len(possible_bodies) != 1:
+def parse_multipart_signed(raw_message, message, limits=DEFAULT_LIMITS):
+    # multipart/signed must contain exactly two parts: I) the signed content, II) the application/pgp-signature
+    parts = message.get_payload()
+    if not isinstance(parts, list) or len(parts) != 2 or \
+            parts[1].get_content_type() != "application/pgp-signature":
         raise ParsingError("Malformated S/MIME message")
-    body = possible_bodies[0]
+    signed, signature = parts
 
-    # multipart/signed must contain one and only one application/pgp-signature
-    # this one pyzmail finds correctly
-    possible_signatures = [part.part.get_payload() for part in parsed_message.mailparts
-                           if part.part.get_content_type() == 'application/pgp-signature']
-    if len(possible_signatures) != 1:
+    # the signature is over the exact bytes of the first part, the parser does not keep those
+    delimiters = list(re.finditer(rb'(?:^|\r?\n)--' + re.escape(message.get_boundary().encode()) + rb'[ \t]*\r?\n',
+                                  raw_message))
+    if len(delimiters) < 2:
         raise ParsingError("Malformated S/MIME message")
+    body = raw_message[delimiters[0].end():delimiters[1].start()]
+
+    # attachments of the signed part, they might contain public keys
+    _, attachments = split_body(signed)
+    return body, [signature.get_payload()] + decode_attachments(attachments, limits)
 
-    return body, possible_signatures
 
-def parse_pgp_inline(message):
+def parse_pgp_inline(message, limits=DEFAULT_LIMITS):
     # identify and decode main message body
-    if message.text_part:
-        body = decode(message.text_part)
-    elif message.html_part:
-        body = decode(message.html_part)
+    body_parts, attachments = split_body(message)
+    if "text/plain" in body_parts:
+        body = decode(body_parts["text/plain"])
+    elif "text/html" in body_parts:
+        body = decode(body_parts["text/html"])
     else:
         raise ParsingError("Email does not contain body")
 
     # decode attachments
-    attachments = [decode(part) for part in message.mailparts if not part.is_body]
-    return body, attachments
-
-
-def decode(message_part):
-    content_transfer_encoding = message_part.part["Content-Transfer-Encoding"]
-    content_type = message_part.part["Content-Type"]
-    payload = message_part.part.get_payload()
+    return body, decode_attachments(attachments, limits)
+
+
+def split_body(message):
+    """
+    Find the parts that are the text and html body of the message, everything else is an attachment. Follows the
+    rules mail clients use to pick the body.
+    :return: (dictionary of content type to body part, list of attachment parts)
+    """
+    body_parts = {}
+    find_body_parts(message, body_parts)
+    is_body = set(id(part) for part in body_parts.values())
+    return body_parts, [part for part in leaf_parts(message) if id(part) not in is_body]
+
+
+def find_body_parts(part, body_parts):
+    content_type = part.get_content_type()
+    if not part.is_multipart():
+        body_parts[content_type] = part
+    elif content_type == "multipart/related":
+        # the part pointed to by start or the first one
+        start = part.get_param('start', None)
+        for i, subpart in enumerate(part.get_payload()):
+            if (not start and i == 0) or (start and start == subpart.get('Content-Id')):
+                find_body_parts(subpart, body_parts)
+                return
+    elif content_type == "multipart/alternative":
+        # all parts are candidates and the last one is the best
+        for subpart in part.get_payload():
+            find_body_parts(subpart, body_parts)
+    elif content_type in ("multipart/report", "multipart/signed"):
+        # only the first part is a candidate
+        subparts = part.get_payload()
+        if subparts:
+            find_body_parts(subparts[0], body_parts)
+    elif content_type == "multipart/encrypted":
+        # the body has to be decrypted first
+        return
+    else:
+        # anything else is treated as multipart/mixed, the first part that is not an attachment is the body
+        for subpart in part.get_payload():
+            found = {}
+            find_body_parts(subpart, found)
+            if subpart.get_param('attachment', None, 'content-disposition') != '':
+                for key, value in found.items():
+                    body_parts.setdefault(key, value)
+
+
+def leaf_parts(message):
+    # depth first, attached messages are not looked into
+    parts = []
+    stack = [message]
+    while stack:
+        part = stack.pop(0)
+        if part.get_content_type().startswith('message/'):
+            parts.append(part)
+        elif part.is_multipart():
+            stack[:0] = part.get_payload()
+        else:
+            parts.append(part)
+    return parts
+
+
+def decode_attachments(parts, limits=DEFAULT_LIMITS):
+    attachments = []
+    for part in parts:
+        size = decoded_size(part)
+        if limits.max_size is not None and size > limits.max_size:
+            log.info("Dropping {} attachment of about {} bytes".format(part.get_content_type(), size))
+        elif size > limits.memory_limit and part["Content-Transfer-Encoding"] in ("base64", "quoted-printable"):
+            attachments.append(spill(part, limits.directory))
+        else:
+            attachments.append(decode(part))
+    return attachments
+
+
+def decode(part):
+    content_transfer_encoding = part["Content-Transfer-Encoding"]
+    content_type = part["Content-Type"]
+    payload = part.get_payload()
 
     if content_transfer_encoding == "base64":
         payload = base64.b64decode(payload)
@@ -142,6 +387,7 @@ def get_charset(content_type):
 
 @contextmanager
 def connect(pop3_server, username, password):
+    conn = None
     try:
         conn = poplib.POP3_SSL(pop3_server)
         conn.user(username)
@@ -0,0 +1,222 @@
+from contextlib import contextmanager
+from email.parser import BytesHeaderParser
+import imaplib
+import logging
+import select
+import ssl
+import time
+
+from pgpbuddy.attachment import DEFAULT_LIMITS
+from pgpbuddy.fetch import parse_message, ParsingError
+from pgpbuddy.metrics import timed
+from pgpbuddy.state import Status
+
+
+log = logging.getLogger(__name__)
+
+# servers drop idle clients after 30 minutes, re-issue IDLE well before that. after a timeout the mailbox is checked
+# anyway
+IDLE_TIMEOUT = 5 * 60
+MIN_BACKOFF = 1
+MAX_BACKOFF = 5 * 60
+
+MAILBOX = 'INBOX'
+
+
+def serve(imap_server, username, password, state, handle_messages, limit=None, idle_timeout=IDLE_TIMEOUT,
+          coordinator=None, limits=DEFAULT_LIMITS):
+    """
+    Hold one IMAP connection open and hand new messages to handle_messages the moment they arrive. The connection is
+    re-established with exponential backoff whenever it breaks.
+    :param handle_messages: called with a generator of (uid, (raw message, headers, body, attachments)), it must mark
+    answered messages as replied in state
+    :param coordinator: optional Coordinator, only the messages it assigns to this node are handled
+    """
+    backoff = MIN_BACKOFF
+    while True:
+        try:
+            with connect(imap_server, username, password) as conn:
+                backoff = MIN_BACKOFF
+                uidvalidity = uid_validity(conn)
+                while True:
+                    # EXISTS responses from here on report the number of messages after the mailbox was listed. it
+                    # is listed once per cycle, handling and deleting both work from that listing
+                    conn.untagged_responses.pop('EXISTS', None)
+                    uids = list_uids(conn, uidvalidity)
+                    handle_messages(iter_new_messages(conn, state, uids, limit, coordinator, limits))
+                    deleted = delete_replied(conn, state, uids, coordinator)
+
+                    # IDLE only announces mail that arrives after it started, mail that arrived earlier is reported
+                    # by the server in the responses to the commands above
+                    if not has_new_mail(conn, len(uids) - deleted):
+                        idle(conn, idle_timeout)
+        except (imaplib.IMAP4.error, OSError) as e:
+            log.info("IMAP connection failed ({}), reconnecting in {} seconds".format(e, backoff))
+            time.sleep(backoff)
+            backoff = min(2 * backoff, MAX_BACKOFF)
+
+
+def has_new_mail(conn, count):
+    """
+    :param count: number of messages the mailbox holds if nothing arrived since it was listed
+    :return: True if the server reports more messages than that
+    """
+    # a NOOP gives the server the chance to report the current number of messages (RFC 3501 6.1.2)
+    conn.noop()
+    exists = [int(data) for data in conn.untagged_responses.pop('EXISTS', []) if data is not None]
+    return bool(exists) and exists[-1] > count
+
+
+def iter_new_messages(conn, state, uids, limit=None, coordinator=None, limits=DEFAULT_LIMITS):
+    """
+    Retrieve the messages of the selected mailbox that have not been answered yet, without marking them as read.
+    :param uids: result of list_uids
+    :return: generator of (uid, (raw message, headers, body, attachments))
+    """
+    state.prune(uids.values())
+    if coordinator is not None:
+        # the heartbeat goes out with every IDLE cycle, also one that finds nothing to claim
+        coordinator.heartbeat()
+        coordinator.prune(uids.values())
+
+    new_messages = []
+    for imap_uid, uid in sorted(uids.items()):
+        if limit is not None and len(new_messages) >= limit:
+            break
+        if not state.should_retrieve(uid):
+            continue
+        if coordinator is not None and \
+                not coordinator.claim(state.sender(uid, lambda: retrieve_sender(conn, imap_uid)), uid):
+            continue
+        new_messages.append((imap_uid, uid))
+
+    for imap_uid, uid in new_messages:
+        state.mark(uid, Status.seen)
+        raw_message = retrieve_message(conn, imap_uid)
+        if raw_message is None:
+            continue
+        try:
+            message = parse_message(raw_message, limits)
+        except ParsingError as e:
+            # there is nothing to answer, treat it as done so that it gets deleted
+            log.info("Skipping message: {}".format(e))
+            state.mark(uid, Status.replied)
+            continue
+        yield uid, message
+
+
+def uid_validity(conn):
+    # IMAP uids are only unique together with the UIDVALIDITY the server reported when the mailbox was selected
+    data = conn.untagged_responses.get('UIDVALIDITY')
+    if not data:
+        raise imaplib.IMAP4.error("the server did not report the UIDVALIDITY of the mailbox")
+    return data[-1].decode()
+
+
+def list_uids(conn, uidvalidity):
+    """
+    :return: dict of IMAP uid to the uid buddy knows the message by
+    """
+    _, data = conn.uid('SEARCH', None, 'ALL')
+    return {int(imap_uid): "{}:{}".format(uidvalidity, int(imap_uid)) for imap_uid in data[0].split()}
+
+
+@timed("retrieve")
+def retrieve_message(conn, imap_uid):
+    _, data = conn.uid('FETCH', str(imap_uid), '(BODY.PEEK[])')
+    parts = [part for part in data if isinstance(part, tuple)]
+    if not parts:
+        return None
+    # same form as poplib returns messages, lines without line endings
+    return parts[0][1].split(b'\r\n')
+
+
+def retrieve_sender(conn, imap_uid):
+    _, data = conn.uid('FETCH', str(imap_uid), '(BODY.PEEK[HEADER.FIELDS (FROM)])')
+    parts = [part for part in data if isinstance(part, tuple)]
+    if not parts:
+        return ""
+    return BytesHeaderParser().parsebytes(parts[0][1]).get("From", "")
+
+
+def delete_replied(conn, state, uids, coordinator=None):
+    """
+    :param uids: result of list_uids
+    :return: number of messages deleted
+    """
+    replied = state.replied()
+    if coordinator is not None:
+        # another node may have answered a message and stopped before deleting it
+        replied |= coordinator.replied()
+    to_delete = [str(imap_uid) for imap_uid, uid in uids.items() if uid in replied]
+    if to_delete:
+        conn.uid('STORE', ",".join(to_delete), '+FLAGS', '(\\Deleted)')
+        conn.expunge()
+    return len(to_delete)
+
+
+def idle(conn, timeout):
+    """
+    Wait in IDLE until the server announces new mail or the timeout expires (RFC 2177).
+    :return: True if new mail arrived
+    """
+    tag = conn._new_tag()
+    conn.send(tag + b' IDLE\r\n')
+    line = conn.readline()
+    if not line.startswith(b'+'):
+        raise imaplib.IMAP4.error("IDLE not supported: {}".format(line))
+
+    new_mail = False
+    deadline = time.time() + timeout
+    while not new_mail:
+        remaining = deadline - time.time()
+        if remaining <= 0 or not readable(conn, remaining):
+            break
+        line = conn.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed during IDLE")
+        new_mail = line.startswith(b'* ') and line.rstrip().endswith(b'EXISTS')
+
+    conn.send(b'DONE\r\n')
+    while True:
+        line = conn.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed during IDLE")
+        if line.startswith(tag):
+            break
+    return new_mail
+
+
+def readable(conn, timeout):
+    if buffered(conn):
+        return True
+    return bool(select.select([conn.sock], [], [], timeout)[0])
+
+
+def buffered(conn):
+    # select does not see data that was already read into the file's buffer together with an earlier line, or that
+    # the ssl layer already decrypted. peeking without blocking finds both
+    timeout = conn.sock.gettimeout()
+    conn.sock.setblocking(False)
+    try:
+        return bool(conn.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        conn.sock.settimeout(timeout)
+
+
+@contextmanager
+def connect(imap_server, username, password, mailbox=MAILBOX):
+    conn = None
+    try:
+        conn = imaplib.IMAP4_SSL(imap_server)
+        conn.login(username, password)
+        conn.select(mailbox)
+        yield conn
+    finally:
+        if conn:
+            try:
+                conn.logout()
+            except (imaplib.IMAP4.error, OSError):
+                pass
@@ -0,0 +1,106 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.utils import parseaddr
+import logging
+import sqlite3
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_NEGATIVE_TTL = 60 * 60
+
+# what the keyserver knows about a sender, the ascii armored public keys and their fingerprints as gpg reported them
+SenderKeys = namedtuple('SenderKeys', 'keys fingerprints')
+NO_KEYS = SenderKeys('', ())
+
+
+class KeyCache(object):
+    """
+    Persistent cache of keyserver lookups keyed by sender address. Entries hold the SenderKeys found for the sender,
+    NO_KEYS means that the keyserver did not know the sender. Expired entries are still served while they are
+    refreshed in the background.
+    """
+
+    def __init__(self, filename, fetch, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL):
+        """
+        :param filename: sqlite database file, ":memory:" for a cache that only lives as long as the process
+        :param fetch: function that takes a sender and returns the SenderKeys found for it on the keyserver
+        :param ttl: seconds after which an entry with keys is refreshed
+        :param negative_ttl: seconds after which an entry without keys is refreshed
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.db:
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(keys)").fetchall()]
+            if columns and "fingerprints" not in columns:
+                # a cache of an earlier version, without fingerprints its entries are looked up again
+                self.db.execute("DROP TABLE keys")
+            self.db.execute("CREATE TABLE IF NOT EXISTS keys "
+                            "(sender TEXT PRIMARY KEY, keys TEXT, fingerprints TEXT, fetched REAL)")
+
+    def get(self, sender):
+        """
+        :return: the cached SenderKeys of the sender, None if the sender is not in the cache
+        """
+        sender = normalize(sender)
+        with self.lock:
+            row = self.db.execute("SELECT keys, fingerprints, fetched FROM keys WHERE sender = ?",
+                                  (sender,)).fetchone()
+        if row is None:
+            return None
+
+        keys, fingerprints, fetched = row
+        ttl = self.ttl if keys else self.negative_ttl
+        if time.time() - fetched > ttl:
+            self.refresh(sender)
+        return SenderKeys(keys, tuple(fingerprints.split()))
+
+    def put(self, sender, sender_keys):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO keys (sender, keys, fingerprints, fetched) VALUES (?, ?, ?, ?)",
+                            (normalize(sender), sender_keys.keys, " ".join(sender_keys.fingerprints), time.time()))
+
+    def refresh(self, sender):
+        sender = normalize(sender)
+        with self.lock:
+            if sender in self.refreshing:
+                return
+            self.refreshing.add(sender)
+        self.executor.submit(self._refresh, sender)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.db.close()
+
+    def _refresh(self, sender):
+        try:
+            self.put(sender, self.fetch(sender))
+        except Exception:
+            log.exception("Refreshing keys of {} failed".format(sender))
+        finally:
+            with self.lock:
+                self.refreshing.discard(sender)
+
+
+def normalize(sender):
+    # "Name <address>" and "address" belong to the same sender
+    address = parseaddr(sender)[1]
+    return (address or sender).strip().lower()
+
+
+@contextmanager
+def init_keycache(filename, fetch, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL):
+    keycache = KeyCache(filename, fetch, ttl, negative_ttl)
+    try:
+        yield keycache
+    finally:
+        keycache.close()
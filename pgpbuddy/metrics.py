@@ -0,0 +1,148 @@
+from contextlib import contextmanager, ContextDecorator
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+DEFAULT_STATS_INTERVAL = 5 * 60
+
+
+class Metrics(object):
+    """
+    Latency histograms per pipeline stage and counters, shared by all threads of the process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.counters = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.latencies.setdefault(stage, {"buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0})
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def get(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def clear(self):
+        with self.lock:
+            self.latencies = {}
+            self.counters = {}
+
+    def render(self):
+        """
+        :return: all metrics in the Prometheus text exposition format
+        """
+        with self.lock:
+            lines = ["# TYPE buddy_stage_seconds histogram"]
+            for stage, histogram in sorted(self.latencies.items()):
+                for bound, count in zip(BUCKETS, histogram["buckets"]):
+                    lines.append('buddy_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage, bound, count))
+                lines.append('buddy_stage_seconds_bucket{{stage="{}",le="+Inf"}} {}'.format(stage, histogram["count"]))
+                lines.append('buddy_stage_seconds_sum{{stage="{}"}} {}'.format(stage, histogram["sum"]))
+                lines.append('buddy_stage_seconds_count{{stage="{}"}} {}'.format(stage, histogram["count"]))
+
+            names = sorted(set(name for name, _ in self.counters))
+            for name in names:
+                lines.append("# TYPE buddy_{} counter".format(name))
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        labels = ",".join('{}="{}"'.format(key, value) for key, value in labels)
+                        lines.append("buddy_{}{} {}".format(name, "{" + labels + "}" if labels else "", value))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        :return: one line per stage with count and mean latency, and all counters, for the log
+        """
+        with self.lock:
+            lines = ["{}: {} calls, {:.1f} ms mean".format(stage, histogram["count"],
+                                                           1000 * histogram["sum"] / histogram["count"])
+                     for stage, histogram in sorted(self.latencies.items())]
+            lines += ["{}{}: {}".format(name, dict(labels) if labels else "", value)
+                      for (name, labels), value in sorted(self.counters.items())]
+        return "\n".join(lines)
+
+
+metrics = Metrics()
+
+
+class timed(ContextDecorator):
+    """
+    Record the duration of a stage, as a with block or as a function decorator.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.local = threading.local()
+
+    def __enter__(self):
+        # the same instance decorates a function that runs in several threads at once
+        self.local.__dict__.setdefault("starts", []).append(time.perf_counter())
+        return self
+
+    def __exit__(self, *exc):
+        metrics.observe(self.stage, time.perf_counter() - self.local.starts.pop())
+        return False
+
+
+def increment(name, amount=1, **labels):
+    metrics.increment(name, amount, **labels)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes would flood the log
+        pass
+
+
+def dump_stats(stop, interval):
+    while not stop.wait(interval):
+        log.info("Pipeline stats:\n{}".format(metrics.summary()))
+
+
+@contextmanager
+def init_metrics(port=None, interval=None):
+    """
+    Serve the metrics for Prometheus on port and/or write a summary to the log every interval seconds.
+    """
+    server = None
+    stop = threading.Event()
+    if port is not None:
+        server = HTTPServer(("", port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    if interval:
+        threading.Thread(target=dump_stats, args=(stop, interval), daemon=True).start()
+    try:
+        yield metrics
+    finally:
+        stop.set()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from pgpbuddy.keycache import normalize, NO_KEYS
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+DEFAULT_TIMEOUT = 10
+
+
+class KeyPrefetcher(object):
+    """
+    Looks up the keys of all senders of a batch concurrently, so that handling a message only waits for a sender's
+    key when it actually needs it.
+    """
+
+    def __init__(self, fetch, keycache=None, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT):
+        """
+        :param fetch: function that takes a sender and returns the SenderKeys found for it on the keyserver
+        :param keycache: optional KeyCache that is consulted before and updated after asking the keyserver
+        :param timeout: seconds after the start of a lookup after which its sender is treated as having no key
+        """
+        self.fetch = fetch
+        self.keycache = keycache
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.lookups = {}
+
+    def prefetch(self, senders):
+        with self.lock:
+            self._prune()
+            for sender in senders:
+                sender = normalize(sender)
+                if sender not in self.lookups:
+                    self.lookups[sender] = (time.time(), self.executor.submit(self._lookup, sender))
+
+    def get(self, sender):
+        """
+        Wait for the lookup of the sender's keys, starting it first if it was not prefetched.
+        :return: the sender's SenderKeys, NO_KEYS if none were found in time
+        """
+        self.prefetch([sender])
+        with self.lock:
+            started, lookup = self.lookups[normalize(sender)]
+        try:
+            return lookup.result(timeout=max(0, started + self.timeout - time.time()))
+        except TimeoutError:
+            log.info("Keyserver lookup for {} timed out".format(sender))
+        except Exception:
+            log.exception("Keyserver lookup for {} failed".format(sender))
+        return NO_KEYS
+
+    def close(self):
+        # lookups that timed out keep running in the background and still end up in the key cache
+        self.executor.shutdown(wait=False)
+
+    def _prune(self):
+        # a long running prefetcher must not remember every sender, finished lookups are in the key cache anyway
+        now = time.time()
+        expired = [sender for sender, (started, lookup) in self.lookups.items()
+                   if lookup.done() and started + self.timeout < now]
+        for sender in expired:
+            del self.lookups[sender]
+
+    def _lookup(self, sender):
+        if self.keycache is not None:
+            keys = self.keycache.get(sender)
+            if keys is not None:
+                return keys
+
+        keys = self.fetch(sender)
+        if self.keycache is not None:
+            self.keycache.put(sender, keys)
+        return keys
+
+
+@contextmanager
+def init_prefetcher(fetch, keycache=None, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT):
+    prefetcher = KeyPrefetcher(fetch, keycache, workers, timeout)
+    try:
+        yield prefetcher
+    finally:
+        prefetcher.close()
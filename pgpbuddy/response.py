@@ -1,4 +1,6 @@
-from pgpbuddy.crypto import Signature, Encryption
+from collections import namedtuple
+
+from pgpbuddy.crypto import Signature, Encryption, PublicKey
 
 # python can not directly do lookup of enums -> replace enums in the dictionary keys with their integer representations
 def compile_lookup_table(lookup_table):
@@ -68,3 +70,51 @@ default_content = "Had trouble parsing your message. sorry. good luck."
 content = compile_lookup_table(content)
 subject = compile_lookup_table(subject)
 
+
+
+# subject and content of every response precompiled into format strings, rendering a response is a single format call
+Template = namedtuple('Template', 'subject content content_with_reason')
+
+
+def compile_template(subject_text, content_text):
+    subject_text = subject_text.replace('{', '{{').replace('}', '}}')
+    content_text = content_text.replace('{', '{{').replace('}', '}}')
+    return Template(subject_text + ' (Was: {})', content_text, content_text + ' because {}')
+
+
+templates = {key: compile_template(subject[key], content.get(key, default_content)) for key in subject}
+default_template = compile_template(default_subject, default_content)
+
+
+def render(encryption_status, signature_status, original_subject, reason):
+    """
+    :return: subject and text of the response
+    """
+    template = templates.get((encryption_status.value, signature_status.value), default_template)
+    # both contents are format strings, the braces of the tables only come out single once formatted
+    text = template.content_with_reason.format(reason) if reason != '' else template.content.format()
+    return template.subject.format(original_subject), text
+
+
+def case(encryption_status, signature_status, key_status):
+    """
+    :return: letter of the response in the bot logic of the README, "unknown" for combinations it does not cover
+    """
+    key_available = key_status == PublicKey.available
+    if encryption_status == Encryption.missing:
+        if signature_status == Signature.missing:
+            return "A"
+        if signature_status == Signature.incorrect:
+            return "C" if key_available else "B"
+        if signature_status == Signature.correct:
+            return "E"
+    if encryption_status == Encryption.correct:
+        if signature_status == Signature.incorrect:
+            return "D"
+        if signature_status == Signature.correct:
+            return "F"
+        if signature_status == Signature.missing:
+            return "H" if key_available else "G"
+    if encryption_status == Encryption.incorrect:
+        return "I" if key_available else "J"
+    return "unknown"
@@ -0,0 +1,119 @@
+from collections import namedtuple, OrderedDict
+import hashlib
+import threading
+import time
+
+from pgpbuddy.attachment import is_spilled
+from pgpbuddy.keycache import normalize
+
+
+DEFAULT_RESULT_CACHE_SIZE = 1024
+DEFAULT_RESULT_TTL = 60 * 60
+DEFAULT_DUPLICATE_INTERVAL = 10 * 60
+
+# outcome of handling a message, the case of the bot logic it fell into and the response buddy sent for it
+Result = namedtuple('Result', 'encryption_status signature_status reason case subject text')
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def message_digest(header, body, attachments, fingerprints=()):
+    """
+    Digest of what decides how buddy answers a message. Headers that every hop changes, e.g. Received, Date or
+    Message-ID, are left out, so copies of a message that took different routes have the same digest.
+    :param header: parsed headers, of which From, Subject and Content-Type are used
+    :param body: body and attachments as parsed, attachments can be spilled to disk
+    :param fingerprints: of the sender's keys as found on the keyserver, a message is only handled the same way again
+    as long as the same keys are found
+    """
+    digest = hashlib.sha256()
+    update(digest, normalize(header["From"] or ""))
+    update(digest, " ".join((header["Subject"] or "").split()))
+    update(digest, header["Content-Type"] or "")
+    update(digest, body)
+    for attachment in attachments:
+        update(digest, attachment)
+    # the armored keys change with every new signature the keyserver collects, the fingerprints only with the keys
+    update(digest, "\n".join(sorted(fingerprints)))
+    return digest.hexdigest()
+
+
+def update(digest, data):
+    # every field is prefixed with its length, so that no two different messages produce the same input
+    if is_spilled(data):
+        digest.update("{}:".format(data.size).encode())
+        f = data.open()
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+        return
+
+    if isinstance(data, str):
+        data = data.encode('utf-8', 'surrogateescape')
+    digest.update("{}:".format(len(data)).encode())
+    digest.update(data)
+
+
+class ResultCache(object):
+    """
+    Least recently used cache of the results of handling messages, by message digest. Retries and mail loops send the
+    same message over and over, each copy is only handled once and answered at most once per duplicate interval.
+    """
+
+    def __init__(self, size=DEFAULT_RESULT_CACHE_SIZE, ttl=DEFAULT_RESULT_TTL,
+                 duplicate_interval=DEFAULT_DUPLICATE_INTERVAL):
+        """
+        :param size: number of messages to remember, 0 disables the cache
+        :param ttl: seconds a result is reused
+        :param duplicate_interval: seconds after a reply during which copies of the message are not answered again
+        """
+        self.size = size
+        self.ttl = ttl
+        self.duplicate_interval = duplicate_interval
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, digest):
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None or entry["result"] is None or entry["expires"] <= time.time():
+                return None
+            self.entries.move_to_end(digest)
+            return entry["result"]
+
+    def put(self, digest, result):
+        if self.size <= 0:
+            return
+        with self.lock:
+            entry = self._entry(digest)
+            entry["result"] = result
+            entry["expires"] = time.time() + self.ttl
+
+    def admit(self, digest, uid):
+        """
+        Decide whether the message uid gets a reply. A message that is retried is always admitted again.
+        :return: False if a copy of the message with another uid was admitted within the duplicate interval
+        """
+        if self.size <= 0:
+            return True
+        now = time.time()
+        with self.lock:
+            entry = self._entry(digest)
+            if entry["uid"] not in (None, uid) and now - entry["admitted"] < self.duplicate_interval:
+                return False
+            entry["uid"] = uid
+            entry["admitted"] = now
+            return True
+
+    def _entry(self, digest):
+        entry = self.entries.get(digest)
+        if entry is None:
+            entry = self.entries[digest] = {"result": None, "expires": 0, "uid": None, "admitted": 0}
+        self.entries.move_to_end(digest)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return entry
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
@@ -4,9 +4,14 @@ import logging
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
+from pgpbuddy.metrics import timed
+
 
 log = logging.getLogger(__name__)
 
+# reply code with which a server announces that it is about to close the session
+SERVICE_NOT_AVAILABLE = 421
+
 
 def create_message(recipient, subject, content):
     msg = MIMEMultipart('alternative')
@@ -19,21 +24,94 @@ def create_message(recipient, subject, content):
     return msg
 
 
+def message_content(msg):
+    """
+    :param msg: message as created by create_message
+    :return: subject and content of the message
+    """
+    body = msg.get_payload(0)
+    return msg["Subject"], body.get_payload(decode=True).decode(body.get_content_charset() or 'us-ascii')
+
+
 def send_response(smtp_server, smtp_port, username, password, msg):
     with connect(smtp_server, smtp_port, username, password) as conn:
         conn.sendmail(username, msg["To"], msg.as_string())
         log.debug('Sent email successfully')
 
 
+def send_responses(smtp_server, smtp_port, username, password, messages):
+    """
+    Send a batch of messages over a single authenticated SMTP session. If the server drops the session
+    the connection is re-established and the message is tried once more.
+    :param messages: list of messages as created by create_message
+    :return: list of messages that were sent and list of (message, error) tuples for the ones that failed
+    """
+    sent, failed = [], []
+    conn = None
+    try:
+        for msg in messages:
+            error = None
+            for attempt in range(2):
+                try:
+                    if conn is None:
+                        conn = open_connection(smtp_server, smtp_port, username, password)
+                    with timed("smtp_send"):
+                        conn.sendmail(username, msg["To"], msg.as_string())
+                    sent.append(msg)
+                    error = None
+                    break
+                except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                    # session is gone, reconnect and retry
+                    log.debug('SMTP session dropped, reconnecting: {}'.format(e))
+                    close_connection(conn)
+                    conn, error = None, e
+                except smtplib.SMTPResponseException as e:
+                    if e.smtp_code != SERVICE_NOT_AVAILABLE:
+                        error = e
+                        break
+                    log.debug('SMTP server closing session, reconnecting: {}'.format(e))
+                    close_connection(conn)
+                    conn, error = None, e
+                except (smtplib.SMTPException, OSError) as e:
+                    error = e
+                    break
+
+            if error is not None:
+                log.info('Could not send email to {}: {}'.format(msg["To"], error))
+                failed.append((msg, error))
+    finally:
+        close_connection(conn)
 
-@contextmanager
-def connect(smtp_server, smtp_port, username, password):
+    log.debug('Sent {} emails, {} failed'.format(len(sent), len(failed)))
+    return sent, failed
+
+
+def open_connection(smtp_server, smtp_port, username, password):
+    conn = smtplib.SMTP_SSL(smtp_server, smtp_port)
     try:
-        conn = smtplib.SMTP_SSL(smtp_server, smtp_port)
         conn.ehlo()
         conn.login(username, password)
+    except Exception:
+        close_connection(conn)
+        raise
+    return conn
+
+
+def close_connection(conn):
+    if conn is None:
+        return
+    try:
+        conn.quit()
+    except (smtplib.SMTPException, OSError):
+        # the server might already have dropped the session
+        conn.close()
+
+
+@contextmanager
+def connect(smtp_server, smtp_port, username, password):
+    conn = None
+    try:
+        conn = open_connection(smtp_server, smtp_port, username, password)
         yield conn
     finally:
-        if conn:
-            conn.quit()
-
+        close_connection(conn)
@@ -0,0 +1,129 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import logging
+
+import pgpbuddy.crypto as crypto
+from pgpbuddy.buddy import process_message, new_messages, mark_replied, admit, is_large, POLL_INTERVAL
+from pgpbuddy.fetch import message_size
+from pgpbuddy.prefetch import init_prefetcher, DEFAULT_WORKERS, DEFAULT_TIMEOUT
+from pgpbuddy.send import send_responses
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 100
+
+# replies that are ready at the same time are sent over one smtp session
+MAX_SEND_BATCH = 50
+
+
+def run(config, resources, polls=None):
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(serve(config, resources, polls))
+    finally:
+        loop.close()
+
+
+async def serve(config, resources, polls=None):
+    """
+    Run fetching, handling and sending as concurrent stages connected by bounded queues. A full queue makes the stage
+    before it wait, so no stage can run away from the others. The mail and gpg libraries block, their calls run in
+    executors.
+    :param polls: number of polls of the mailbox before returning, None to run forever
+    """
+    queue_size = config.get("queue-size", DEFAULT_QUEUE_SIZE)
+    incoming = asyncio.Queue(maxsize=queue_size)
+    outgoing = asyncio.Queue(maxsize=queue_size)
+
+    # one handling thread per keyring workspace, large messages are handled by threads of their own so that the small
+    # ones do not queue behind them. the mail connections get their own threads
+    handlers = ThreadPoolExecutor(max_workers=resources.workspaces.size)
+    large_handlers = ThreadPoolExecutor(max_workers=max(resources.workspaces.large_size, 1))
+    mail = ThreadPoolExecutor(max_workers=2)
+
+    with init_prefetcher(crypto.fetch_public_keys_from_server, resources.keycache,
+                         config.get("keyserver-workers", DEFAULT_WORKERS),
+                         config.get("keyserver-timeout", DEFAULT_TIMEOUT)) as prefetcher:
+        stages = [asyncio.ensure_future(handle(config, resources, prefetcher, incoming, outgoing, handlers,
+                                               large_handlers))
+                  for _ in range(queue_size)]
+        stages.append(asyncio.ensure_future(send(config, resources, outgoing, mail)))
+        try:
+            await fetch(config, resources, prefetcher, incoming, outgoing, mail, polls)
+        finally:
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            handlers.shutdown(wait=True)
+            large_handlers.shutdown(wait=True)
+            mail.shutdown(wait=True)
+
+
+async def fetch(config, resources, prefetcher, incoming, outgoing, executor, polls):
+    loop = asyncio.get_event_loop()
+    poll = 0
+    while polls is None or poll < polls:
+        try:
+            await loop.run_in_executor(executor, retrieve, config, resources, prefetcher, incoming, loop)
+        except Exception:
+            log.exception("Fetching messages failed")
+
+        # messages of this poll that are not answered yet would be retrieved again
+        await incoming.join()
+        await outgoing.join()
+
+        poll += 1
+        if polls is None or poll < polls:
+            await asyncio.sleep(config.get("poll-interval", POLL_INTERVAL))
+
+
+def retrieve(config, resources, prefetcher, incoming, loop):
+    # runs in a thread, blocks while the incoming queue is full
+    for uid, message in new_messages(config, resources):
+        raw_message, header, _, _ = message
+        if not admit(resources, uid, message):
+            continue
+        prefetcher.prefetch([header["From"]])
+        # released once the message is handled
+        size = message_size(raw_message)
+        resources.admission.acquire(size, is_large(config, size))
+        asyncio.run_coroutine_threadsafe(incoming.put((uid, message)), loop).result()
+
+
+async def handle(config, resources, prefetcher, incoming, outgoing, executor, large_executor):
+    loop = asyncio.get_event_loop()
+    while True:
+        uid, message = await incoming.get()
+        size = message_size(message[0])
+        large = is_large(config, size)
+        lane = large_executor if large else executor
+        try:
+            response_full = await loop.run_in_executor(lane, process_message, resources, prefetcher, uid, message,
+                                                       large)
+            if response_full is not None:
+                await outgoing.put((uid, response_full))
+        finally:
+            resources.admission.release(size, large)
+            incoming.task_done()
+
+
+async def send(config, resources, outgoing, executor):
+    loop = asyncio.get_event_loop()
+    while True:
+        batch = [await outgoing.get()]
+        while not outgoing.empty() and len(batch) < MAX_SEND_BATCH:
+            batch.append(outgoing.get_nowait())
+
+        try:
+            uids = {id(response_full): uid for uid, response_full in batch}
+            sent, _ = await loop.run_in_executor(executor, send_responses, config["smtp-server"], config["smtp-port"],
+                                                 config["username"], config["password"],
+                                                 [response_full for _, response_full in batch])
+            for response_full in sent:
+                mark_replied(resources, uids[id(response_full)])
+        except Exception:
+            log.exception("Sending replies failed")
+        finally:
+            for _ in batch:
+                outgoing.task_done()
@@ -0,0 +1,184 @@
+from bisect import bisect
+from contextlib import contextmanager
+import hashlib
+import logging
+import socket
+import sqlite3
+import threading
+import time
+
+from pgpbuddy.keycache import normalize
+
+
+log = logging.getLogger(__name__)
+
+# a node sends its heartbeat once per poll of the mailbox, which is at most 5 minutes apart when waiting in IMAP IDLE
+DEFAULT_NODE_TTL = 10 * 60
+DEFAULT_CLAIM_TTL = 5 * 60
+DEFAULT_REPLICAS = 64
+
+
+def _hash(key):
+    return int(hashlib.sha1(key.encode()).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys onto nodes. When a node joins or leaves only the keys next to its points on the ring
+    change owner, all other keys stay where they were.
+    """
+
+    def __init__(self, nodes, replicas=DEFAULT_REPLICAS):
+        points = sorted((_hash("{}#{}".format(node, i)), node) for node in nodes for i in range(replicas))
+        self.hashes = [h for h, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def owner(self, key):
+        if not self.nodes:
+            return None
+        return self.nodes[bisect(self.hashes, _hash(key)) % len(self.nodes)]
+
+
+class LeaseStore(object):
+    """
+    Shared record of the live nodes and of which node claimed which message. All nodes have to open the same
+    database file, e.g. on a shared file system.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: sqlite database file, ":memory:" for a single node
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False, timeout=30)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS nodes (node TEXT PRIMARY KEY, expires REAL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS claims "
+                            "(uid TEXT PRIMARY KEY, node TEXT, expires REAL, replied INTEGER)")
+
+    def heartbeat(self, node, ttl):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO nodes (node, expires) VALUES (?, ?)", (node, time.time() + ttl))
+
+    def leave(self, node):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM nodes WHERE node = ?", (node,))
+
+    def live_nodes(self):
+        with self.lock:
+            rows = self.db.execute("SELECT node FROM nodes WHERE expires > ?", (time.time(),)).fetchall()
+        return sorted(node for node, in rows)
+
+    def claim(self, uid, node, ttl):
+        """
+        Claim a message for node, unless another node holds an unexpired claim or already answered it.
+        :return: True if node now holds the claim
+        """
+        now = time.time()
+        with self.lock, self.db:
+            # BEGIN IMMEDIATE so that two nodes cannot both see the claim as free
+            self.db.execute("BEGIN IMMEDIATE")
+            row = self.db.execute("SELECT node, expires, replied FROM claims WHERE uid = ?", (uid,)).fetchone()
+            if row is not None:
+                owner, expires, replied = row
+                if owner != node and (replied or expires > now):
+                    return False
+            self.db.execute("INSERT OR REPLACE INTO claims (uid, node, expires, replied) VALUES (?, ?, ?, 0)",
+                            (uid, node, now + ttl))
+            return True
+
+    def mark_replied(self, uid, node):
+        with self.lock, self.db:
+            self.db.execute("UPDATE claims SET replied = 1 WHERE uid = ? AND node = ?", (uid, node))
+
+    def replied(self):
+        with self.lock:
+            rows = self.db.execute("SELECT uid FROM claims WHERE replied = 1").fetchall()
+        return set(uid for uid, in rows)
+
+    def prune(self, uids_on_server):
+        """
+        Forget the claims of all messages that are no longer in the mailbox.
+        """
+        uids_on_server = set(uids_on_server)
+        with self.lock, self.db:
+            known = [uid for uid, in self.db.execute("SELECT uid FROM claims").fetchall()]
+            self.db.executemany("DELETE FROM claims WHERE uid = ?",
+                                [(uid,) for uid in known if uid not in uids_on_server])
+
+    def close(self):
+        self.db.close()
+
+
+class Coordinator(object):
+    """
+    Splits one mailbox between several buddy nodes. Senders are assigned to the live nodes by consistent hashing, so
+    each sender's keys stay cached on one node. A node additionally claims each message in the lease store before it
+    retrieves it, this keeps two nodes from answering the same message while the set of live nodes changes.
+    """
+
+    def __init__(self, store, node, node_ttl=DEFAULT_NODE_TTL, claim_ttl=DEFAULT_CLAIM_TTL,
+                 replicas=DEFAULT_REPLICAS):
+        """
+        :param store: LeaseStore shared by all nodes
+        :param node: name of this node, unique among the nodes
+        :param node_ttl: seconds after its last heartbeat after which a node counts as gone
+        :param claim_ttl: seconds a node has to answer a message it claimed
+        """
+        self.store = store
+        self.node = node
+        self.node_ttl = node_ttl
+        self.claim_ttl = claim_ttl
+        self.replicas = replicas
+        self.last_heartbeat = 0
+        self.ring = None
+
+    def owns(self, sender):
+        self._refresh()
+        return self.ring.owner(normalize(sender)) == self.node
+
+    def claim(self, sender, uid):
+        """
+        :return: True if this node is responsible for the message and nobody else is working on it
+        """
+        return self.owns(sender) and self.store.claim(uid, self.node, self.claim_ttl)
+
+    def mark_replied(self, uid):
+        self.store.mark_replied(uid, self.node)
+
+    def replied(self):
+        return self.store.replied()
+
+    def prune(self, uids_on_server):
+        self.store.prune(uids_on_server)
+
+    def leave(self):
+        self.store.leave(self.node)
+
+    def heartbeat(self):
+        """
+        Keep this node in the ring for another node_ttl seconds, whether or not it has messages to claim.
+        """
+        self.store.heartbeat(self.node, self.node_ttl)
+        self.last_heartbeat = time.time()
+        nodes = self.store.live_nodes()
+        if self.ring is None or nodes != self.nodes:
+            log.info("Sharding the mailbox between nodes {}".format(", ".join(nodes)))
+        self.nodes = nodes
+        self.ring = HashRing(nodes, self.replicas)
+
+    def _refresh(self):
+        # heartbeats are written well within node_ttl, the ring is rebuilt with every heartbeat
+        if self.ring is None or time.time() - self.last_heartbeat >= self.node_ttl / 3:
+            self.heartbeat()
+
+
+@contextmanager
+def init_coordinator(filename, node=None, node_ttl=DEFAULT_NODE_TTL, claim_ttl=DEFAULT_CLAIM_TTL):
+    store = LeaseStore(filename)
+    coordinator = Coordinator(store, node or socket.gethostname(), node_ttl, claim_ttl)
+    try:
+        yield coordinator
+    finally:
+        coordinator.leave()
+        store.close()
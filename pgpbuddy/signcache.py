@@ -0,0 +1,40 @@
+from collections import OrderedDict
+import threading
+
+
+DEFAULT_SIGNATURE_CACHE_SIZE = 256
+
+
+class SignatureCache(object):
+    """
+    Least recently used cache of clearsigned responses. Responses that are only signed depend on the template, the
+    reason and buddy's key but not on the recipient, so most of them can be signed once and sent many times.
+    """
+
+    def __init__(self, size=DEFAULT_SIGNATURE_CACHE_SIZE):
+        """
+        :param size: number of signed responses to keep, 0 disables the cache
+        """
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, signed):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = signed
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
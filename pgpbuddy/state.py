@@ -0,0 +1,120 @@
+from contextlib import contextmanager
+from enum import Enum
+import sqlite3
+import threading
+import time
+
+
+Status = Enum('Status', 'seen processed replied')
+
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_MAX_DEFERRALS = 10
+
+
+class MailState(object):
+    """
+    Remembers, by POP3 UIDL, which messages of the mailbox were retrieved (seen), handled (processed) and answered
+    (replied). Messages stay on the server until they are answered, so a crash or a failed reply only means that
+    the message is retrieved again on the next poll. The sender of every message is remembered as well, so that its
+    headers are only looked at once however long it stays on the server.
+    """
+
+    def __init__(self, filename, max_attempts=DEFAULT_MAX_ATTEMPTS, max_deferrals=DEFAULT_MAX_DEFERRALS):
+        """
+        :param filename: sqlite database file, ":memory:" for state that only lives as long as the process
+        :param max_attempts: how often a message is retrieved before buddy gives up on answering it
+        :param max_deferrals: how often a message that is over its sender's limit is put off before it is given up on
+        """
+        self.max_attempts = max_attempts
+        self.max_deferrals = max_deferrals
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS messages "
+                            "(uid TEXT PRIMARY KEY, status INTEGER, attempts INTEGER, updated REAL, "
+                            "deferrals INTEGER DEFAULT 0)")
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(messages)").fetchall()]
+            if "deferrals" not in columns:
+                # state of an earlier version, its messages were never deferred
+                self.db.execute("ALTER TABLE messages ADD COLUMN deferrals INTEGER DEFAULT 0")
+            self.db.execute("CREATE TABLE IF NOT EXISTS senders (uid TEXT PRIMARY KEY, sender TEXT)")
+
+    def get(self, uid):
+        with self.lock:
+            row = self.db.execute("SELECT status FROM messages WHERE uid = ?", (uid,)).fetchone()
+        return Status(row[0]) if row else None
+
+    def attempts(self, uid):
+        with self.lock:
+            row = self.db.execute("SELECT attempts FROM messages WHERE uid = ?", (uid,)).fetchone()
+        return row[0] if row else 0
+
+    def deferrals(self, uid):
+        with self.lock:
+            row = self.db.execute("SELECT deferrals FROM messages WHERE uid = ?", (uid,)).fetchone()
+        return row[0] if row else 0
+
+    def should_retrieve(self, uid):
+        return self.get(uid) != Status.replied and self.attempts(uid) < self.max_attempts
+
+    def should_defer(self, uid):
+        return self.deferrals(uid) < self.max_deferrals
+
+    def mark(self, uid, status):
+        # every time a message is retrieved again counts as another attempt to answer it
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO messages (uid, status, attempts, updated) VALUES (?, ?, 0, ?)",
+                            (uid, status.value, time.time()))
+            self.db.execute("UPDATE messages SET status = ?, updated = ?, attempts = attempts + ? WHERE uid = ?",
+                            (status.value, time.time(), 1 if status == Status.seen else 0, uid))
+
+    def defer(self, uid):
+        """
+        Give back the attempt of a message that was retrieved but put off for a later poll without trying to answer it.
+        """
+        with self.lock, self.db:
+            self.db.execute("UPDATE messages SET attempts = MAX(attempts - 1, 0), deferrals = deferrals + 1, "
+                            "updated = ? WHERE uid = ?", (time.time(), uid))
+
+    def sender(self, uid, retrieve):
+        """
+        :param retrieve: function that looks the sender up on the server, only called the first time
+        :return: the sender of the message
+        """
+        with self.lock:
+            row = self.db.execute("SELECT sender FROM senders WHERE uid = ?", (uid,)).fetchone()
+        if row is not None:
+            return row[0]
+
+        sender = retrieve()
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO senders (uid, sender) VALUES (?, ?)", (uid, sender))
+        return sender
+
+    def replied(self):
+        with self.lock:
+            rows = self.db.execute("SELECT uid FROM messages WHERE status = ?", (Status.replied.value,)).fetchall()
+        return set(uid for uid, in rows)
+
+    def prune(self, uids_on_server):
+        """
+        Forget all messages that are no longer in the mailbox.
+        """
+        uids_on_server = set(uids_on_server)
+        with self.lock, self.db:
+            for table in ("messages", "senders"):
+                known = [uid for uid, in self.db.execute("SELECT uid FROM {}".format(table)).fetchall()]
+                self.db.executemany("DELETE FROM {} WHERE uid = ?".format(table),
+                                    [(uid,) for uid in known if uid not in uids_on_server])
+
+    def close(self):
+        self.db.close()
+
+
+@contextmanager
+def init_state(filename, max_attempts=DEFAULT_MAX_ATTEMPTS, max_deferrals=DEFAULT_MAX_DEFERRALS):
+    state = MailState(filename, max_attempts, max_deferrals)
+    try:
+        yield state
+    finally:
+        state.close()
@@ -0,0 +1,158 @@
+from contextlib import contextmanager
+from functools import partial
+import json
+import logging
+import os
+import threading
+import time
+
+import gnupg
+
+from pgpbuddy.metrics import increment
+
+
+log = logging.getLogger(__name__)
+
+# the Tracer of the process, None while tracing is off
+tracer = None
+
+# fields that describe the work the current thread is doing, added to every trace entry
+context = threading.local()
+
+# the gpg commands python-gnupg runs, the first one among a process's arguments names it. the other arguments are
+# options, e.g. --batch or --keyserver, and come first for some commands. an encryption that also signs is --encrypt
+COMMANDS = ["--decrypt", "--encrypt", "--symmetric", "--clearsign", "--detach-sign", "--sign", "--verify",
+            "--import", "--export", "--export-secret-keys", "--recv-keys", "--send-keys", "--search-keys",
+            "--delete-key", "--delete-secret-key", "--delete-secret-and-public-key", "--list-keys",
+            "--list-secret-keys", "--gen-key", "--version"]
+
+# python-gnupg signs with the short forms of --sign
+ALIASES = {"-s": "--sign", "-sa": "--sign"}
+
+
+class Tracer(object):
+    """
+    Appends one JSON line per gpg process to a trace file.
+    """
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.file = open(filename, "a")
+
+    def record(self, entry):
+        line = json.dumps(entry, sort_keys=True)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+@contextmanager
+def traced(**fields):
+    """
+    Attach fields, e.g. the uid and sender of the message being handled, to the gpg processes started in the block.
+    """
+    previous = getattr(context, "fields", {})
+    context.fields = dict(previous, **fields)
+    try:
+        yield
+    finally:
+        context.fields = previous
+
+
+class TracedGPG(gnupg.GPG):
+    """
+    gnupg.GPG that counts its gpg processes and, while tracing is on, records for each of them the operation, input
+    size, wall time, CPU time and exit status.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # gnupg.GPG already runs gpg --version while it is initialized
+        self._pending = threading.local()
+        super(TracedGPG, self).__init__(*args, **kwargs)
+
+    def _handle_io(self, args, fileobj, *rest, **kwargs):
+        # the size of the input is only known here, the process is started further down
+        if tracer is not None:
+            self._pending.input_bytes = input_size(fileobj)
+        return super(TracedGPG, self)._handle_io(args, fileobj, *rest, **kwargs)
+
+    def _open_subprocess(self, args, *rest, **kwargs):
+        # count the gpg processes per command, e.g. "--decrypt"
+        command = command_name(args)
+        increment("gpg_processes_total", command=command)
+
+        process = super(TracedGPG, self)._open_subprocess(args, *rest, **kwargs)
+        if tracer is not None:
+            process.trace = dict(getattr(context, "fields", {}), operation=command,
+                                 input_bytes=getattr(self._pending, "input_bytes", None), started=time.time())
+            process.trace_start = time.perf_counter()
+            self._pending.input_bytes = None
+        return process
+
+    def _collect_output(self, process, result, *rest, **kwargs):
+        entry = getattr(process, "trace", None)
+        if entry is None:
+            return super(TracedGPG, self)._collect_output(process, result, *rest, **kwargs)
+
+        process.wait = partial(wait_with_rusage, process)
+        try:
+            return super(TracedGPG, self)._collect_output(process, result, *rest, **kwargs)
+        finally:
+            entry["wall_ms"] = 1000 * (time.perf_counter() - process.trace_start)
+            entry["exit_status"] = process.returncode
+            entry["status"] = getattr(result, "status", None)
+            usage = getattr(process, "rusage", None)
+            if usage is not None:
+                entry["user_cpu_ms"] = 1000 * usage.ru_utime
+                entry["system_cpu_ms"] = 1000 * usage.ru_stime
+                # no peak memory, the child's ru_maxrss already counts the memory of buddy it was forked from
+            active = tracer
+            if active is not None:
+                active.record(entry)
+
+
+def command_name(args):
+    args = set(ALIASES.get(arg, arg) for arg in args)
+    return next((command for command in COMMANDS if command in args), "other")
+
+
+def wait_with_rusage(process, timeout=None):
+    # Popen.wait would reap the process and throw its resource usage away
+    if process.returncode is None:
+        _, status, process.rusage = os.wait4(process.pid, 0)
+        process.returncode = exit_code(status)
+    return process.returncode
+
+
+def exit_code(status):
+    # same as Popen.returncode, negative for a process that was killed by a signal
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def input_size(fileobj):
+    try:
+        if hasattr(fileobj, "getbuffer"):
+            return fileobj.getbuffer().nbytes
+        return os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+@contextmanager
+def init_tracer(filename):
+    """
+    Trace every gpg process of buddy into filename, as JSON lines.
+    """
+    global tracer
+    tracer = Tracer(filename)
+    log.info("Tracing gpg processes to {}".format(filename))
+    try:
+        yield tracer
+    finally:
+        active, tracer = tracer, None
+        active.close()
@@ -0,0 +1,117 @@
+from collections import namedtuple
+from contextlib import contextmanager
+import logging
+import sqlite3
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LEASE = 5 * 60
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF = 60
+
+Job = namedtuple('Job', 'uid raw_message attempts')
+
+
+class WorkQueue(object):
+    """
+    Durable queue of retrieved messages between fetching and handling. A worker leases a message; if it is not
+    completed before the lease runs out (the worker crashed or handling failed) the message becomes available again.
+    Messages that were leased max_attempts times without being completed are moved to the dead-letter area.
+    """
+
+    def __init__(self, filename, lease=DEFAULT_LEASE, max_attempts=DEFAULT_MAX_ATTEMPTS, backoff=DEFAULT_BACKOFF):
+        """
+        :param filename: sqlite database file, ":memory:" for a queue that only lives as long as the process
+        :param lease: seconds a worker has to complete a message
+        :param backoff: seconds a released message waits before its second attempt, doubled for every further one
+        """
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS jobs (uid TEXT PRIMARY KEY, raw_message BLOB, "
+                            "attempts INTEGER, leased_until REAL, enqueued REAL, dead INTEGER)")
+
+    def put(self, uid, raw_message):
+        if isinstance(raw_message, list):
+            raw_message = b'\n'.join(raw_message)
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO jobs (uid, raw_message, attempts, leased_until, enqueued, dead) "
+                            "VALUES (?, ?, 0, 0, ?, 0)", (uid, raw_message, time.time()))
+
+    def take(self):
+        """
+        Lease the oldest message that is not leased by another worker.
+        :return: Job or None if there is nothing to do
+        """
+        now = time.time()
+        with self.lock, self.db:
+            while True:
+                row = self.db.execute("SELECT uid, raw_message, attempts FROM jobs "
+                                      "WHERE dead = 0 AND leased_until < ? ORDER BY enqueued LIMIT 1",
+                                      (now,)).fetchone()
+                if row is None:
+                    return None
+
+                uid, raw_message, attempts = row
+                if attempts >= self.max_attempts:
+                    log.info("Giving up on message {} after {} attempts".format(uid, attempts))
+                    self.db.execute("UPDATE jobs SET dead = 1 WHERE uid = ?", (uid,))
+                    continue
+
+                self.db.execute("UPDATE jobs SET attempts = ?, leased_until = ? WHERE uid = ?",
+                                (attempts + 1, now + self.lease, uid))
+                return Job(uid, raw_message, attempts + 1)
+
+    def complete(self, uid):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM jobs WHERE uid = ?", (uid,))
+
+    def defer(self, uid):
+        """
+        Give back the attempt of a leased message that is put off, it is handed out again once its lease runs out.
+        """
+        with self.lock, self.db:
+            self.db.execute("UPDATE jobs SET attempts = MAX(attempts - 1, 0) WHERE uid = ?", (uid,))
+
+    def release(self, uid):
+        """
+        Give back a leased message that failed, it is handed out again after a backoff instead of when the lease runs
+        out. Until then it is not taken again, e.g. by the same poll.
+        """
+        with self.lock, self.db:
+            row = self.db.execute("SELECT attempts FROM jobs WHERE uid = ?", (uid,)).fetchone()
+            if row is None:
+                return
+            backoff = min(self.backoff * 2 ** max(row[0] - 1, 0), self.lease)
+            self.db.execute("UPDATE jobs SET leased_until = ? WHERE uid = ?", (time.time() + backoff, uid))
+
+    def dead(self):
+        with self.lock:
+            rows = self.db.execute("SELECT uid, raw_message, attempts FROM jobs WHERE dead = 1").fetchall()
+        return [Job(*row) for row in rows]
+
+    def __contains__(self, uid):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM jobs WHERE uid = ?", (uid,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE dead = 0").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+
+@contextmanager
+def init_workqueue(filename, lease=DEFAULT_LEASE, max_attempts=DEFAULT_MAX_ATTEMPTS, backoff=DEFAULT_BACKOFF):
+    workqueue = WorkQueue(filename, lease, max_attempts, backoff)
+    try:
+        yield workqueue
+    finally:
+        workqueue.close()
@@ -0,0 +1,277 @@
+from contextlib import contextmanager
+import shutil
+import logging
+import tempfile
+import queue
+import subprocess
+import time
+from email.utils import parseaddr
+from os import path
+
+from pgpbuddy.keycache import normalize
+from pgpbuddy.trace import TracedGPG
+
+
+log = logging.getLogger(__name__)
+
+# gpg 1.x keeps the keys in pubring.gpg and secring.gpg, gpg 2.1 and later in pubring.kbx and private-keys-v1.d
+KEYRING_FILES = ["pubring.gpg", "secring.gpg", "pubring.kbx", "private-keys-v1.d"]
+
+# keep the unlocked secret key cached in the agent for as long as the workspace lives
+AGENT_CONF = "default-cache-ttl 31536000\nmax-cache-ttl 31536000\n"
+
+# validity values in gpg's colon listing that make a key unusable: invalid, revoked, expired, disabled
+UNUSABLE_VALIDITY = "ired"
+
+
+class KeyringIndex(object):
+    """
+    In-memory index of the public keys in a keyring by email address, so that checking whether a sender's key is
+    available does not need a gpg call.
+    """
+
+    def __init__(self):
+        self.keys = {}
+        self.addresses = {}
+
+    def add(self, listed_keys):
+        """
+        :param listed_keys: result of gpg.list_keys
+        """
+        for key in listed_keys:
+            fingerprint = key.get('fingerprint')
+            if not fingerprint:
+                continue
+            self.remove([fingerprint])
+
+            addresses = set(normalize(parseaddr(uid)[1] or uid) for uid in key.get('uids', []))
+            self.keys[fingerprint] = {'addresses': addresses,
+                                      'expires': int(key['expires']) if key.get('expires') else None,
+                                      'usable': is_usable(key)}
+            for address in addresses:
+                self.addresses.setdefault(address, set()).add(fingerprint)
+
+    def remove(self, fingerprints):
+        for fingerprint in fingerprints:
+            key = self.keys.pop(fingerprint, None)
+            if key is None:
+                continue
+            for address in key['addresses']:
+                self.addresses[address].discard(fingerprint)
+                if not self.addresses[address]:
+                    del self.addresses[address]
+
+    def clear(self):
+        self.keys = {}
+        self.addresses = {}
+
+    def lookup(self, sender):
+        """
+        :return: fingerprints of the keys of the sender that can currently be used to encrypt to the sender
+        """
+        now = time.time()
+        fingerprints = self.addresses.get(normalize(sender), set())
+        return [fingerprint for fingerprint in fingerprints
+                if self.keys[fingerprint]['usable'] and
+                (self.keys[fingerprint]['expires'] is None or self.keys[fingerprint]['expires'] > now)]
+
+
+def is_usable(key):
+    if key.get('trust') and key['trust'] in UNUSABLE_VALIDITY:
+        return False
+    # subkeys are listed as [keyid, capabilities, fingerprint], a key without subkeys encrypts with its primary key
+    subkeys = key.get('subkeys', [])
+    return not subkeys or any('e' in subkey[1] for subkey in subkeys)
+
+
+class BuddyGPG(TracedGPG):
+    """
+    TracedGPG that remembers which keys were imported into the keyring, so that a workspace can roll them back.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(BuddyGPG, self).__init__(*args, **kwargs)
+        self.encoding = 'utf-8'
+        self.imported = {}
+        self.index = KeyringIndex()
+        self._signing_fingerprint = None
+
+    @property
+    def signing_fingerprint(self):
+        # buddy's keyring holds its one secret key, every response is signed with it
+        if self._signing_fingerprint is None:
+            secret_keys = self.list_keys(True)
+            self._signing_fingerprint = secret_keys[0]['fingerprint'] if secret_keys else ''
+        return self._signing_fingerprint
+
+    def import_keys(self, key_data):
+        result = super(BuddyGPG, self).import_keys(key_data)
+        self._record_import(result)
+        return result
+
+    def recv_keys(self, keyserver, *keyids):
+        result = super(BuddyGPG, self).recv_keys(keyserver, *keyids)
+        self._record_import(result)
+        return result
+
+    def _record_import(self, result):
+        # remember whether the key was actually changed, '0' means it was already in the keyring as is
+        changed_keys = []
+        for entry in result.results:
+            fingerprint = entry.get('fingerprint')
+            if fingerprint and 'ok' in entry:
+                changed = entry['ok'] != '0' or self.imported.get(fingerprint, False)
+                self.imported[fingerprint] = changed
+                if entry['ok'] != '0':
+                    changed_keys.append(fingerprint)
+
+        # keep the index up to date with only the keys that changed
+        if changed_keys:
+            self.index.add(self.list_keys(keys=changed_keys))
+
+
+class Workspace(object):
+    """
+    Isolated GNUPGHOME that is set up once and reused for many messages. After each message the keys the message
+    imported are deleted again, so every message starts with exactly buddy's own keyring.
+    """
+
+    def __init__(self, path_to_buddy_keyring, agent=False):
+        """
+        :param agent: run a gpg-agent for the lifetime of the workspace, so that buddy's secret key is loaded and
+        unlocked once instead of by every gpg call
+        """
+        self.source = path_to_buddy_keyring
+        self.gnupghome = tempfile.mkdtemp(prefix="buddy_")
+        self._copy_keyring()
+        self.agent = agent and self._start_agent()
+        self.gpg = BuddyGPG(gnupghome=self.gnupghome, use_agent=self.agent)
+        self._build_index()
+        if self.agent:
+            # first use of the secret key loads it into the agent
+            self.gpg.sign("pgpbuddy")
+
+    @property
+    def index(self):
+        return self.gpg.index
+
+    @contextmanager
+    def message(self):
+        """
+        Provide the gpg instance for handling a single message and roll back its keyring changes afterwards.
+        """
+        try:
+            yield self.gpg
+        finally:
+            self.reset()
+
+    def reset(self):
+        imported, self.gpg.imported = self.gpg.imported, {}
+        if not imported:
+            return
+
+        # a message changed one of buddy's own keys (e.g. new signatures), deleting it is not an option
+        if any(changed for fingerprint, changed in imported.items() if fingerprint in self.baseline):
+            self.restore()
+            return
+
+        to_delete = [fingerprint for fingerprint in imported if fingerprint not in self.baseline]
+        result = self.gpg.delete_keys(to_delete)
+        if result.status != 'ok':
+            log.info("Rolling back imported keys failed ({}), restoring keyring".format(result.status))
+            self.restore()
+            return
+        self.index.remove(to_delete)
+
+    def restore(self):
+        self._copy_keyring()
+        self._build_index()
+
+    def close(self):
+        if self.agent:
+            gpgconf(self.gnupghome, "--kill", "gpg-agent")
+        shutil.rmtree(self.gnupghome, ignore_errors=True)
+
+    def _start_agent(self):
+        with open(path.join(self.gnupghome, "gpg-agent.conf"), "w") as conf:
+            conf.write(AGENT_CONF)
+        if gpgconf(self.gnupghome, "--launch", "gpg-agent"):
+            return True
+        log.info("Could not start gpg-agent, every gpg call will load the secret key itself")
+        return False
+
+    def _build_index(self):
+        keys = self.gpg.list_keys()
+        self.baseline = set(keys.fingerprints)
+        self.index.clear()
+        self.index.add(keys)
+
+    def _copy_keyring(self):
+        for filename in KEYRING_FILES:
+            source, target = path.join(self.source, filename), path.join(self.gnupghome, filename)
+            if path.isdir(source):
+                shutil.rmtree(target, ignore_errors=True)
+                shutil.copytree(source, target)
+            elif path.exists(source):
+                shutil.copyfile(source, target)
+
+
+def gpgconf(gnupghome, *args):
+    try:
+        return subprocess.call(["gpgconf", "--homedir", gnupghome] + list(args),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+    except OSError:
+        # gpg 1.x does not come with gpgconf
+        return False
+
+
+@contextmanager
+def init_workspace(path_to_buddy_keyring, agent=False):
+    workspace = Workspace(path_to_buddy_keyring, agent)
+    try:
+        yield workspace
+    finally:
+        workspace.close()
+
+
+class WorkspacePool(object):
+    """
+    One workspace per worker. A worker takes a workspace for the duration of a message and hands it back afterwards.
+    The workers of large messages take theirs from workspaces of their own, so that a large message never holds a
+    workspace a small one is waiting for.
+    """
+
+    def __init__(self, path_to_buddy_keyring, size, agent=False, large_size=0):
+        """
+        :param size: number of workspaces for small messages
+        :param large_size: number of workspaces for large messages, 0 to handle them with the small ones
+        """
+        self.size = size
+        self.large_size = large_size
+        self.workspaces = [Workspace(path_to_buddy_keyring, agent) for _ in range(size + large_size)]
+        self.available = queue.Queue()
+        self.large_available = queue.Queue()
+        for i, workspace in enumerate(self.workspaces):
+            (self.available if i < size else self.large_available).put(workspace)
+
+    @contextmanager
+    def acquire(self, large=False):
+        available = self.large_available if large and self.large_size else self.available
+        workspace = available.get()
+        try:
+            yield workspace
+        finally:
+            available.put(workspace)
+
+    def close(self):
+        for workspace in self.workspaces:
+            workspace.close()
+
+
+@contextmanager
+def init_workspaces(path_to_buddy_keyring, size, agent=False, large_size=0):
+    workspaces = WorkspacePool(path_to_buddy_keyring, size, agent, large_size)
+    try:
+        yield workspaces
+    finally:
+        workspaces.close()
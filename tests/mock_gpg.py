@@ -114,17 +114,22 @@ def mock_sign(success):
 def mock_import_keys(list_of_success_indicators):
     """
     :param list_of_success_indicators: A boolean or a list of booleans. The i-th element indicates whether
-    import_keys should succeed or fail on the i-th time it is being called.
+    import_keys should succeed or fail on the i-th time it is being called. An element can also be a list of
+    booleans, one for each key gpg reports on in that call.
     :return:
     """
 
-    def get_result(success):
-        if success:
-            result = MagicMock(gnupg.ImportResult)
-            result.results = [{'ok': '1'}]
-        else:
-            result = MagicMock(gnupg.ImportResult)
-            result.results = [{'ok': '0'}]
+    def get_result(successes):
+        if not isinstance(successes, list):
+            successes = [successes]
+        result = MagicMock(gnupg.ImportResult)
+        result.results = []
+        for i, success in enumerate(successes):
+            if success:
+                result.results.append({'fingerprint': 'FPR{}'.format(i), 'ok': '1',
+                                       'text': 'Not actually changed\nEntirely new key\n'})
+            else:
+                result.results.append({'fingerprint': None, 'problem': '0', 'text': 'No valid data found'})
         return result
 
     return init_multicall_mock(get_result, list_of_success_indicators)
@@ -135,8 +140,12 @@ def mock_search_keys(keys_to_return):
     return MagicMock(return_value=result)
 
 
-def mock_recv_keys():
-    return MagicMock(return_value=None)
+def mock_recv_keys(fingerprints=None):
+    if fingerprints is None:
+        return MagicMock(return_value=None)
+    result = MagicMock(gnupg.ImportResult)
+    result.fingerprints = fingerprints
+    return MagicMock(return_value=result)
 
 
 ###############################################################################
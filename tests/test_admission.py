@@ -0,0 +1,109 @@
+import threading
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from pgpbuddy.admission import AdmissionControl, Admission, TokenBucket
+
+
+class TestTokenBucket(TestCase):
+
+    def test_refill(self):
+        bucket = TokenBucket(rate=1, burst=2, now=0)
+        for _ in range(2):
+            assert bucket.available(0)
+            bucket.take()
+        assert not bucket.available(0.5)
+        assert bucket.available(1)
+
+    def test_burst(self):
+        bucket = TokenBucket(rate=1, burst=2, now=0)
+        bucket.refill(1000)
+        assert bucket.tokens == 2
+
+
+class TestAdmit(TestCase):
+
+    def test_sender_limit(self):
+        admission = AdmissionControl(4, sender_rate=1, sender_burst=2, domain_rate=None)
+        with patch('time.time', MagicMock(return_value=1000)):
+            assert admission.admit("User <user@example.com>") == Admission.accept
+            assert admission.admit("user@example.com") == Admission.accept
+            assert admission.admit("USER@example.com") == Admission.sender_limit
+            assert admission.admit("other@example.com") == Admission.accept
+        # one message per minute
+        with patch('time.time', MagicMock(return_value=1060)):
+            assert admission.admit("user@example.com") == Admission.accept
+
+    def test_domain_limit(self):
+        admission = AdmissionControl(4, sender_rate=None, domain_rate=1, domain_burst=2)
+        with patch('time.time', MagicMock(return_value=1000)):
+            assert admission.admit("user1@example.com") == Admission.accept
+            assert admission.admit("user2@example.com") == Admission.accept
+            assert admission.admit("user3@example.com") == Admission.domain_limit
+            assert admission.admit("user3@example.org") == Admission.accept
+
+    def test_limited_domain_takes_no_sender_token(self):
+        admission = AdmissionControl(4, sender_rate=1, sender_burst=1, domain_rate=1, domain_burst=1)
+        with patch('time.time', MagicMock(return_value=1000)):
+            assert admission.admit("user1@example.com") == Admission.accept
+            assert admission.admit("user2@example.com") == Admission.domain_limit
+        with patch('time.time', MagicMock(return_value=1060)):
+            assert admission.admit("user2@example.com") == Admission.accept
+
+    def test_eviction(self):
+        admission = AdmissionControl(4, sender_rate=1, sender_burst=1, domain_rate=None, max_tracked=2)
+        with patch('time.time', MagicMock(return_value=1000)):
+            for i in range(10):
+                admission.admit("user{}@example.com".format(i))
+            assert len(admission.buckets) == 2
+            # forgotten senders start with a full bucket
+            assert admission.admit("user0@example.com") == Admission.accept
+
+
+class TestBudget(TestCase):
+
+    def _acquire_in_thread(self, admission, size, large=False):
+        acquired = threading.Event()
+        thread = threading.Thread(target=lambda: (admission.acquire(size, large), acquired.set()))
+        thread.start()
+        return thread, acquired
+
+    def test_in_flight(self):
+        admission = AdmissionControl(2)
+        admission.acquire(10)
+        admission.acquire(10)
+        thread, acquired = self._acquire_in_thread(admission, 10)
+
+        assert not acquired.wait(0.1)
+        admission.release(10)
+        assert acquired.wait(1)
+        thread.join()
+
+    def test_bytes(self):
+        admission = AdmissionControl(10, max_bytes=100)
+        admission.acquire(60)
+        thread, acquired = self._acquire_in_thread(admission, 60)
+
+        assert not acquired.wait(0.1)
+        admission.release(60)
+        assert acquired.wait(1)
+        thread.join()
+        assert admission.bytes_in_flight == 60
+
+    def test_lanes(self):
+        admission = AdmissionControl(2, max_bytes=100, max_large_in_flight=1)
+        admission.acquire(1000, large=True)
+        thread, acquired = self._acquire_in_thread(admission, 1000, large=True)
+
+        # the large lane is full and holds all bytes, small messages still get through
+        admission.acquire(10)
+        assert admission.in_flight == 2
+        assert not acquired.wait(0.1)
+        admission.release(1000, large=True)
+        assert acquired.wait(1)
+        thread.join()
+
+    def test_large_message_alone(self):
+        admission = AdmissionControl(10, max_bytes=100)
+        admission.acquire(1000)
+        assert admission.in_flight == 1
@@ -0,0 +1,112 @@
+from email.mime.application import MIMEApplication
+from email.mime.text import MIMEText
+from email import charset
+from email.parser import BytesParser
+import os
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from pgpbuddy.attachment import spill, decoded_size, Limits, SpilledAttachment
+from pgpbuddy.crypto import decrypt_attachment, import_public_keys_from_attachments, Encryption
+from pgpbuddy.fetch import decode_attachments
+
+
+data = bytes(range(256)) * 40
+# starts with a public-key encrypted session key packet
+encrypted = b'\x85\x01\x0c\x03' + data
+
+
+def quoted_printable_part(text):
+    qp = charset.Charset('utf-8')
+    qp.body_encoding = charset.QP
+    part = MIMEText("", "plain")
+    part.set_payload(text, qp)
+    return part
+
+
+class TestSpill(TestCase):
+
+    @patch('pgpbuddy.attachment.CHUNK_SIZE', 333)
+    def test_base64(self):
+        part = MIMEApplication(data)
+        attachment = spill(part)
+
+        assert attachment.read() == data
+        assert attachment.size == len(data)
+        assert abs(decoded_size(part) - len(data)) < len(data) // 50
+
+    @patch('pgpbuddy.attachment.CHUNK_SIZE', 333)
+    def test_quoted_printable(self):
+        text = "Gänsefüßchen " * 200
+        attachment = spill(quoted_printable_part(text))
+
+        assert attachment.read().decode('utf-8') == text
+
+    def test_quoted_printable_8bit(self):
+        # unencoded 8bit data in a quoted-printable part is kept as it is instead of being replaced
+        for charset in ["utf-8", "iso-8859-1"]:
+            raw = "Content-Type: text/plain; charset={}\nContent-Transfer-Encoding: quoted-printable\n\n" \
+                  "G\u00e4nse=\r\nf\u00fc\u00dfchen\r\nline two".format(charset).encode(charset)
+            part = BytesParser().parsebytes(raw)
+            # line ends and soft line breaks split between two chunks
+            for chunk_size in range(1, 20):
+                with patch('pgpbuddy.attachment.CHUNK_SIZE', chunk_size):
+                    attachment = spill(part)
+
+                assert attachment.read() == "Gänsefüßchen\r\nline two".encode(charset)
+
+
+class TestDecodeAttachments(TestCase):
+
+    def test_limits(self):
+        small = MIMEApplication(b"small")
+        large = MIMEApplication(data)
+        limits = Limits(memory_limit=1000, max_size=10 ** 6, directory=None)
+
+        attachments = decode_attachments([small, large], limits)
+        assert attachments[0] == b"small"
+        assert isinstance(attachments[1], SpilledAttachment)
+        assert attachments[1].read() == data
+
+    def test_too_large_dropped(self):
+        limits = Limits(memory_limit=100, max_size=1000, directory=None)
+        assert decode_attachments([MIMEApplication(data)], limits) == []
+
+
+class TestSpilledCrypto(TestCase):
+
+    def test_decrypt_by_file(self):
+        def decrypt_file(file, output):
+            assert file.read() == encrypted
+            with open(output, 'wb') as out:
+                out.write(b"plaintext")
+            return MagicMock(status='decryption ok')
+
+        gpg = MagicMock()
+        gpg.decrypt_file.side_effect = decrypt_file
+        attachment = spill(MIMEApplication(encrypted))
+
+        plaintext, status = decrypt_attachment(gpg, attachment)
+        assert status == Encryption.correct
+        assert plaintext.read() == b"plaintext"
+        assert not gpg.decrypt.called
+        # the plaintext file is only reachable through the open attachment
+        assert not os.path.exists(gpg.decrypt_file.call_args[1]["output"])
+
+    def test_not_encrypted(self):
+        gpg = MagicMock()
+        gpg.decrypt_file.return_value = MagicMock(status='no data was provided')
+        attachment = spill(MIMEApplication(encrypted))
+
+        assert decrypt_attachment(gpg, attachment) == (attachment, Encryption.missing)
+
+    def test_import_key(self):
+        key = "-----BEGIN PGP PUBLIC KEY BLOCK-----\n\nabc\n-----END PGP PUBLIC KEY BLOCK-----\n"
+        gpg = MagicMock()
+        gpg.import_keys.return_value = MagicMock(results=[{'fingerprint': 'FPR', 'ok': '1', 'text': 'Entirely new key'}])
+        attachments = [(spill(MIMEApplication(key.encode())), Encryption.missing),
+                       (spill(MIMEApplication(data)), Encryption.missing)]
+
+        imported = import_public_keys_from_attachments(gpg, attachments)
+        gpg.import_keys.assert_called_once_with(key.strip())
+        assert [key.fingerprint for key in imported] == ['FPR']
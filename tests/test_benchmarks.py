@@ -0,0 +1,44 @@
+from unittest import TestCase
+
+from benchmarks.run import percentile
+from benchmarks.servers import MemoryMailbox, MemorySMTP, local_servers
+from pgpbuddy.fetch import iter_new_messages
+from pgpbuddy.send import create_message, send_responses
+from pgpbuddy.state import MailState, Status
+
+
+def raw_message(i):
+    return "From: user{}@example.com\nTo: buddy@example.com\nSubject: message {}\nContent-Type: text/plain\n\n" \
+           "Hello buddy\n".format(i, i).encode()
+
+
+class TestLocalServers(TestCase):
+
+    def test_fetch_and_send(self):
+        mailbox = MemoryMailbox([raw_message(1), raw_message(2)])
+        smtp = MemorySMTP()
+        state = MailState(":memory:")
+
+        with local_servers(mailbox, smtp):
+            messages = list(iter_new_messages("pop3", "buddy", "password", state))
+            sent, failed = send_responses("smtp", 465, "buddy", "password",
+                                          [create_message(header["From"], "re", "text")
+                                           for _, (_, header, _, _) in messages])
+            for uid, _ in messages:
+                state.mark(uid, Status.replied)
+            # answered messages are deleted on the next poll
+            assert list(iter_new_messages("pop3", "buddy", "password", state)) == []
+
+        assert [uid for uid, _ in messages] == ["uid1", "uid2"]
+        assert [recipient for recipient, _ in smtp.sent] == ["user1@example.com", "user2@example.com"]
+        assert mailbox.messages == {}
+
+
+class TestPercentile(TestCase):
+
+    def test_nearest_rank(self):
+        values = list(range(1, 101))
+        assert percentile(values, 50) == 50
+        assert percentile(values, 99) == 99
+        assert percentile([3], 99) == 3
+        assert percentile([], 50) == 0.0
@@ -0,0 +1,292 @@
+import threading
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from pgpbuddy import metrics
+from pgpbuddy.keycache import NO_KEYS
+from pgpbuddy.state import MailState, Status
+from pgpbuddy.workqueue import WorkQueue
+from pgpbuddy.resultcache import ResultCache
+from pgpbuddy.admission import AdmissionControl
+from pgpbuddy.send import create_message
+from pgpbuddy.buddy import check_and_reply_to_messages, poll_and_reply_to_messages, needs_sender_key, check_node_ttl, \
+    Resources
+from pgpbuddy.shard import LeaseStore, Coordinator
+from benchmarks.servers import MemoryMailbox, MemorySMTP, local_servers
+from pgpbuddy.workspace import WorkspacePool
+
+
+config = {"pop3-server": "pop3", "smtp-server": "smtp", "smtp-port": 465, "username": "buddy@example.com",
+          "password": "password", "gnupghome": "credentials"}
+
+
+def mock_workspaces(size, large_size=1):
+    # a real pool, workers wait for a workspace just like they do in buddy
+    with patch('pgpbuddy.workspace.Workspace'):
+        return WorkspacePool("credentials", size, large_size=large_size)
+
+
+def mock_message(sender):
+    return b"raw", {"From": sender, "Subject": "subject", "Content-Type": "text/plain"}, "body", []
+
+
+def mock_resources(workers, state, workqueue=None, results=None, admission=None, coordinator=None):
+    if admission is None:
+        admission = AdmissionControl(2 * workers, sender_rate=None, domain_rate=None)
+    return Resources(mock_workspaces(workers), None, state, workqueue, coordinator, None, results, admission)
+
+
+def mock_make_response(gpg, header, encryption_status, signature_status, reason, index=None, signatures=None):
+    if header["From"] == "broken@example.com":
+        raise ValueError("something went wrong")
+    return {"To": header["From"], "Subject": "response"}, "A"
+
+
+@patch('pgpbuddy.crypto.fetch_public_keys_from_server', MagicMock(return_value=NO_KEYS))
+@patch('pgpbuddy.buddy.handle_message', MagicMock(side_effect=lambda gpg, message, prefetcher: (message[1], None, None, '')))
+@patch('pgpbuddy.buddy.make_response', MagicMock(side_effect=mock_make_response))
+class TestCheckAndReply(TestCase):
+
+    def _run(self, senders, workers):
+        messages = [("uid{}".format(i), mock_message(sender)) for i, sender in enumerate(senders)]
+        send = MagicMock(side_effect=lambda *args: (args[-1], []))
+        self.state = MailState(":memory:")
+        with patch('pgpbuddy.buddy.iter_new_messages', MagicMock(return_value=iter(messages))), \
+                patch('pgpbuddy.buddy.send_responses', send):
+            check_and_reply_to_messages(config, mock_resources(workers, self.state))
+        return send
+
+    def test_all_replies_sent_in_one_batch(self):
+        senders = ["user{}@example.com".format(i) for i in range(10)]
+
+        send = self._run(senders, workers=4)
+
+        assert send.call_count == 1
+        responses = send.call_args[0][-1]
+        assert [response["To"] for response in responses] == senders
+
+    def test_failing_message_does_not_block_others(self):
+        senders = ["user1@example.com", "broken@example.com", "user2@example.com"]
+
+        send = self._run(senders, workers=2)
+
+        responses = send.call_args[0][-1]
+        assert [response["To"] for response in responses] == ["user1@example.com", "user2@example.com"]
+        assert self.state.replied() == {"uid0", "uid2"}
+        assert self.state.get("uid1") is None
+
+    def test_workqueue_completed_after_reply(self):
+        senders = ["user1@example.com", "broken@example.com"]
+        messages = [("uid{}".format(i), mock_message(sender)) for i, sender in enumerate(senders)]
+        queue = WorkQueue(":memory:")
+        for uid, _ in messages:
+            queue.put(uid, b"raw")
+            queue.take()
+        enqueue = MagicMock()
+        with patch('pgpbuddy.buddy.enqueue_new_messages', enqueue), \
+                patch('pgpbuddy.buddy.iter_queued_messages', MagicMock(return_value=iter(messages))), \
+                patch('pgpbuddy.buddy.send_responses', MagicMock(side_effect=lambda *args: (args[-1], []))):
+            check_and_reply_to_messages(config, mock_resources(2, MailState(":memory:"), queue))
+
+        assert enqueue.called
+        assert "uid0" not in queue
+        # stays queued and is handed out again after the backoff, not by the same poll
+        assert queue.take() is None
+        with patch('time.time', return_value=10 ** 10):
+            assert queue.take().uid == "uid1"
+        queue.close()
+
+
+@patch('pgpbuddy.crypto.fetch_public_keys_from_server', MagicMock(return_value=NO_KEYS))
+class TestDuplicates(TestCase):
+
+    def _run(self, copies, duplicate_interval):
+        messages = [("uid{}".format(i), mock_message("user@example.com")) for i in range(copies)]
+        handle = MagicMock(side_effect=lambda gpg, message, prefetcher: (message[1], None, None, ''))
+        respond = MagicMock(side_effect=lambda gpg, header, *args: (create_message(header["From"], "response", "text"),
+                                                                     "A"))
+        send = MagicMock(side_effect=lambda *args: (args[-1], []))
+        self.state = MailState(":memory:")
+        results = ResultCache(duplicate_interval=duplicate_interval)
+        with patch('pgpbuddy.buddy.iter_new_messages', MagicMock(return_value=iter(messages))), \
+                patch('pgpbuddy.buddy.handle_message', handle), patch('pgpbuddy.buddy.make_response', respond), \
+                patch('pgpbuddy.buddy.send_responses', send):
+            check_and_reply_to_messages(config, mock_resources(1, self.state, results=results))
+        return handle, send.call_args[0][-1]
+
+    def test_copies_dropped(self):
+        handle, responses = self._run(3, duplicate_interval=600)
+
+        assert handle.call_count == 1
+        assert len(responses) == 1
+        # the dropped copies are deleted from the server as well
+        assert self.state.replied() == {"uid0", "uid1", "uid2"}
+
+    def test_copies_answered_from_cache(self):
+        metrics.metrics.clear()
+        handle, responses = self._run(3, duplicate_interval=0)
+
+        assert handle.call_count == 1
+        assert [(response["To"], response["Subject"]) for response in responses] == \
+            [("user@example.com", "response")] * 3
+        assert responses[2].get_payload(0).get_payload() == "text"
+        # the answers from the cache are counted under the case of the answer they copy
+        assert metrics.metrics.get("responses_total", case="A", cached="true") == 2
+
+
+@patch('pgpbuddy.crypto.fetch_public_keys_from_server', MagicMock(return_value=NO_KEYS))
+@patch('pgpbuddy.buddy.handle_message', MagicMock(side_effect=lambda gpg, message, prefetcher: (message[1], None, None, '')))
+@patch('pgpbuddy.buddy.make_response', MagicMock(side_effect=mock_make_response))
+class TestAdmission(TestCase):
+
+    def _flood(self, state, admission):
+        senders = ["flood@example.com"] * 5 + ["user@example.com"]
+        messages = [("uid{}".format(i), mock_message(sender)) for i, sender in enumerate(senders)]
+        send = MagicMock(side_effect=lambda *args: (args[-1], []))
+        for uid, _ in messages:
+            if state.get(uid) != Status.replied:
+                state.mark(uid, Status.seen)
+        messages = [(uid, message) for uid, message in messages if state.get(uid) != Status.replied]
+        with patch('pgpbuddy.buddy.iter_new_messages', MagicMock(return_value=iter(messages))), \
+                patch('pgpbuddy.buddy.send_responses', send):
+            check_and_reply_to_messages(config, mock_resources(2, state, admission=admission))
+        return [response["To"] for response in send.call_args[0][-1]]
+
+    def test_flooding_sender_deferred(self):
+        state = MailState(":memory:", max_deferrals=2)
+        admission = AdmissionControl(4, sender_rate=1, sender_burst=2, domain_rate=None)
+
+        with patch('time.time', MagicMock(return_value=1000)):
+            assert self._flood(state, admission) == ["flood@example.com"] * 2 + ["user@example.com"]
+        # messages over the sender's limit stay on the server, their retrieval did not count as an attempt
+        assert state.replied() == {"uid0", "uid1", "uid5"}
+        assert state.attempts("uid2") == 0
+        assert state.deferrals("uid2") == 1
+        assert admission.in_flight == 0
+
+        # one more message per minute
+        with patch('time.time', MagicMock(return_value=1060)):
+            assert self._flood(state, admission) == ["flood@example.com"]
+        assert state.replied() == {"uid0", "uid1", "uid2", "uid5"}
+
+    def test_flooding_sender_dropped_after_max_deferrals(self):
+        state = MailState(":memory:", max_deferrals=1)
+        admission = AdmissionControl(4, sender_rate=1, sender_burst=2, domain_rate=None)
+
+        with patch('time.time', MagicMock(return_value=1000)):
+            self._flood(state, admission)
+            assert self._flood(state, admission) == []
+        # dropped messages are deleted without a reply
+        assert state.replied() == set("uid{}".format(i) for i in range(6))
+
+    def test_busy_domain_deferred(self):
+        senders = ["user{}@example.com".format(i) for i in range(3)] + ["user@example.org"]
+        messages = [("uid{}".format(i), mock_message(sender)) for i, sender in enumerate(senders)]
+        send = MagicMock(side_effect=lambda *args: (args[-1], []))
+        state = MailState(":memory:")
+        for uid, _ in messages:
+            state.mark(uid, Status.seen)
+        admission = AdmissionControl(4, sender_rate=None, domain_rate=1, domain_burst=2)
+        with patch('pgpbuddy.buddy.iter_new_messages', MagicMock(return_value=iter(messages))), \
+                patch('pgpbuddy.buddy.send_responses', send):
+            check_and_reply_to_messages(config, mock_resources(2, state, admission=admission))
+
+        responses = send.call_args[0][-1]
+        assert [response["To"] for response in responses] == senders[:2] + senders[3:]
+        # the deferred message stays on the server and its retrieval did not count as an attempt
+        assert state.replied() == {"uid0", "uid1", "uid3"}
+        assert state.get("uid2") == Status.seen
+        assert state.attempts("uid2") == 0
+
+
+@patch('pgpbuddy.crypto.fetch_public_keys_from_server', MagicMock(return_value=NO_KEYS))
+@patch('pgpbuddy.buddy.make_response', MagicMock(side_effect=mock_make_response))
+class TestLanes(TestCase):
+
+    def test_small_message_not_behind_large(self):
+        small_handled = threading.Event()
+
+        def handle(gpg, message, prefetcher):
+            raw_message, header, _, _ = message
+            if len(raw_message) > 10:
+                # the large message is only done once the small one was handled
+                assert small_handled.wait(5)
+            else:
+                small_handled.set()
+            return header, None, None, ''
+
+        large = (b"x" * 100,) + mock_message("large@example.com")[1:]
+        messages = [("uid0", large), ("uid1", mock_message("small@example.com"))]
+        send = MagicMock(side_effect=lambda *args: (args[-1], []))
+        state = MailState(":memory:")
+        with patch('pgpbuddy.buddy.iter_new_messages', MagicMock(return_value=iter(messages))), \
+                patch('pgpbuddy.buddy.handle_message', MagicMock(side_effect=handle)), \
+                patch('pgpbuddy.buddy.send_responses', send):
+            # with a workspace shared by both lanes the large message would hold it while waiting for the small one
+            check_and_reply_to_messages(dict(config, **{"large-message-size": 10}), mock_resources(1, state))
+
+        assert [response["To"] for response in send.call_args[0][-1]] == ["large@example.com", "small@example.com"]
+
+
+class TestNeedsSenderKey(TestCase):
+
+    def test_plain(self):
+        assert not needs_sender_key({"Content-Type": "text/plain"}, "Hello buddy")
+
+    def test_inline_pgp(self):
+        assert needs_sender_key({"Content-Type": "text/plain"}, "-----BEGIN PGP SIGNED MESSAGE-----\nHello buddy")
+
+    def test_multipart(self):
+        assert needs_sender_key({"Content-Type": "multipart/signed"}, "Hello buddy")
+        assert needs_sender_key({"Content-Type": "multipart/encrypted"}, b"binary")
+
+
+@patch('pgpbuddy.crypto.fetch_public_keys_from_server', MagicMock(return_value=NO_KEYS))
+@patch('pgpbuddy.buddy.make_response',
+       MagicMock(side_effect=lambda gpg, header, *args: (create_message(header["From"], "response", "text"), "A")))
+class TestSharedMaildrop(TestCase):
+
+    def test_locked_maildrop(self):
+        senders = ["user{}@example.com".format(i) for i in range(10)]
+        mailbox = MemoryMailbox("From: {}\nTo: buddy@example.com\nSubject: hi\nContent-Type: text/plain\n\n"
+                                "Hello buddy\n".format(sender).encode() for sender in senders)
+        smtp = MemorySMTP()
+        store = LeaseStore(":memory:")
+        store.heartbeat("node1", 60)
+        store.heartbeat("node2", 60)
+        node1 = mock_resources(1, MailState(":memory:"), coordinator=Coordinator(store, "node1"))
+        node2 = mock_resources(1, MailState(":memory:"), coordinator=Coordinator(store, "node2"))
+        locked_out = []
+
+        def handle(gpg, message, prefetcher):
+            if not locked_out:
+                # node1 holds the maildrop while it handles its messages, node2 cannot log in
+                with self.assertLogs('pgpbuddy.buddy') as logs:
+                    poll_and_reply_to_messages(config, node2, polls=1)
+                locked_out.append(logs.output)
+            return message[1], None, None, ''
+
+        with local_servers(mailbox, smtp), patch('pgpbuddy.buddy.handle_message', MagicMock(side_effect=handle)):
+            poll_and_reply_to_messages(config, node1, polls=1)
+            # node2 tries again on its next poll, it also deletes what node1 answered
+            poll_and_reply_to_messages(config, node2, polls=1)
+            poll_and_reply_to_messages(config, node1, polls=1)
+
+        assert "maildrop already locked" in locked_out[0][0]
+        assert sorted(recipient for recipient, _ in smtp.sent) == sorted(senders)
+        assert mailbox.messages == {}
+
+
+class TestCheckNodeTtl(TestCase):
+
+    def test_longer_than_poll_interval(self):
+        check_node_ttl(dict(config, **{"shard-store": "shards.sqlite", "node-ttl": 120, "poll-interval": 60}))
+        with self.assertRaises(ValueError):
+            check_node_ttl(dict(config, **{"shard-store": "shards.sqlite", "node-ttl": 60, "poll-interval": 60}))
+
+    def test_longer_than_idle(self):
+        with self.assertRaises(ValueError):
+            check_node_ttl(dict(config, **{"shard-store": "shards.sqlite", "node-ttl": 180, "imap-server": "imap"}))
+
+    def test_not_sharded(self):
+        check_node_ttl(dict(config, **{"node-ttl": 1}))
@@ -4,6 +4,7 @@ from unittest import TestCase
 from nose.tools import assert_list_equal
 
 from pgpbuddy.crypto import *
+from pgpbuddy.keycache import SenderKeys, NO_KEYS
 from tests.mock_gpg import *
 
 
@@ -44,6 +45,18 @@ class TestCheckEncryptionAndSignature(TestCase):
         assert signature_status == Signature.incorrect
         assert reason
 
+    @patch('gnupg.GPG', decrypt=mock_decrypt(Encryption.correct, Signature.incorrect),
+           verify=mock_verify(Signature.incorrect))
+    def test_correct_encrypted_incorrect_sig_single_decrypt(self, gpg):
+        result = decrypt(gpg, "blabla")
+        encryption_status, signature_status, reason = classify_decryption(result)
+        assert encryption_status == Encryption.correct
+        assert signature_status == Signature.incorrect
+        assert 'unexpected data' in reason
+        assert result.data == b'-----BEGIN PGP SIGNATURE-----'
+        assert gpg.decrypt.call_count == 1
+        assert gpg.verify.call_count == 1
+
     @patch('gnupg.GPG', decrypt=mock_decrypt(Encryption.correct, Signature.correct))
     def test_correct_encrypted_correct_sig(self, gpg):
         encryption_status, signature_status, reason = check_encryption_and_signature(gpg, "blabla")
@@ -83,104 +96,101 @@ class TestCheckEncryptionAndSignature(TestCase):
 class TestImportKeysFromAttachments(TestCase):
 
     def _mock_key(self, content):
-        return "-----BEGIN PGP PUBLIC KEY BLOCK-----\n{}\n-----END PGP PUBLIC KEY BLOCK-----\n".format(content)
+        return "-----BEGIN PGP PUBLIC KEY BLOCK-----\n{}\n-----END PGP PUBLIC KEY BLOCK-----".format(content)
 
     @patch('gnupg.GPG')
     def test_no_attachments(self, gpg):
         attachments = []
 
-        remaining_attachments = import_public_keys_from_attachments(gpg, attachments)
+        imported = import_public_keys_from_attachments(gpg, attachments)
 
-        assert remaining_attachments == []
+        assert imported == []
         assert not gpg.import_keys.called
 
     @patch('gnupg.GPG')
     def test_plain_attachment(self, gpg):
-        attachments = [("blabla", None)]
+        attachments = [("blabla", None), ("bla", Encryption.missing), ("blu", Encryption.correct)]
 
-        remaining_attachments = import_public_keys_from_attachments(gpg, attachments)
+        imported = import_public_keys_from_attachments(gpg, attachments)
 
-        assert_list_equal(attachments, remaining_attachments)
+        assert imported == []
         assert not gpg.import_keys.called
 
     @patch('gnupg.GPG', import_keys=mock_import_keys(True))
     def test_key_attachment(self, gpg):
         key = self._mock_key("PRETEND THIS IS A KEY")
-        attachments = [(key, None)]
+        attachments = [(key + "\n", None)]
 
-        remaining_attachments = import_public_keys_from_attachments(gpg, attachments)
+        imported = import_public_keys_from_attachments(gpg, attachments)
 
-        expected = []
-        assert_list_equal(expected, remaining_attachments)
-        gpg.import_keys.assert_called_once_with(self.__format_key(key))
+        assert_list_equal([KeyImport('FPR0', True, 'Not actually changed, Entirely new key')], imported)
+        gpg.import_keys.assert_called_once_with(key)
 
     @patch('gnupg.GPG', import_keys=mock_import_keys(False))
     def test_key_attachment_import_fails(self, gpg):
         key = self._mock_key("PRETEND THIS IS A KEY")
         attachments = [(key, None)]
 
-        remaining_attachments = import_public_keys_from_attachments(gpg, attachments)
+        imported = import_public_keys_from_attachments(gpg, attachments)
 
-        expected = attachments
-        assert_list_equal(expected, remaining_attachments)
-        gpg.import_keys.assert_called_once_with(self.__format_key(key))
+        assert_list_equal([KeyImport(None, False, 'No valid data found')], imported)
+        gpg.import_keys.assert_called_once_with(key)
 
-    @patch('gnupg.GPG')
+    @patch('gnupg.GPG', import_keys=mock_import_keys(True))
     def test_binary_attachment(self, gpg):
-        attachments = [(self._mock_key("This will be binary so not considered a key").encode(), None)]
-
-        remaining_attachments = import_public_keys_from_attachments(gpg, attachments)
+        key = self._mock_key("application/pgp-keys attachments are not decoded to text")
+        attachments = [(key.encode(), None), (b"\x89PNG", None)]
 
-        expected = attachments
-        assert_list_equal(expected, remaining_attachments)
-        assert not gpg.import_keys.called
+        imported = import_public_keys_from_attachments(gpg, attachments)
 
-    @patch('gnupg.GPG', import_keys=mock_import_keys([False, True, True]))
-    def test_mixture_of_everything(self, gpg):
-        key1 = self._mock_key("Failing key")
-        key2 = self._mock_key("Succeeding key")
-        key3 = self._mock_key("Another succeeding key")
-        attachments = [("blabla", None), (key1, None), (b"binary", None), (key2, None), ("ladida", None),  (key3, None)]
+        assert len(imported) == 1
+        gpg.import_keys.assert_called_once_with(key)
 
-        remaining_attachments = import_public_keys_from_attachments(gpg, attachments)
+    @patch('gnupg.GPG', import_keys=mock_import_keys([[True, True, True]]))
+    def test_single_import(self, gpg):
+        key1 = self._mock_key("First key")
+        key2 = self._mock_key("Second key, same attachment")
+        key3 = self._mock_key("Third key")
+        attachments = [("blabla", None), ("Here are my keys\n" + key1 + "\n\n" + key2, None), (b"binary", None),
+                       (key3, None)]
 
-        expected = [attachments[0], attachments[1], attachments[2], attachments[4]]
-        assert_list_equal(expected, remaining_attachments)
-        gpg.import_keys.assert_any_call(self.__format_key(key1))
-        gpg.import_keys.assert_any_call(self.__format_key(key2))
-        gpg.import_keys.assert_any_call(self.__format_key(key3))
+        imported = import_public_keys_from_attachments(gpg, attachments)
 
-    @patch('gnupg.GPG')
-    def test_preserve_encryption_status(self, gpg):
-        attachments = [("bla", Encryption.missing), ("blu", Encryption.correct), ("ble", Encryption.incorrect)]
+        assert [key.fingerprint for key in imported] == ['FPR0', 'FPR1', 'FPR2']
+        gpg.import_keys.assert_called_once_with("\n".join([key1, key2, key3]))
 
-        remaining_attachments = import_public_keys_from_attachments(gpg, attachments)
+    @patch('gnupg.GPG', import_keys=mock_import_keys([False, False, True, True]))
+    def test_broken_block(self, gpg):
+        key1 = self._mock_key("Broken key")
+        key2 = self._mock_key("Succeeding key")
+        key3 = self._mock_key("Another succeeding key")
+        attachments = [(key1, None), (key2, None), (key3, None)]
 
-        expected = attachments
-        assert_list_equal(expected, remaining_attachments)
-        assert not gpg.import_keys.called
+        imported = import_public_keys_from_attachments(gpg, attachments)
 
-    @staticmethod
-    def __format_key(key):
-        return key.strip().split("\n")
+        assert [key.ok for key in imported] == [False, True, True]
+        assert gpg.import_keys.call_count == 4
+        gpg.import_keys.assert_any_call(key1)
+        gpg.import_keys.assert_any_call(key2)
+        gpg.import_keys.assert_any_call(key3)
 
 
-class TestImportFromKeyServer():
+class TestReceiveFromKeyServer():
 
     server = 'pgp.mit.edu'
 
     @patch('gnupg.GPG', search_keys=mock_search_keys([]), recv_keys=mock_recv_keys())
     def test_no_key_found(self, gpg):
         sender = "sender@plain.txt"
-        import_public_keys_from_server(gpg, sender)
+        assert receive_public_keys(gpg, sender) == []
 
         gpg.search_keys.assert_called_once_with(sender, self.server)
         assert not gpg.recv_keys.called
 
-    @patch('gnupg.GPG', search_keys=mock_search_keys(["key1"]), recv_keys=mock_recv_keys())
+    @patch('gnupg.GPG', search_keys=mock_search_keys(["key1"]), recv_keys=mock_recv_keys(["fpr1"]))
     def test_one_key_found(self, gpg):
         sender = "sender@plain.txt"
-        import_public_keys_from_server(gpg, sender)
+        assert receive_public_keys(gpg, sender) == ["fpr1"]
 
         gpg.search_keys.assert_called_once_with(sender, self.server)
         gpg.recv_keys.assert_called_once_with(self.server, "key1")
@@ -188,12 +198,22 @@ class TestImportFromKeyServer():
     @patch('gnupg.GPG', search_keys=mock_search_keys(["key1", "key2"]), recv_keys=mock_recv_keys())
     def test_two_keys_found(self, gpg):
         sender = "sender@plain.txt"
-        import_public_keys_from_server(gpg, sender)
+        receive_public_keys(gpg, sender)
 
         gpg.search_keys.assert_called_once_with(sender, self.server)
         gpg.recv_keys.assert_any_call(self.server, "key1")
         gpg.recv_keys.assert_any_call(self.server, "key2")
 
+    @patch('gnupg.GPG', export_keys=MagicMock(return_value="armored keys"))
+    def test_sender_keys(self, gpg):
+        assert sender_keys_of(gpg, ["fpr2", "fpr1", "fpr2"]) == SenderKeys("armored keys", ("fpr1", "fpr2"))
+        gpg.export_keys.assert_called_once_with(["fpr2", "fpr1", "fpr2"])
+
+    @patch('gnupg.GPG')
+    def test_no_sender_keys(self, gpg):
+        assert sender_keys_of(gpg, []) == NO_KEYS
+        assert not gpg.export_keys.called
+
 
 class TestPublicKeyAvailable(TestCase):
     @patch('gnupg.GPG', encrypt=mock_encrypt(success=True))
@@ -210,6 +230,14 @@ class TestPublicKeyAvailable(TestCase):
 
         assert result == PublicKey.not_available
 
+    @patch('gnupg.GPG', encrypt=mock_encrypt(success=True))
+    def test_index(self, gpg):
+        index = MagicMock(lookup=MagicMock(side_effect=lambda sender: ["KEY1"] if sender == "known@plain.text" else []))
+
+        assert check_public_key_available(gpg, "known@plain.text", index) == PublicKey.available
+        assert check_public_key_available(gpg, "unknown@plain.text", index) == PublicKey.not_available
+        assert not gpg.encrypt.called
+
 
 class TestVerifyExternalSig(TestCase):
     @patch('gnupg.GPG', verify_data=mock_verify(Signature.correct))
@@ -251,3 +279,28 @@ class TestVerifyExternalSig(TestCase):
 
         assert signature_status == Signature.missing
         assert not reason
+
+
+class TestClassifyAttachment(TestCase):
+
+    def test_armored(self):
+        assert classify_attachment("-----BEGIN PGP MESSAGE-----\n\nabc") == PgpData.armored
+        assert classify_attachment(b"see below\n-----BEGIN PGP PUBLIC KEY BLOCK-----") == PgpData.armored
+
+    def test_packets(self):
+        # old format public-key encrypted session key, new format symmetrically encrypted integrity protected data
+        assert classify_attachment(b'\x85\x01\x0c\x03' + b'\x00' * 20) == PgpData.packets
+        assert classify_attachment(b'\xd2\x50\x01' + b'\x00' * 20) == PgpData.packets
+
+    def test_common_formats(self):
+        for head in [b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR', b'\xff\xd8\xff\xe0\x00\x10JFIF', b'%PDF-1.4',
+                     b'PK\x03\x04', b'GIF89a', "plain text"]:
+            assert classify_attachment(head) == PgpData.none
+
+    def test_gpg_skipped(self):
+        gpg = MagicMock()
+        data = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR'
+
+        assert decrypt_attachment(gpg, data) == (data, Encryption.missing)
+        assert not gpg.decrypt.called
+
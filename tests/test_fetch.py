@@ -0,0 +1,215 @@
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from pgpbuddy.fetch import iter_new_messages, enqueue_new_messages, iter_queued_messages, parse_message, \
+    ParsingError
+from pgpbuddy.shard import LeaseStore, Coordinator
+from pgpbuddy.state import MailState, Status
+from pgpbuddy.workqueue import WorkQueue
+
+
+def mock_message(i):
+    return ["From: user{}@example.com".format(i).encode(), b"To: buddy@example.com",
+            "Subject: message {}".format(i).encode(), b"Content-Type: text/plain", b"", b"Hello buddy"]
+
+
+def mock_pop3(num_messages):
+    conn = MagicMock()
+    conn.list.return_value = (b"+OK", ["{} 100".format(i).encode() for i in range(1, num_messages + 1)], 0)
+    conn.retr.side_effect = lambda i: (b"+OK", mock_message(i), 0)
+    conn.top.side_effect = lambda i, lines: (b"+OK", mock_message(i)[:4], 0)
+    conn.uidl.return_value = (b"+OK", ["{} uid{}".format(i, i).encode() for i in range(1, num_messages + 1)], 0)
+    return MagicMock(return_value=conn)
+
+
+class TestIterNewMessages(TestCase):
+
+    def setUp(self):
+        self.state = MailState(":memory:")
+
+    def tearDown(self):
+        self.state.close()
+
+    def test_lazy(self):
+        pop3 = mock_pop3(3)
+        with patch('poplib.POP3_SSL', pop3):
+            messages = iter_new_messages("server", "buddy", "password", self.state)
+            _, (_, header, body, _) = next(messages)
+
+            assert header["From"] == "user1@example.com"
+            assert pop3.return_value.retr.call_count == 1
+            assert len(list(messages)) == 2
+        assert pop3.return_value.quit.called
+
+    def test_not_deleted_on_retrieval(self):
+        pop3 = mock_pop3(2)
+        with patch('poplib.POP3_SSL', pop3):
+            messages = list(iter_new_messages("server", "buddy", "password", self.state))
+
+        assert [uid for uid, _ in messages] == ["uid1", "uid2"]
+        assert not pop3.return_value.dele.called
+        assert self.state.get("uid1") == Status.seen
+
+    def test_only_unanswered_retrieved(self):
+        self.state.mark("uid1", Status.replied)
+        self.state.mark("uid2", Status.processed)
+        pop3 = mock_pop3(3)
+        with patch('poplib.POP3_SSL', pop3):
+            messages = list(iter_new_messages("server", "buddy", "password", self.state))
+
+        assert [uid for uid, _ in messages] == ["uid2", "uid3"]
+        pop3.return_value.dele.assert_called_once_with(1)
+
+    def test_limit(self):
+        with patch('poplib.POP3_SSL', mock_pop3(3)):
+            messages = list(iter_new_messages("server", "buddy", "password", self.state, limit=1))
+
+        assert [uid for uid, _ in messages] == ["uid1"]
+        assert self.state.get("uid2") is None
+
+    def test_small_messages_first(self):
+        pop3 = mock_pop3(3)
+        pop3.return_value.list.return_value = (b"+OK", [b"1 5000000", b"2 2000", b"3 1000"], 0)
+        with patch('poplib.POP3_SSL', pop3):
+            messages = list(iter_new_messages("server", "buddy", "password", self.state, limit=2))
+
+        # the limit still takes the oldest messages, only their order changes
+        assert [uid for uid, _ in messages] == ["uid2", "uid1"]
+
+    def test_sharded(self):
+        store = LeaseStore(":memory:")
+        store.heartbeat("node1", 60)
+        store.heartbeat("node2", 60)
+        node1, node2 = Coordinator(store, "node1"), Coordinator(store, "node2")
+
+        with patch('poplib.POP3_SSL', mock_pop3(20)):
+            uids1 = [uid for uid, _ in iter_new_messages("server", "buddy", "password", self.state,
+                                                          coordinator=node1)]
+        with patch('poplib.POP3_SSL', mock_pop3(20)):
+            uids2 = [uid for uid, _ in iter_new_messages("server", "buddy", "password", MailState(":memory:"),
+                                                          coordinator=node2)]
+
+        assert uids1 and uids2
+        assert sorted(uids1 + uids2) == sorted("uid{}".format(i) for i in range(1, 21))
+
+    def test_heartbeat_without_new_messages(self):
+        store = LeaseStore(":memory:")
+        with patch('poplib.POP3_SSL', mock_pop3(0)):
+            assert list(iter_new_messages("server", "buddy", "password", self.state,
+                                          coordinator=Coordinator(store, "node1"))) == []
+
+        assert store.live_nodes() == ["node1"]
+
+    def test_headers_looked_at_once(self):
+        store = LeaseStore(":memory:")
+        for uid in ("uid1", "uid2"):
+            store.claim(uid, "node2", 60)
+        pop3 = mock_pop3(2)
+        for _ in range(2):
+            with patch('poplib.POP3_SSL', pop3):
+                # both messages are claimed by the other node and stay on the server
+                assert list(iter_new_messages("server", "buddy", "password", self.state,
+                                              coordinator=Coordinator(store, "node1"))) == []
+
+        assert pop3.return_value.top.call_count == 2
+
+    def test_deleted_when_other_node_replied(self):
+        store = LeaseStore(":memory:")
+        store.claim("uid1", "node2", 60)
+        store.mark_replied("uid1", "node2")
+        pop3 = mock_pop3(2)
+        with patch('poplib.POP3_SSL', pop3):
+            messages = list(iter_new_messages("server", "buddy", "password", self.state,
+                                              coordinator=Coordinator(store, "node1")))
+
+        assert [uid for uid, _ in messages] == ["uid2"]
+        pop3.return_value.dele.assert_called_once_with(1)
+
+
+class TestWorkQueueMessages(TestCase):
+
+    def setUp(self):
+        self.state = MailState(":memory:")
+        self.queue = WorkQueue(":memory:")
+
+    def tearDown(self):
+        self.state.close()
+        self.queue.close()
+
+    def test_enqueue(self):
+        pop3 = mock_pop3(2)
+        with patch('poplib.POP3_SSL', pop3):
+            assert enqueue_new_messages("server", "buddy", "password", self.state, self.queue) == 2
+            assert enqueue_new_messages("server", "buddy", "password", self.state, self.queue) == 0
+
+        assert pop3.return_value.retr.call_count == 2
+        assert len(self.queue) == 2
+
+    def test_queued_messages(self):
+        with patch('poplib.POP3_SSL', mock_pop3(2)):
+            enqueue_new_messages("server", "buddy", "password", self.state, self.queue)
+
+        messages = list(iter_queued_messages(self.queue, self.state))
+        assert [(uid, header["From"]) for uid, (_, header, _, _) in messages] == \
+            [("uid1", "user1@example.com"), ("uid2", "user2@example.com")]
+        # leased until they are answered
+        assert len(self.queue) == 2
+        assert list(iter_queued_messages(self.queue, self.state)) == []
+
+    def test_unparsable_completed(self):
+        self.queue.put("uid1", b"")
+        with patch('pgpbuddy.fetch.parse_message', side_effect=ParsingError("broken")):
+            assert list(iter_queued_messages(self.queue, self.state)) == []
+
+        assert "uid1" not in self.queue
+        assert self.state.get("uid1") == Status.replied
+
+
+signed_part = b"""Content-Type: multipart/mixed; boundary="inner"
+
+--inner
+Content-Type: text/plain; charset="utf-8"
+
+Hello buddy
+--inner
+Content-Type: application/pgp-keys; name="key.asc"
+Content-Disposition: attachment; filename="key.asc"
+
+-----BEGIN PGP PUBLIC KEY BLOCK-----
+--inner--"""
+
+signed_message = b"""From: =?utf-8?q?G=C3=A4nsef=C3=BC=C3=9Fchen?= <user@example.com>
+To: buddy@example.com
+Subject: signed
+Content-Type: multipart/signed; micalg=pgp-sha256; protocol="application/pgp-signature"; boundary="outer"
+
+--outer
+""" + signed_part + b"""
+--outer
+Content-Type: application/pgp-signature; name="signature.asc"
+
+-----BEGIN PGP SIGNATURE-----
+--outer--
+"""
+
+
+class TestParseMessage(TestCase):
+
+    def test_multipart_signed(self):
+        _, header, body, attachments = parse_message(signed_message.split(b"\n"))
+
+        assert header["Content-Type"] == "multipart/signed"
+        assert body == signed_part
+        assert attachments == ["-----BEGIN PGP SIGNATURE-----", "-----BEGIN PGP PUBLIC KEY BLOCK-----"]
+
+    def test_headers_decoded(self):
+        _, header, _, _ = parse_message(signed_message)
+
+        assert header["From"] == "G\u00e4nsef\u00fc\u00dfchen <user@example.com>"
+        assert dict(header) == {"Subject": "signed", "To": "buddy@example.com", "From": header["From"],
+                                "Content-Type": "multipart/signed"}
+
+    def test_signature_missing(self):
+        message = signed_message.replace(b"application/pgp-signature;", b"text/plain;")
+        with self.assertRaises(ParsingError):
+            parse_message(message)
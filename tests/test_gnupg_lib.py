@@ -1,13 +1,12 @@
 from os import path
 from contextlib import contextmanager
 from unittest import TestCase
+import shutil
 import tempfile
 
 import gnupg
 from nose.tools import nottest
 
-from pgpbuddy.crypto import temp_pgp_dir
-
 
 """
 This module contains tests that check the responses given by python-gnupg for various scenarios relevant to pgpbuddy.
@@ -232,6 +231,17 @@ def init_gpg(user):
     gpg.encoding = 'utf-8'
     return gpg
 
+@contextmanager
+def temp_pgp_dir(gpghome):
+    tmpdir = tempfile.mkdtemp(prefix="buddy_")
+    shutil.copyfile(path.join(gpghome, "pubring.gpg"), path.join(tmpdir, "pubring.gpg"))
+    shutil.copyfile(path.join(gpghome, "secring.gpg"), path.join(tmpdir, "secring.gpg"))
+    try:
+        yield tmpdir
+    finally:
+        shutil.rmtree(tmpdir)
+
+
 @contextmanager
 def merge_keyrings(user1, user2):
     gpg = init_gpg(user1)
@@ -0,0 +1,205 @@
+from contextlib import contextmanager
+import socket
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from pgpbuddy.imap import iter_new_messages, delete_replied, idle, serve, readable, list_uids, has_new_mail
+from pgpbuddy.shard import LeaseStore, Coordinator
+from pgpbuddy.state import MailState, Status
+
+
+def mock_message(i):
+    return "From: user{}@example.com\r\nTo: buddy@example.com\r\nSubject: message {}\r\n" \
+           "Content-Type: text/plain\r\n\r\nHello buddy\r\n".format(i, i).encode()
+
+
+def mock_imap(imap_uids, lines=None):
+    deleted = set()
+
+    def uid(command, *args):
+        if command == 'SEARCH':
+            return 'OK', [" ".join(str(i) for i in imap_uids).encode()]
+        if command == 'FETCH':
+            i = int(args[0])
+            return 'OK', [("{} (UID {} BODY[] {{100}}".format(i, i).encode(), mock_message(i)), b')']
+        if command == 'STORE':
+            deleted.update(int(i) for i in args[0].split(","))
+        return 'OK', [None]
+
+    def expunge():
+        imap_uids[:] = [i for i in imap_uids if i not in deleted]
+        return 'OK', [None]
+
+    def noop():
+        # the server reports the number of messages in the mailbox
+        conn.untagged_responses.setdefault('EXISTS', []).append(str(len(imap_uids)).encode())
+        return 'OK', [b'NOOP completed']
+
+    conn = MagicMock()
+    conn.uid.side_effect = uid
+    conn.noop.side_effect = noop
+    conn.expunge.side_effect = expunge
+    conn._new_tag.return_value = b'A001'
+    # as reported in the response to SELECT
+    conn.untagged_responses = {'UIDVALIDITY': [b'42']}
+    conn.readline.side_effect = lines or []
+    return conn
+
+
+class TestIterNewMessages(TestCase):
+
+    def setUp(self):
+        self.state = MailState(":memory:")
+
+    def tearDown(self):
+        self.state.close()
+
+    def test_new_messages(self):
+        conn = mock_imap([3, 7])
+        messages = list(iter_new_messages(conn, self.state, list_uids(conn, "42")))
+
+        assert [uid for uid, _ in messages] == ["42:3", "42:7"]
+        assert [header["Subject"] for _, (_, header, _, _) in messages] == ["message 3", "message 7"]
+        assert self.state.get("42:3") == Status.seen
+
+    def test_skip_answered(self):
+        self.state.mark("42:3", Status.replied)
+        conn = mock_imap([3, 7])
+        messages = list(iter_new_messages(conn, self.state, list_uids(conn, "42")))
+
+        assert [uid for uid, _ in messages] == ["42:7"]
+
+    def test_claimed_by_other_node(self):
+        store = LeaseStore(":memory:")
+        store.claim("42:3", "node2", 60)
+        conn = mock_imap([3, 7])
+        messages = list(iter_new_messages(conn, self.state, list_uids(conn, "42"),
+                                          coordinator=Coordinator(store, "node1")))
+
+        assert [uid for uid, _ in messages] == ["42:7"]
+        assert store.claim("42:7", "node2", 60) is False
+
+    def test_heartbeat_without_new_messages(self):
+        store = LeaseStore(":memory:")
+        assert list(iter_new_messages(mock_imap([]), self.state, {}, coordinator=Coordinator(store, "node1"))) == []
+
+        assert store.live_nodes() == ["node1"]
+
+    def test_delete_replied(self):
+        self.state.mark("42:3", Status.replied)
+        self.state.mark("42:7", Status.processed)
+        conn = mock_imap([3, 7])
+
+        assert delete_replied(conn, self.state, list_uids(conn, "42")) == 1
+        conn.uid.assert_any_call('STORE', '3', '+FLAGS', '(\\Deleted)')
+        assert conn.expunge.called
+
+    def test_has_new_mail(self):
+        imap_uids = [3, 7]
+        conn = mock_imap(imap_uids)
+
+        assert not has_new_mail(conn, 2)
+        imap_uids.append(8)
+        assert has_new_mail(conn, 2)
+        assert not conn.status.called
+
+
+class TestIdle(TestCase):
+
+    @patch('pgpbuddy.imap.readable', MagicMock(return_value=True))
+    def test_new_mail(self):
+        conn = mock_imap([], [b'+ idling\r\n', b'* 4 EXISTS\r\n', b'A001 OK IDLE terminated\r\n'])
+
+        assert idle(conn, 10)
+        conn.send.assert_any_call(b'A001 IDLE\r\n')
+        conn.send.assert_any_call(b'DONE\r\n')
+
+    @patch('pgpbuddy.imap.readable', MagicMock(return_value=False))
+    def test_timeout(self):
+        conn = mock_imap([], [b'+ idling\r\n', b'A001 OK IDLE terminated\r\n'])
+
+        assert not idle(conn, 10)
+        conn.send.assert_any_call(b'DONE\r\n')
+
+
+class StopServing(Exception):
+    pass
+
+
+class TestServe(TestCase):
+
+    def setUp(self):
+        self.state = MailState(":memory:")
+
+    def tearDown(self):
+        self.state.close()
+
+    def serve(self, conn, handle_messages, limit=None):
+        @contextmanager
+        def connect(*args):
+            yield conn
+
+        with patch('pgpbuddy.imap.connect', connect), \
+                patch('pgpbuddy.imap.idle', MagicMock(side_effect=StopServing)) as idle_mock:
+            with self.assertRaises(StopServing):
+                serve("imap.example.com", "buddy", "secret", self.state, handle_messages, limit)
+        return idle_mock
+
+    def test_mail_arrived_during_batch(self):
+        imap_uids = [3]
+        conn = mock_imap(imap_uids)
+        batches = []
+
+        def handle_messages(messages):
+            batches.append([uid for uid, _ in messages])
+            if len(batches) == 1:
+                imap_uids.append(7)
+            for uid in batches[-1]:
+                self.state.mark(uid, Status.replied)
+
+        idle_mock = self.serve(conn, handle_messages)
+        assert batches == [["42:3"], ["42:7"]]
+        assert idle_mock.call_count == 1
+        # one listing per cycle, the UIDVALIDITY is taken from the response to SELECT
+        assert [call[0][0] for call in conn.uid.call_args_list].count('SEARCH') == 2
+        assert not conn.status.called
+
+    def test_exists_announced_during_batch(self):
+        imap_uids = [3]
+        conn = mock_imap(imap_uids)
+        # this server reports new mail only together with the responses to other commands
+        conn.noop.side_effect = None
+        batches = []
+
+        def handle_messages(messages):
+            batches.append([uid for uid, _ in messages])
+            if len(batches) == 1:
+                imap_uids.append(7)
+                conn.untagged_responses['EXISTS'] = [b'2']
+            for uid in batches[-1]:
+                self.state.mark(uid, Status.replied)
+
+        self.serve(conn, handle_messages)
+        assert batches == [["42:3"], ["42:7"]]
+
+
+class TestReadable(TestCase):
+
+    def test_buffered(self):
+        server, client = socket.socketpair()
+        try:
+            conn = MagicMock()
+            conn.sock = client
+            conn.file = client.makefile('rb')
+            server.sendall(b'+ idling\r\n* 4 EXISTS\r\n')
+
+            assert conn.file.readline() == b'+ idling\r\n'
+            # the EXISTS line was read into the file's buffer, the socket itself has nothing more to read
+            assert readable(conn, 0)
+            assert conn.file.readline() == b'* 4 EXISTS\r\n'
+            assert not readable(conn, 0)
+            assert client.gettimeout() is None
+        finally:
+            conn.file.close()
+            server.close()
+            client.close()
@@ -0,0 +1,78 @@
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from pgpbuddy.keycache import KeyCache, SenderKeys, NO_KEYS, normalize
+
+
+KEYS = SenderKeys("keys", ("fpr1", "fpr2"))
+REFRESHED_KEYS = SenderKeys("refreshed keys", ("fpr1",))
+
+
+class TestKeyCache(TestCase):
+
+    def setUp(self):
+        self.fetch = MagicMock(return_value=REFRESHED_KEYS)
+        self.cache = KeyCache(":memory:", self.fetch, ttl=100, negative_ttl=10)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_miss(self):
+        assert self.cache.get("sender@example.com") is None
+
+    def test_hit(self):
+        self.cache.put("sender@example.com", KEYS)
+
+        assert self.cache.get("sender@example.com") == KEYS
+        assert self.cache.get("Sender <SENDER@example.com>") == KEYS
+        assert not self.fetch.called
+
+    def test_negative_hit(self):
+        self.cache.put("sender@example.com", NO_KEYS)
+
+        assert self.cache.get("sender@example.com") == NO_KEYS
+        assert not self.fetch.called
+
+    def test_cache_without_fingerprints(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "keycache.sqlite")
+            db = sqlite3.connect(path)
+            with db:
+                db.execute("CREATE TABLE keys (sender TEXT PRIMARY KEY, keys TEXT, fetched REAL)")
+                db.execute("INSERT INTO keys VALUES (?, ?, ?)", ("sender@example.com", "keys", 1000))
+            db.close()
+
+            cache = KeyCache(path, self.fetch)
+            assert cache.get("sender@example.com") is None
+            cache.put("sender@example.com", KEYS)
+            assert cache.get("sender@example.com") == KEYS
+            cache.close()
+
+    def test_expired_served_and_refreshed(self):
+        with patch('time.time', MagicMock(return_value=1000)):
+            self.cache.put("sender@example.com", KEYS)
+        with patch('time.time', MagicMock(return_value=1101)):
+            keys = self.cache.get("sender@example.com")
+            self.cache.executor.shutdown(wait=True)
+            refreshed_keys = self.cache.get("sender@example.com")
+
+        assert keys == KEYS
+        assert refreshed_keys == REFRESHED_KEYS
+        self.fetch.assert_called_once_with("sender@example.com")
+
+    def test_negative_entries_expire_sooner(self):
+        with patch('time.time', MagicMock(return_value=1000)):
+            self.cache.put("sender@example.com", NO_KEYS)
+        with patch('time.time', MagicMock(return_value=1011)):
+            self.cache.get("sender@example.com")
+        self.cache.executor.shutdown(wait=True)
+
+        self.fetch.assert_called_once_with("sender@example.com")
+
+
+def test_normalize():
+    assert normalize("Sender Name <Sender@Example.com>") == "sender@example.com"
+    assert normalize("sender@example.com") == "sender@example.com"
@@ -6,19 +6,23 @@ from nose_parameterized import parameterized
 from tests.mock_gpg import *
 from pgpbuddy.fetch import parse_message
 from pgpbuddy.buddy import handle_message
+from pgpbuddy.keycache import NO_KEYS
 
 
 # Add support for another client by creating a subdirectory in samples. Put sample emails generated by that client into
 # the new directory. See "samples/thunderbird_enigmail" for examples. Finally, add name of new directory to list below.
 mailclients = ["thunderbird_enigmail"]
 
+# the keyserver does not know the senders of the samples
+prefetcher = MagicMock(get=MagicMock(return_value=NO_KEYS))
+
 
 @parameterized(mailclients)
 @patch('gnupg.GPG', decrypt=mock_decrypt(Encryption.missing, Signature.correct), sign=mock_sign(success=True))
 def test_inline_signed(client, gpg):
     message = message_from_file(client, "inline_signed.txt")
     message = parse_message(message)
-    _, encryption_status, signature_status, _ = handle_message(gpg, message)
+    _, encryption_status, signature_status, _ = handle_message(gpg, message, prefetcher)
     assert encryption_status == Encryption.missing
     assert signature_status == Signature.correct
 
@@ -28,7 +32,7 @@ def test_inline_signed(client, gpg):
 def test_inline_encrypted(client, gpg):
     message = message_from_file(client, "inline_encrypted.txt")
     message = parse_message(message)
-    _, encryption_status, signature_status, _ = handle_message(gpg, message)
+    _, encryption_status, signature_status, _ = handle_message(gpg, message, prefetcher)
     assert encryption_status == Encryption.correct
     assert signature_status == Signature.missing
 
@@ -38,7 +42,7 @@ def test_inline_encrypted(client, gpg):
 def test_multipart_signed(client, gpg):
     message = message_from_file(client, "multipart_signed.txt")
     message = parse_message(message)
-    _, encryption_status, signature_status, _ = handle_message(gpg, message)
+    _, encryption_status, signature_status, _ = handle_message(gpg, message, prefetcher)
     assert encryption_status == Encryption.missing
     assert signature_status == Signature.correct
 
@@ -52,9 +56,10 @@ def test_multipart_encrypted(client, gpg):
     gpg.decrypt = mock_decrypt(Encryption.correct, Signature.missing, decrypted_body)
 
     message = parse_message(message)
-    _, encryption_status, signature_status, _ = handle_message(gpg, message)
+    _, encryption_status, signature_status, _ = handle_message(gpg, message, prefetcher)
     assert encryption_status == Encryption.correct
     assert signature_status == Signature.missing
+    assert gpg.decrypt.call_count == 1
 
 
 def message_from_file(client, filename):
@@ -0,0 +1,100 @@
+from http.server import HTTPServer
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from urllib.request import urlopen
+
+from pgpbuddy import metrics
+from pgpbuddy.buddy import make_response
+from pgpbuddy.crypto import Encryption, Signature, PublicKey
+from pgpbuddy.metrics import Metrics, timed, init_metrics
+
+
+class TestMetrics(TestCase):
+
+    def test_histogram(self):
+        registry = Metrics()
+        registry.observe("parse", 0.003)
+        registry.observe("parse", 0.2)
+
+        text = registry.render()
+        assert 'buddy_stage_seconds_bucket{stage="parse",le="0.005"} 1' in text
+        assert 'buddy_stage_seconds_bucket{stage="parse",le="0.25"} 2' in text
+        assert 'buddy_stage_seconds_bucket{stage="parse",le="+Inf"} 2' in text
+        assert 'buddy_stage_seconds_count{stage="parse"} 2' in text
+
+    def test_counters(self):
+        registry = Metrics()
+        registry.increment("responses_total", case="A")
+        registry.increment("responses_total", case="A")
+        registry.increment("responses_total", case="F")
+        registry.increment("handling_errors_total")
+
+        assert registry.get("responses_total", case="A") == 2
+        text = registry.render()
+        assert '# TYPE buddy_responses_total counter' in text
+        assert 'buddy_responses_total{case="A"} 2' in text
+        assert 'buddy_responses_total{case="F"} 1' in text
+        assert 'buddy_handling_errors_total 1' in text
+        assert "responses_total{'case': 'A'}: 2" in registry.summary()
+
+
+class TestTimed(TestCase):
+
+    def setUp(self):
+        metrics.metrics.clear()
+
+    def test_decorator(self):
+        @timed("stage")
+        def stage():
+            return "done"
+
+        assert stage() == "done"
+        assert stage() == "done"
+        assert metrics.metrics.latencies["stage"]["count"] == 2
+
+    def test_recorded_on_error(self):
+        with self.assertRaises(ValueError):
+            with timed("stage"):
+                raise ValueError()
+        assert metrics.metrics.latencies["stage"]["count"] == 1
+
+    def test_response_case_counted(self):
+        header = {"From": "sender@example.com", "Subject": "hello"}
+
+        with patch("pgpbuddy.crypto.check_public_key_available", return_value=PublicKey.not_available):
+            _, case = make_response(MagicMock(), header, Encryption.missing, Signature.missing, "")
+
+        assert case == "A"
+        assert metrics.metrics.get("responses_total", case="A", cached="false") == 1
+        assert metrics.metrics.latencies["sign_encrypt"]["count"] == 1
+
+
+class TestInitMetrics(TestCase):
+
+    def test_disabled(self):
+        with patch("pgpbuddy.metrics.HTTPServer") as server, patch("pgpbuddy.metrics.threading.Thread") as thread:
+            with init_metrics():
+                pass
+        server.assert_not_called()
+        thread.assert_not_called()
+
+    def test_server_shut_down(self):
+        with patch("pgpbuddy.metrics.HTTPServer") as server:
+            with init_metrics(port=9100):
+                server.assert_called_once_with(("", 9100), metrics.MetricsHandler)
+            server.return_value.shutdown.assert_called_once_with()
+
+    def test_scrape(self):
+        metrics.metrics.clear()
+        metrics.increment("responses_total", case="E")
+        servers = []
+
+        def create_server(*args):
+            servers.append(HTTPServer(*args))
+            return servers[-1]
+
+        with patch("pgpbuddy.metrics.HTTPServer", side_effect=create_server):
+            with init_metrics(port=0):
+                port = servers[0].server_address[1]
+                text = urlopen("http://127.0.0.1:{}/metrics".format(port)).read().decode()
+        assert 'buddy_responses_total{case="E"} 1' in text
@@ -0,0 +1,80 @@
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from pgpbuddy.keycache import NO_KEYS
+from pgpbuddy.prefetch import KeyPrefetcher
+
+
+class TestKeyPrefetcher(TestCase):
+
+    def test_lookups_run_concurrently(self):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def fetch(sender):
+            barrier.wait()
+            return "keys of {}".format(sender)
+
+        prefetcher = KeyPrefetcher(fetch, workers=3)
+        prefetcher.prefetch(["a@example.com", "b@example.com", "c@example.com"])
+
+        assert prefetcher.get("a@example.com") == "keys of a@example.com"
+        assert prefetcher.get("C <c@example.com>") == "keys of c@example.com"
+        prefetcher.close()
+
+    def test_sender_looked_up_once(self):
+        fetch = MagicMock(return_value="keys")
+        prefetcher = KeyPrefetcher(fetch)
+        prefetcher.prefetch(["a@example.com", "A <a@example.com>"])
+
+        assert prefetcher.get("a@example.com") == "keys"
+        fetch.assert_called_once_with("a@example.com")
+        prefetcher.close()
+
+    def test_get_without_prefetch(self):
+        prefetcher = KeyPrefetcher(MagicMock(return_value="keys"))
+
+        assert prefetcher.get("a@example.com") == "keys"
+        prefetcher.close()
+
+    def test_timeout(self):
+        release = threading.Event()
+
+        def fetch(sender):
+            release.wait(5)
+            return "keys"
+
+        prefetcher = KeyPrefetcher(fetch, timeout=0.05)
+        prefetcher.prefetch(["slow@example.com"])
+
+        assert prefetcher.get("slow@example.com") == NO_KEYS
+        release.set()
+        prefetcher.close()
+
+    def test_failing_lookup(self):
+        prefetcher = KeyPrefetcher(MagicMock(side_effect=OSError("network down")))
+
+        assert prefetcher.get("a@example.com") == NO_KEYS
+        prefetcher.close()
+
+    def test_keycache(self):
+        fetch = MagicMock(return_value="fetched keys")
+        keycache = MagicMock(get=MagicMock(side_effect=lambda sender: "cached keys" if sender == "a@example.com" else None))
+        prefetcher = KeyPrefetcher(fetch, keycache)
+
+        assert prefetcher.get("a@example.com") == "cached keys"
+        assert prefetcher.get("b@example.com") == "fetched keys"
+        fetch.assert_called_once_with("b@example.com")
+        keycache.put.assert_called_once_with("b@example.com", "fetched keys")
+        prefetcher.close()
+
+    def test_finished_lookups_forgotten(self):
+        fetch = MagicMock(return_value="keys")
+        prefetcher = KeyPrefetcher(fetch, timeout=0.05)
+        assert prefetcher.get("a@example.com") == "keys"
+
+        time.sleep(0.1)
+        prefetcher.prefetch(["b@example.com"])
+        assert "a@example.com" not in prefetcher.lookups
+        prefetcher.close()
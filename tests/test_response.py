@@ -0,0 +1,51 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from pgpbuddy import response
+from pgpbuddy.crypto import Encryption, Signature, PublicKey
+
+
+class TestRender(TestCase):
+
+    def test_same_as_tables(self):
+        for encryption_status, signature_status in [(Encryption.correct, Signature.correct),
+                                                    (Encryption.missing, Signature.missing),
+                                                    (Encryption.missing, Signature.incorrect)]:
+            key = (encryption_status.value, signature_status.value)
+            subject, text = response.render(encryption_status, signature_status, "hello {}", "")
+
+            assert subject == "{} (Was: hello {{}})".format(response.subject[key])
+            assert text == response.content[key]
+
+    def test_reason(self):
+        _, text = response.render(Encryption.missing, Signature.incorrect, "hello", "of {reasons}")
+        assert text == "I was not able to verify your signature... because of {reasons}"
+
+    def test_braces_in_tables(self):
+        template = response.compile_template("subject {x}", "content {x}")
+        with patch.dict(response.templates, {(Encryption.missing.value, Signature.incorrect.value): template}):
+            for reason in ["", "of {reasons}"]:
+                subject, text = response.render(Encryption.missing, Signature.incorrect, "hello", reason)
+
+                assert subject == "subject {x} (Was: hello)"
+                assert text.startswith("content {x}")
+
+    def test_unknown_combination(self):
+        _, text = response.render(Encryption.incorrect, Signature.incorrect, "hello", "")
+        assert text == response.default_content
+
+
+class TestResponseCase(TestCase):
+
+    def test_cases(self):
+        available, not_available = PublicKey.available, PublicKey.not_available
+        assert response.case(Encryption.missing, Signature.missing, not_available) == "A"
+        assert response.case(Encryption.missing, Signature.incorrect, not_available) == "B"
+        assert response.case(Encryption.missing, Signature.incorrect, available) == "C"
+        assert response.case(Encryption.correct, Signature.incorrect, available) == "D"
+        assert response.case(Encryption.missing, Signature.correct, available) == "E"
+        assert response.case(Encryption.correct, Signature.correct, available) == "F"
+        assert response.case(Encryption.correct, Signature.missing, not_available) == "G"
+        assert response.case(Encryption.correct, Signature.missing, available) == "H"
+        assert response.case(Encryption.incorrect, Signature.missing, available) == "I"
+        assert response.case(Encryption.incorrect, Signature.missing, not_available) == "J"
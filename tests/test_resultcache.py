@@ -0,0 +1,103 @@
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from pgpbuddy.attachment import SpilledAttachment
+from pgpbuddy.crypto import Encryption, Signature
+from pgpbuddy.fetch import parse_message
+from pgpbuddy.resultcache import ResultCache, Result, message_digest
+
+
+result = Result(Encryption.missing, Signature.correct, '', "E", "subject", "signed text")
+
+
+def raw_message(received, sender="Alice <alice@example.com>", body="Hello buddy"):
+    return ("Return-Path: <bounce-{0}@example.com>\r\n"
+            "Received: from mx{0}.example.com by buddy.example.com\r\n"
+            "Date: Mon, {0} Oct 2026 10:00:00 +0000\r\n"
+            "Message-ID: <{0}@example.com>\r\n"
+            "From: {1}\r\nTo: buddy@example.com\r\nSubject: Hello\r\nContent-Type: text/plain\r\n\r\n"
+            "{2}\r\n").format(received, sender, body).encode()
+
+
+def spill_text(data):
+    f = tempfile.TemporaryFile()
+    f.write(data)
+    f.flush()
+    return SpilledAttachment(f)
+
+
+def digest(raw, fingerprints=()):
+    _, header, body, attachments = parse_message(raw)
+    return message_digest(header, body, attachments, fingerprints)
+
+
+class TestMessageDigest(TestCase):
+
+    def test_transport_headers_ignored(self):
+        assert digest(raw_message(1)) == digest(raw_message(2))
+        assert digest(raw_message(1)) == digest(raw_message(2, sender="alice@EXAMPLE.com"))
+
+    def test_content(self):
+        assert digest(raw_message(1)) != digest(raw_message(1, body="Hello again"))
+        assert digest(raw_message(1)) != digest(raw_message(1, sender="bob@example.com"))
+
+    def test_attachments(self):
+        header = {"From": "alice@example.com", "Subject": "Hello", "Content-Type": "multipart/mixed"}
+        spilled = spill_text(b"attachment")
+        try:
+            assert message_digest(header, "body", [b"attachment"]) == message_digest(header, "body", [spilled])
+            assert message_digest(header, "body", [b"attachment"]) != message_digest(header, "body", [b"other"])
+            # the field boundaries are part of the digest
+            assert message_digest(header, "body", [b"attachment"]) != message_digest(header, "bodyattachment", [])
+        finally:
+            spilled.close()
+
+    def test_sender_keys(self):
+        assert digest(raw_message(1), ("fpr1", "fpr2")) == digest(raw_message(1), ("fpr2", "fpr1"))
+        assert digest(raw_message(1), ("fpr1", "fpr2")) != digest(raw_message(1), ("fpr1",))
+        assert digest(raw_message(1), ("fpr1",)) != digest(raw_message(1))
+
+
+class TestResultCache(TestCase):
+
+    def test_hit(self):
+        cache = ResultCache()
+        cache.put("digest", result)
+        assert cache.get("digest") == result
+        assert cache.get("other digest") is None
+
+    def test_expired(self):
+        cache = ResultCache(ttl=100)
+        with patch('time.time', MagicMock(return_value=1000)):
+            cache.put("digest", result)
+        with patch('time.time', MagicMock(return_value=1101)):
+            assert cache.get("digest") is None
+
+    def test_lru(self):
+        cache = ResultCache(size=2)
+        cache.put("a", result)
+        cache.put("b", result)
+        cache.get("a")
+        cache.put("c", result)
+
+        assert cache.get("a") == result
+        assert cache.get("b") is None
+        assert len(cache) == 2
+
+    def test_duplicates_not_admitted(self):
+        cache = ResultCache(duplicate_interval=600)
+        with patch('time.time', MagicMock(return_value=1000)):
+            assert cache.admit("digest", "uid1")
+            assert not cache.admit("digest", "uid2")
+            # a retry of the same message is answered
+            assert cache.admit("digest", "uid1")
+        with patch('time.time', MagicMock(return_value=1601)):
+            assert cache.admit("digest", "uid2")
+
+    def test_disabled(self):
+        cache = ResultCache(size=0)
+        cache.put("digest", result)
+        assert cache.get("digest") is None
+        assert cache.admit("digest", "uid1")
+        assert cache.admit("digest", "uid2")
@@ -0,0 +1,89 @@
+import smtplib
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from pgpbuddy.send import create_message, send_responses
+
+
+def mock_smtp(sendmail_side_effects):
+    """
+    Mock for smtplib.SMTP_SSL. Every connection that is opened shares the list of side effects, the i-th element
+    configures the i-th call to sendmail. None means that the mail is accepted.
+    """
+    connections = []
+
+    def side_effect(*args):
+        def sendmail(*args):
+            effect = sendmail_side_effects.pop(0)
+            if effect is not None:
+                raise effect
+        conn = MagicMock()
+        conn.sendmail = MagicMock(side_effect=sendmail)
+        connections.append(conn)
+        return conn
+
+    smtp = MagicMock(side_effect=side_effect)
+    smtp.connections = connections
+    return smtp
+
+
+class TestSendResponses(TestCase):
+
+    def _messages(self, n):
+        return [create_message("user{}@example.com".format(i), "subject", "content") for i in range(n)]
+
+    def test_single_session(self):
+        smtp = mock_smtp([None, None, None])
+        messages = self._messages(3)
+
+        with patch('smtplib.SMTP_SSL', smtp):
+            sent, failed = send_responses("server", 465, "buddy", "password", messages)
+
+        assert sent == messages
+        assert failed == []
+        assert smtp.call_count == 1
+        assert smtp.connections[0].login.call_count == 1
+        assert smtp.connections[0].quit.call_count == 1
+
+    def test_reconnect_when_dropped(self):
+        smtp = mock_smtp([None, smtplib.SMTPServerDisconnected("gone"), None, None])
+        messages = self._messages(3)
+
+        with patch('smtplib.SMTP_SSL', smtp):
+            sent, failed = send_responses("server", 465, "buddy", "password", messages)
+
+        assert sent == messages
+        assert failed == []
+        assert smtp.call_count == 2
+
+    def test_report_failed(self):
+        refused = smtplib.SMTPRecipientsRefused({"user1@example.com": (550, b"no such user")})
+        smtp = mock_smtp([None, refused, None])
+        messages = self._messages(3)
+
+        with patch('smtplib.SMTP_SSL', smtp):
+            sent, failed = send_responses("server", 465, "buddy", "password", messages)
+
+        assert sent == [messages[0], messages[2]]
+        assert failed == [(messages[1], refused)]
+        assert smtp.call_count == 1
+
+    def test_give_up_after_second_drop(self):
+        dropped = smtplib.SMTPServerDisconnected("gone")
+        smtp = mock_smtp([dropped, dropped, None])
+        messages = self._messages(2)
+
+        with patch('smtplib.SMTP_SSL', smtp):
+            sent, failed = send_responses("server", 465, "buddy", "password", messages)
+
+        assert sent == [messages[1]]
+        assert failed == [(messages[0], dropped)]
+
+    def test_no_messages(self):
+        smtp = mock_smtp([])
+
+        with patch('smtplib.SMTP_SSL', smtp):
+            sent, failed = send_responses("server", 465, "buddy", "password", [])
+
+        assert sent == [] and failed == []
+        assert not smtp.called
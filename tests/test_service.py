@@ -0,0 +1,46 @@
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from pgpbuddy.keycache import NO_KEYS
+from pgpbuddy.service import run
+from pgpbuddy.state import MailState, Status
+from tests.test_buddy import config, mock_resources, mock_message
+
+
+def mock_process_message(resources, prefetcher, uid, message, large=False):
+    _, header, _, _ = message
+    if header["From"] == "broken@example.com":
+        return None
+    return {"To": header["From"], "Subject": "response"}
+
+
+@patch('pgpbuddy.crypto.fetch_public_keys_from_server', MagicMock(return_value=NO_KEYS))
+@patch('pgpbuddy.service.process_message', MagicMock(side_effect=mock_process_message))
+class TestService(TestCase):
+
+    def _run(self, senders, queue_size):
+        messages = [("uid{}".format(i), mock_message(sender)) for i, sender in enumerate(senders)]
+        send = MagicMock(side_effect=lambda *args: (args[-1], []))
+        state = MailState(":memory:")
+        service_config = dict(config, **{"queue-size": queue_size})
+        with patch('pgpbuddy.buddy.iter_new_messages', MagicMock(return_value=iter(messages))), \
+                patch('pgpbuddy.service.send_responses', send):
+            run(service_config, mock_resources(2, state), polls=1)
+        return send, state
+
+    def test_all_messages_answered(self):
+        senders = ["user{}@example.com".format(i) for i in range(20)]
+
+        send, state = self._run(senders, queue_size=3)
+
+        sent = [response["To"] for call in send.call_args_list for response in call[0][-1]]
+        assert sorted(sent) == sorted(senders)
+        assert state.replied() == set("uid{}".format(i) for i in range(20))
+
+    def test_unanswered_not_marked(self):
+        senders = ["user1@example.com", "broken@example.com"]
+
+        send, state = self._run(senders, queue_size=5)
+
+        assert state.replied() == {"uid0"}
+        assert state.get("uid1") is None
@@ -0,0 +1,78 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from pgpbuddy.shard import HashRing, LeaseStore, Coordinator
+
+
+class TestHashRing(TestCase):
+
+    def test_empty(self):
+        assert HashRing([]).owner("user@example.com") is None
+
+    def test_all_nodes_get_keys(self):
+        ring = HashRing(["node1", "node2", "node3"])
+        owners = set(ring.owner("user{}@example.com".format(i)) for i in range(100))
+        assert owners == {"node1", "node2", "node3"}
+
+    def test_only_keys_of_leaving_node_move(self):
+        before = HashRing(["node1", "node2", "node3"])
+        after = HashRing(["node1", "node2"])
+        for i in range(100):
+            key = "user{}@example.com".format(i)
+            if before.owner(key) != "node3":
+                assert after.owner(key) == before.owner(key)
+
+
+class TestCoordinator(TestCase):
+
+    def setUp(self):
+        self.store = LeaseStore(":memory:")
+        self.node1 = Coordinator(self.store, "node1", claim_ttl=60)
+        self.node2 = Coordinator(self.store, "node2", claim_ttl=60)
+        # both nodes have to be known before the shares are computed
+        self.store.heartbeat("node1", 60)
+        self.store.heartbeat("node2", 60)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_disjoint_senders(self):
+        senders = ["User{} <user{}@example.com>".format(i, i) for i in range(50)]
+        owned1 = set(sender for sender in senders if self.node1.owns(sender))
+        owned2 = set(sender for sender in senders if self.node2.owns(sender))
+
+        assert owned1 and owned2
+        assert owned1 | owned2 == set(senders)
+        assert not owned1 & owned2
+
+    def test_claim(self):
+        assert self.store.claim("uid1", "node1", 60)
+        assert self.store.claim("uid1", "node1", 60)
+        assert not self.store.claim("uid1", "node2", 60)
+
+        with patch('time.time', return_value=10 ** 10):
+            assert self.store.claim("uid1", "node2", 60)
+
+    def test_replied_claim_not_taken_over(self):
+        self.store.claim("uid1", "node1", 60)
+        self.store.mark_replied("uid1", "node1")
+
+        with patch('time.time', return_value=10 ** 10):
+            assert not self.store.claim("uid1", "node2", 60)
+        assert self.store.replied() == {"uid1"}
+
+        self.store.prune(["uid2"])
+        assert self.store.replied() == set()
+
+    def test_heartbeat(self):
+        node3 = Coordinator(self.store, "node3", node_ttl=60)
+        node3.heartbeat()
+        assert "node3" in self.store.live_nodes()
+
+        with patch('time.time', return_value=10 ** 10):
+            assert "node3" not in self.store.live_nodes()
+
+    def test_gone_node_loses_senders(self):
+        self.store.leave("node2")
+        node1 = Coordinator(self.store, "node1")
+        assert all(node1.owns("user{}@example.com".format(i)) for i in range(20))
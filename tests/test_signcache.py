@@ -0,0 +1,46 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from pgpbuddy.crypto import encrypt_response, ResponseEncryption
+from pgpbuddy.signcache import SignatureCache
+
+
+class TestSignatureCache(TestCase):
+
+    def test_lru(self):
+        cache = SignatureCache(2)
+        cache.put("a", "signed a")
+        cache.put("b", "signed b")
+        cache.get("a")
+        cache.put("c", "signed c")
+
+        assert cache.get("a") == "signed a"
+        assert cache.get("b") is None
+        assert len(cache) == 2
+
+    def test_disabled(self):
+        cache = SignatureCache(0)
+        cache.put("a", "signed a")
+        assert cache.get("a") is None
+
+    def test_signed_once(self):
+        gpg = MagicMock(signing_fingerprint="FPR")
+        gpg.sign.return_value = MagicMock(data=b"signed")
+        cache = SignatureCache()
+
+        for recipient in ["user1@example.com", "user2@example.com"]:
+            assert encrypt_response(gpg, ResponseEncryption.sign, "text", recipient, cache) == "signed"
+            encrypt_response(gpg, ResponseEncryption.encrypt_fails_but_sign, "text", recipient, cache)
+
+        assert gpg.sign.call_count == 2
+
+    def test_encrypted_not_cached(self):
+        gpg = MagicMock(signing_fingerprint="FPR")
+        gpg.encrypt.return_value = MagicMock(ok=True, data=b"encrypted")
+        cache = SignatureCache()
+
+        encrypt_response(gpg, ResponseEncryption.encrypt_and_sign, "text", "user@example.com", cache)
+        encrypt_response(gpg, ResponseEncryption.encrypt_and_sign, "text", "user@example.com", cache)
+
+        assert gpg.encrypt.call_count == 2
+        assert len(cache) == 0
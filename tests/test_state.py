@@ -0,0 +1,94 @@
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from pgpbuddy.state import MailState, Status
+
+
+class TestMailState(TestCase):
+
+    def setUp(self):
+        self.state = MailState(":memory:", max_attempts=2)
+
+    def tearDown(self):
+        self.state.close()
+
+    def test_new_message(self):
+        assert self.state.get("uid1") is None
+        assert self.state.should_retrieve("uid1")
+
+    def test_lifecycle(self):
+        self.state.mark("uid1", Status.seen)
+        assert self.state.get("uid1") == Status.seen
+        self.state.mark("uid1", Status.processed)
+        assert self.state.should_retrieve("uid1")
+        self.state.mark("uid1", Status.replied)
+
+        assert self.state.get("uid1") == Status.replied
+        assert self.state.replied() == {"uid1"}
+        assert not self.state.should_retrieve("uid1")
+
+    def test_give_up_after_max_attempts(self):
+        self.state.mark("uid1", Status.seen)
+        assert self.state.should_retrieve("uid1")
+        self.state.mark("uid1", Status.seen)
+
+        assert self.state.attempts("uid1") == 2
+        assert not self.state.should_retrieve("uid1")
+
+    def test_defer(self):
+        self.state.mark("uid1", Status.seen)
+        self.state.mark("uid1", Status.seen)
+        self.state.defer("uid1")
+
+        assert self.state.attempts("uid1") == 1
+        assert self.state.should_retrieve("uid1")
+        assert self.state.deferrals("uid1") == 1
+
+    def test_give_up_deferring_after_max_deferrals(self):
+        state = MailState(":memory:", max_deferrals=2)
+        state.mark("uid1", Status.seen)
+        for _ in range(2):
+            assert state.should_defer("uid1")
+            state.defer("uid1")
+
+        assert not state.should_defer("uid1")
+        state.close()
+
+    def test_state_without_deferrals(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "state.sqlite")
+            db = sqlite3.connect(path)
+            with db:
+                db.execute("CREATE TABLE messages "
+                           "(uid TEXT PRIMARY KEY, status INTEGER, attempts INTEGER, updated REAL)")
+                db.execute("INSERT INTO messages VALUES (?, ?, ?, ?)", ("uid1", Status.seen.value, 1, 1000))
+            db.close()
+
+            state = MailState(path)
+            assert state.get("uid1") == Status.seen
+            assert state.deferrals("uid1") == 0
+            state.defer("uid1")
+            assert state.deferrals("uid1") == 1
+            state.close()
+
+    def test_sender(self):
+        retrieve = MagicMock(return_value="user@example.com")
+
+        assert self.state.sender("uid1", retrieve) == "user@example.com"
+        assert self.state.sender("uid1", retrieve) == "user@example.com"
+        assert retrieve.call_count == 1
+
+        self.state.prune(["uid2"])
+        self.state.sender("uid1", retrieve)
+        assert retrieve.call_count == 2
+
+    def test_prune(self):
+        self.state.mark("uid1", Status.replied)
+        self.state.mark("uid2", Status.seen)
+        self.state.prune(["uid2", "uid3"])
+
+        assert self.state.get("uid1") is None
+        assert self.state.get("uid2") == Status.seen
@@ -0,0 +1,111 @@
+from io import BytesIO
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from pgpbuddy import metrics, trace
+from pgpbuddy.trace import TracedGPG, init_tracer, traced, input_size, exit_code, command_name
+
+
+class TestTracedGPG(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="buddy_test_")
+        self.filename = os.path.join(self.directory, "trace.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def entries(self):
+        with open(self.filename) as trace_file:
+            return [json.loads(line) for line in trace_file]
+
+    def test_process_recorded(self):
+        # gnupg.GPG starts gpg --version while it is initialized
+        with init_tracer(self.filename), traced(uid="uid1", sender="sender@example.com"):
+            TracedGPG(gnupghome=self.directory)
+
+        entry, = self.entries()
+        assert entry["operation"] == "--version"
+        assert entry["uid"] == "uid1"
+        assert entry["sender"] == "sender@example.com"
+        assert entry["exit_status"] == 0
+        assert entry["wall_ms"] > 0
+        assert "user_cpu_ms" in entry and "system_cpu_ms" in entry
+
+    def test_off_by_default(self):
+        metrics.metrics.clear()
+        gpg = TracedGPG(gnupghome=self.directory)
+        assert trace.tracer is None
+        assert gpg.version
+        assert metrics.metrics.get("gpg_processes_total", command="--version") == 1
+        assert not os.path.exists(self.filename)
+
+    def test_tracer_closed(self):
+        with init_tracer(self.filename) as tracer:
+            pass
+        assert trace.tracer is None
+        assert tracer.file.closed
+
+
+class TestTraced(TestCase):
+
+    def test_nested(self):
+        with traced(uid="uid1"):
+            with traced(sender="sender@example.com"):
+                assert trace.context.fields == {"uid": "uid1", "sender": "sender@example.com"}
+            assert trace.context.fields == {"uid": "uid1"}
+        assert trace.context.fields == {}
+
+
+class TestCommandName(TestCase):
+
+    def test_options_before_command(self):
+        # as python-gnupg builds them for delete_keys, search_keys, recv_keys and sign
+        assert command_name(['--batch', '--delete-key', 'FPR']) == "--delete-key"
+        assert command_name(['--fixed-list-mode', '--fingerprint', '--with-colons', '--keyserver', 'pgp.mit.edu',
+                             '--search-keys', 'user@example.com']) == "--search-keys"
+        assert command_name(['--keyserver', 'pgp.mit.edu', '--recv-keys', 'KEYID']) == "--recv-keys"
+        assert command_name(['-sa', '--clearsign', '--default-key', 'KEYID']) == "--clearsign"
+        assert command_name(['-sa', '--default-key', 'KEYID']) == "--sign"
+
+    def test_encrypt_and_sign(self):
+        assert command_name(['--encrypt', '--recipient', 'KEYID', '--armor', '--sign']) == "--encrypt"
+
+    def test_unknown(self):
+        assert command_name(['--list-config', '--with-colons']) == "other"
+
+
+class TestExitCode(TestCase):
+
+    def test_exited(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(3)
+        _, status = os.waitpid(pid, 0)
+        assert exit_code(status) == 3
+
+    def test_killed(self):
+        pid = os.fork()
+        if pid == 0:
+            os.kill(os.getpid(), 9)
+            os._exit(0)
+        _, status = os.waitpid(pid, 0)
+        assert exit_code(status) == -9
+
+
+class TestInputSize(TestCase):
+
+    def test_memory(self):
+        assert input_size(BytesIO(b"12345")) == 5
+
+    def test_file(self):
+        with tempfile.TemporaryFile() as data:
+            data.write(b"123456")
+            data.seek(2)
+            assert input_size(data) == 4
+
+    def test_unknown(self):
+        assert input_size(None) is None
@@ -0,0 +1,98 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from pgpbuddy.workqueue import WorkQueue
+
+
+class TestWorkQueue(TestCase):
+
+    def setUp(self):
+        self.queue = WorkQueue(":memory:", lease=60, max_attempts=2)
+
+    def tearDown(self):
+        self.queue.close()
+
+    def test_take_in_order(self):
+        self.queue.put("uid1", [b"line1", b"line2"])
+        self.queue.put("uid2", b"message 2")
+
+        job = self.queue.take()
+        assert job.uid == "uid1"
+        assert job.raw_message == b"line1\nline2"
+        assert job.attempts == 1
+        assert self.queue.take().uid == "uid2"
+        assert self.queue.take() is None
+
+    def test_put_twice(self):
+        self.queue.put("uid1", b"message")
+        self.queue.put("uid1", b"message")
+        assert len(self.queue) == 1
+
+    def test_complete(self):
+        self.queue.put("uid1", b"message")
+        self.queue.take()
+        self.queue.complete("uid1")
+
+        assert "uid1" not in self.queue
+        assert len(self.queue) == 0
+
+    def test_lease_expires(self):
+        self.queue.put("uid1", b"message")
+        self.queue.take()
+        assert self.queue.take() is None
+
+        with patch('time.time', return_value=10 ** 10):
+            job = self.queue.take()
+        assert job.uid == "uid1"
+        assert job.attempts == 2
+
+    def test_release(self):
+        queue = WorkQueue(":memory:", lease=300, max_attempts=5, backoff=10)
+        queue.put("uid1", b"message")
+        now = 1000
+        # the backoff doubles with every attempt
+        for backoff in [10, 20, 40]:
+            with patch('time.time', return_value=now):
+                assert queue.take().uid == "uid1"
+                queue.release("uid1")
+                # not taken again by the same poll
+                assert queue.take() is None
+            with patch('time.time', return_value=now + backoff - 1):
+                assert queue.take() is None
+            now += backoff + 1
+        queue.close()
+
+    def test_release_not_later_than_lease(self):
+        queue = WorkQueue(":memory:", lease=60, backoff=50)
+        queue.put("uid1", b"message")
+        with patch('time.time', return_value=1000):
+            queue.take()
+            queue.release("uid1")
+        with patch('time.time', return_value=1051):
+            queue.take()
+            queue.release("uid1")
+        with patch('time.time', return_value=1112):
+            assert queue.take().attempts == 3
+        queue.close()
+
+    def test_defer(self):
+        self.queue.put("uid1", b"message")
+        self.queue.take()
+        self.queue.defer("uid1")
+        # still leased until the lease runs out
+        assert self.queue.take() is None
+
+        with patch('time.time', return_value=10 ** 10):
+            assert self.queue.take().attempts == 1
+
+    def test_dead_letter(self):
+        self.queue.put("uid1", b"message")
+        for now in [1000, 2000]:
+            with patch('time.time', return_value=now):
+                self.queue.take()
+                self.queue.release("uid1")
+
+        with patch('time.time', return_value=3000):
+            assert self.queue.take() is None
+        assert [job.uid for job in self.queue.dead()] == ["uid1"]
+        assert len(self.queue) == 0
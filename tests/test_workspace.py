@@ -0,0 +1,207 @@
+import os
+from os import path
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+import shutil
+import tempfile
+
+from pgpbuddy.workspace import Workspace, WorkspacePool, BuddyGPG, KeyringIndex
+
+
+BUDDY_KEY = "BUDDY"
+
+
+def mock_buddy_gpg(delete_status='ok'):
+    def side_effect(*args, **kwargs):
+        gpg = MagicMock()
+        gpg.imported = {}
+        gpg.list_keys.return_value.fingerprints = [BUDDY_KEY]
+        gpg.delete_keys.return_value.status = delete_status
+        return gpg
+    return MagicMock(side_effect=side_effect)
+
+
+class TestWorkspace(TestCase):
+
+    def setUp(self):
+        self.keyring = tempfile.mkdtemp()
+        for filename in ["pubring.gpg", "secring.gpg"]:
+            with open(path.join(self.keyring, filename), "w") as f:
+                f.write("original")
+
+    def tearDown(self):
+        shutil.rmtree(self.keyring)
+
+    def _modify_pubring(self, workspace):
+        with open(path.join(workspace.gnupghome, "pubring.gpg"), "w") as f:
+            f.write("modified")
+
+    def _pubring(self, workspace):
+        with open(path.join(workspace.gnupghome, "pubring.gpg")) as f:
+            return f.read()
+
+    @patch('pgpbuddy.workspace.BuddyGPG', mock_buddy_gpg())
+    def test_nothing_imported(self):
+        workspace = Workspace(self.keyring)
+        with workspace.message():
+            pass
+
+        assert not workspace.gpg.delete_keys.called
+        workspace.close()
+        assert not path.exists(workspace.gnupghome)
+
+    @patch('pgpbuddy.workspace.BuddyGPG', mock_buddy_gpg())
+    def test_imported_keys_deleted(self):
+        workspace = Workspace(self.keyring)
+        with workspace.message() as gpg:
+            gpg.imported = {"KEY1": True, "KEY2": False}
+
+        workspace.gpg.delete_keys.assert_called_once_with(["KEY1", "KEY2"])
+        workspace.index.remove.assert_called_once_with(["KEY1", "KEY2"])
+        assert workspace.gpg.imported == {}
+        workspace.close()
+
+    @patch('pgpbuddy.workspace.BuddyGPG', mock_buddy_gpg())
+    def test_buddy_key_changed(self):
+        workspace = Workspace(self.keyring)
+        with workspace.message() as gpg:
+            gpg.imported = {BUDDY_KEY: True, "KEY1": True}
+            self._modify_pubring(workspace)
+
+        assert not workspace.gpg.delete_keys.called
+        assert self._pubring(workspace) == "original"
+        workspace.close()
+
+    @patch('pgpbuddy.workspace.BuddyGPG', mock_buddy_gpg())
+    def test_buddy_key_unchanged(self):
+        workspace = Workspace(self.keyring)
+        with workspace.message() as gpg:
+            gpg.imported = {BUDDY_KEY: False, "KEY1": True}
+
+        workspace.gpg.delete_keys.assert_called_once_with(["KEY1"])
+        workspace.close()
+
+    @patch('pgpbuddy.workspace.BuddyGPG', mock_buddy_gpg(delete_status='No such key'))
+    def test_restore_if_delete_fails(self):
+        workspace = Workspace(self.keyring)
+        with workspace.message() as gpg:
+            gpg.imported = {"KEY1": True}
+            self._modify_pubring(workspace)
+
+        assert self._pubring(workspace) == "original"
+        workspace.close()
+
+    @patch('pgpbuddy.workspace.BuddyGPG', mock_buddy_gpg())
+    def test_gpg2_keyring(self):
+        gpg2_keyring = tempfile.mkdtemp()
+        with open(path.join(gpg2_keyring, "pubring.kbx"), "w") as f:
+            f.write("original")
+        os.mkdir(path.join(gpg2_keyring, "private-keys-v1.d"))
+        with open(path.join(gpg2_keyring, "private-keys-v1.d", "BUDDY.key"), "w") as f:
+            f.write("secret")
+
+        workspace = Workspace(gpg2_keyring)
+        os.remove(path.join(workspace.gnupghome, "private-keys-v1.d", "BUDDY.key"))
+        workspace.restore()
+
+        assert path.exists(path.join(workspace.gnupghome, "pubring.kbx"))
+        assert path.exists(path.join(workspace.gnupghome, "private-keys-v1.d", "BUDDY.key"))
+        workspace.close()
+        shutil.rmtree(gpg2_keyring)
+
+    @patch('pgpbuddy.workspace.BuddyGPG', mock_buddy_gpg())
+    @patch('subprocess.call', MagicMock(return_value=0))
+    def test_agent(self):
+        import subprocess
+        workspace = Workspace(self.keyring, agent=True)
+
+        assert workspace.agent
+        assert path.exists(path.join(workspace.gnupghome, "gpg-agent.conf"))
+        assert subprocess.call.call_args[0][0][-2:] == ["--launch", "gpg-agent"]
+        assert workspace.gpg.sign.call_count == 1
+
+        with workspace.message() as gpg:
+            gpg.sign("response")
+        assert workspace.gpg.sign.call_count == 2
+
+        workspace.close()
+        assert subprocess.call.call_args[0][0][-2:] == ["--kill", "gpg-agent"]
+
+    @patch('pgpbuddy.workspace.BuddyGPG', mock_buddy_gpg())
+    @patch('subprocess.call', MagicMock(side_effect=OSError("no gpgconf")))
+    def test_agent_not_available(self):
+        workspace = Workspace(self.keyring, agent=True)
+
+        assert not workspace.agent
+        assert not workspace.gpg.sign.called
+        workspace.close()
+
+
+class TestWorkspacePool(TestCase):
+
+    @patch('pgpbuddy.workspace.Workspace', MagicMock(side_effect=lambda *args: MagicMock()))
+    def test_large_lane(self):
+        pool = WorkspacePool("keyring", 1, large_size=1)
+
+        with pool.acquire() as small, pool.acquire(large=True) as large:
+            assert small is not large
+            assert pool.available.empty() and pool.large_available.empty()
+
+    @patch('pgpbuddy.workspace.Workspace', MagicMock(side_effect=lambda *args: MagicMock()))
+    def test_no_large_lane(self):
+        pool = WorkspacePool("keyring", 1)
+
+        with pool.acquire(large=True):
+            assert pool.available.empty()
+
+
+class TestRecordImport(TestCase):
+
+    def test_record(self):
+        gpg = BuddyGPG.__new__(BuddyGPG)
+        gpg.imported = {}
+        gpg.index = KeyringIndex()
+        gpg.list_keys = MagicMock(return_value=[mock_key("KEY1", "user1@example.com")])
+        result = MagicMock(results=[{'fingerprint': "KEY1", 'ok': '1'},
+                                    {'fingerprint': "KEY2", 'ok': '0'},
+                                    {'fingerprint': None, 'problem': '0'}])
+
+        gpg._record_import(result)
+
+        assert gpg.imported == {"KEY1": True, "KEY2": False}
+        gpg.list_keys.assert_called_once_with(keys=["KEY1"])
+        assert gpg.index.lookup("user1@example.com") == ["KEY1"]
+
+
+def mock_key(fingerprint, address, trust='-', expires='', capabilities='e'):
+    return {'fingerprint': fingerprint, 'uids': ["Some User <{}>".format(address)], 'trust': trust,
+            'expires': expires, 'subkeys': [[fingerprint[-8:], capabilities, fingerprint + "SUB"]]}
+
+
+class TestKeyringIndex(TestCase):
+
+    def test_lookup(self):
+        index = KeyringIndex()
+        index.add([mock_key("KEY1", "user1@example.com"), mock_key("KEY2", "User2@Example.com")])
+
+        assert index.lookup("user1@example.com") == ["KEY1"]
+        assert index.lookup("Somebody <user2@example.com>") == ["KEY2"]
+        assert index.lookup("user3@example.com") == []
+
+    def test_unusable_keys(self):
+        index = KeyringIndex()
+        index.add([mock_key("REVOKED", "user@example.com", trust='r'),
+                   mock_key("EXPIRED", "user@example.com", expires='1000'),
+                   mock_key("SIGN_ONLY", "user@example.com", capabilities='s')])
+
+        assert index.lookup("user@example.com") == []
+
+    def test_remove(self):
+        index = KeyringIndex()
+        index.add([mock_key("KEY1", "user@example.com"), mock_key("KEY2", "user@example.com")])
+        index.remove(["KEY1"])
+
+        assert index.lookup("user@example.com") == ["KEY2"]
+        index.remove(["KEY2"])
+        assert index.lookup("user@example.com") == []
+        assert index.addresses == {}